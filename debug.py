@@ -44,6 +44,89 @@ class Uploader(QWidget):
         self.progressBar.setValue(progress)
         self.progressBar.setFormat(f"{fileName} - {progress}%")
 
+class StreamStats(QWidget):
+    """每个流的收发速率、消息数、重同步/CRC错误、写队列深度和drain耗时"""
+    COLUMNS=[
+        ("send kb/s",lambda s:f"{s['send_rate']/1024:.1f}"),
+        ("recv kb/s",lambda s:f"{s['receive_rate']/1024:.1f}"),
+        ("send msg/s",lambda s:f"{s['send_message_rate']:.0f}"),
+        ("recv msg/s",lambda s:f"{s['receive_message_rate']:.0f}"),
+        ("queue kb",lambda s:f"{s['queue_bytes']/1024:.1f}"),
+        ("drain ms",lambda s:f"{s['drain_ms']}"),
+        ("resync",lambda s:str(s['resyncs'])),
+        ("crc",lambda s:str(s['crc_mismatches'])),
+    ]
+    def __init__(self):
+        super().__init__()
+        self.setupUi()
+    
+    def setupUi(self):
+        self.setLayout(QVBoxLayout())
+        self.table=TableWidget()
+        self.table.setColumnCount(len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels([name for name,_ in self.COLUMNS])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setMinimumHeight(180)
+        self.layout().addWidget(self.table)
+    
+    def updateStats(self,value:dict):
+        self.table.setRowCount(len(value))
+        self.table.setVerticalHeaderLabels(list(value.keys()))
+        for row,stats in enumerate(value.values()):
+            for column,(_,format) in enumerate(self.COLUMNS):
+                self.table.setItem(row,column,QTableWidgetItem(format(stats)))
+
+class LatencyStats(QWidget):
+    """视频/音频/控制延迟的分位数(本周期和累计)，可以导出累计直方图"""
+    exportLatency=pyqtSignal(str)
+    COLUMNS=["count","p50","p95","p99","max"]
+    def __init__(self):
+        super().__init__()
+        self.setupUi()
+    
+    def setupUi(self):
+        self.setLayout(QVBoxLayout())
+        self.table=TableWidget()
+        self.table.setColumnCount(len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setMinimumHeight(220)
+        self.exportButton=PushButton("Export Latency")
+        self.exportButton.clicked.connect(self.export)
+        self.layout().addWidget(self.table)
+        self.layout().addWidget(self.exportButton)
+    
+    def updateStats(self,value:dict):
+        rows=[(f"{name} {period}",stats[period]) for name,stats in value.items() for period in ("interval","total")]
+        self.table.setRowCount(len(rows))
+        self.table.setVerticalHeaderLabels([label for label,_ in rows])
+        for row,(_,summary) in enumerate(rows):
+            for column,key in enumerate(self.COLUMNS):
+                self.table.setItem(row,column,QTableWidgetItem(str(summary[key])))
+    
+    def export(self):
+        file,ok=QFileDialog.getSaveFileName(self,"Export Latency","latency.json","JSON (*.json)")
+        if ok and file:
+            self.exportLatency.emit(file)
+
+class RecentLog(QWidget):
+    """把内存里最近的日志事件(log_ring_level 以上)和各位置的计数写到文件"""
+    dumpLog=pyqtSignal(str)
+    def __init__(self):
+        super().__init__()
+        self.setupUi()
+    
+    def setupUi(self):
+        self.setLayout(QHBoxLayout())
+        self.dumpButton=PushButton("Dump Log")
+        self.dumpButton.clicked.connect(self.dump)
+        self.layout().addWidget(self.dumpButton)
+    
+    def dump(self):
+        file,ok=QFileDialog.getSaveFileName(self,"Dump Log","highway.log","Log (*.log *.txt)")
+        if ok and file:
+            self.dumpLog.emit(file)
+
 class SettingItem(QWidget):
     settingChanged=pyqtSignal(dict)
     def setupUi(self):
@@ -109,6 +192,12 @@ class Debug(ScrollArea):
         layout=QVBoxLayout()
         self.uploader=Uploader()
         layout.addWidget(self.uploader)
+        self.streamStats=StreamStats()
+        layout.addWidget(self.streamStats)
+        self.latencyStats=LatencyStats()
+        layout.addWidget(self.latencyStats)
+        self.recentLog=RecentLog()
+        layout.addWidget(self.recentLog)
         self.setting_list=[]
         self.settingItemMap=dict()
         for key,value in self.setting.items():
@@ -52,6 +52,14 @@ class MainWindow(FluentWindow):
         self.client.connection_error.connect(self.quic_client_connection_error)
         self.client.receive_video.connect(self.update_monitor)
         self.client.latency.connect(self.monitor.update_latency)
+        self.client.connection_timeline.connect(self.monitor.update_connection_timeline)
+        self.client.stream_stats.connect(self.monitor.update_stream_stats)
+        self.client.stream_stats.connect(self.debug.streamStats.updateStats)
+        self.client.latency_stats.connect(self.monitor.update_latency_stats)
+        self.client.latency_stats.connect(self.debug.latencyStats.updateStats)
+        self.client.control_stats.connect(self.monitor.update_control_stats)
+        self.debug.latencyStats.exportLatency.connect(self.client.export_latency)
+        self.debug.recentLog.dumpLog.connect(self.client.dump_log)
         self.client.input_wave_data.connect(self.monitor.update_wave_form)  
         
         # controller 发送控制消息
@@ -65,7 +73,8 @@ class MainWindow(FluentWindow):
         # self.client.start()
     def update_monitor(self):
         pixmap=self.client.decoder.get_frame()
-        self.monitor.setPixmap(pixmap)
+        if pixmap is not None:
+            self.monitor.setPixmap(pixmap)
     
     def load_setting(self):
         if os.path.exists("setting.json"):
@@ -28,10 +28,46 @@ class StatusBar(QWidget):
     def update_latency(self,value:int):
         self.signal.setText(f"{value} ms")
     
+    def update_connection_timeline(self,value:dict):
+        self.timeline_tooltip="\n".join(f"{name}: {ms} ms" for name,ms in value.items())
+        self.__update_signal_tooltip()
+    
+    def update_latency_stats(self,value:dict):
+        # 本周期的分位数，平均值会掩盖造成卡顿的尾部延迟
+        lines=[]
+        for name,stats in value.items():
+            interval=stats["interval"]
+            if interval["count"]:
+                lines.append(f"{name}: p50 {interval['p50']} p95 {interval['p95']} p99 {interval['p99']} max {interval['max']} ms")
+        self.latency_tooltip="\n".join(lines)
+        self.__update_signal_tooltip()
+    
+    def update_control_stats(self,value:dict):
+        # 被覆盖的是发送前就被更新值替换的控制消息，stale是收到的过期datagram
+        self.control_tooltip=f"control: sent {value['sent']}/{value['put']}, overwritten {value['overwritten']}, stale {value['stale']}"
+        self.__update_signal_tooltip()
+    
+    def __update_signal_tooltip(self):
+        self.signal.setToolTip("\n\n".join(text for text in (self.latency_tooltip,self.control_tooltip,self.timeline_tooltip) if text))
+    
+    def update_stream_stats(self,value:dict):
+        # 按占用的带宽排序，排队和drain耗时高的流就是堵住的流
+        upload=sorted(value.items(),key=lambda item:-item[1]["send_rate"])
+        self.upload.setToolTip("\n".join(
+            f"{name}: {stats['send_rate']/1024:.1f} kb/s, queue {stats['queue_bytes']/1024:.1f} kb, drain {stats['drain_ms']} ms"
+            for name,stats in upload))
+        download=sorted(value.items(),key=lambda item:-item[1]["receive_rate"])
+        self.download.setToolTip("\n".join(
+            f"{name}: {stats['receive_rate']/1024:.1f} kb/s, resync {stats['resyncs']}, crc {stats['crc_mismatches']}"
+            for name,stats in download))
+    
     def setupUi(self):
         layout=QHBoxLayout()
         layout.setAlignment(Qt.AlignmentFlag.AlignRight)
         self.signal=TransparentPushButton(FluentIcon.WIFI.icon(color=QColor("green")),"10 ms")
+        self.latency_tooltip=""
+        self.control_tooltip=""
+        self.timeline_tooltip=""
         self.upload=TransparentPushButton(FluentIcon.UP.icon(),"100 kb/s")
         self.download=TransparentPushButton(FluentIcon.DOWN.icon(),"99 kb/s")
         self.fps=TransparentPushButton(FluentIcon.VIDEO.icon(),"30 fps")
@@ -170,6 +206,18 @@ class Monitor(QWidget):
     def update_latency(self,value:int):
         self.statusBar.update_latency(value)
     
+    def update_connection_timeline(self,value:dict):
+        self.statusBar.update_connection_timeline(value)
+    
+    def update_latency_stats(self,value:dict):
+        self.statusBar.update_latency_stats(value)
+    
+    def update_stream_stats(self,value:dict):
+        self.statusBar.update_stream_stats(value)
+    
+    def update_control_stats(self,value:dict):
+        self.statusBar.update_control_stats(value)
+    
     def update_fps(self):
         self.statusBar.update_fps(self.fps)
         self.fps=0
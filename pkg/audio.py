@@ -3,16 +3,18 @@ import numpy as np
 import pyaudio
 import threading
 from pkg.codec import AsyncRingBuffer,BufferStream
+from pkg.log import get_logger,WARNING
 import time
 from contextlib import contextmanager
 import asyncio
+log=get_logger("audio")
 @contextmanager
 def measure_time(name):
     start_time = time.time()
     yield
     end_time = time.time()
     execution_time = end_time - start_time
-    print(f"{name} using {round(execution_time*1000):.4f} ms")
+    log.debug("%s using %.4f ms",name,execution_time*1000)
 
 class AudioEncoder:
     def __init__(self,format="g726",output=None,rate=8000,channels=1):
@@ -39,11 +41,11 @@ class AudioEncoder:
     async def __fps(self):
         try:
             while self.running:
-                print(f"audio encode fps:{self.fps}")
+                log.debug("audio encode fps: %d",self.fps)
                 self.fps=0
                 await asyncio.sleep(1)
         except asyncio.CancelledError:
-            print("__fps task cancelled")
+            log.debug("__fps task cancelled")
             # 可以做一些清理工作
             return
     def close(self):
@@ -79,7 +81,7 @@ class AudioEncoder:
         return data
     
     def read(self,n):
-        print("read called ",n)
+        log.every("read","read called %d",n)
         return None
 
     def __encode_frames(self):
@@ -105,7 +107,7 @@ class AudioEncoder:
         if self.output:
             self.outf=open(self.output,"wb")
 
-        print(f"start encode format:{self.format} rate:{self.rate} channels:{self.channels}")
+        log.info("start encode format: %s rate: %d channels: %d",self.format,self.rate,self.channels)
         self.fps_task=self.loop.create_task(self.__fps())
         while self.running:
             try:
@@ -126,7 +128,7 @@ class AudioEncoder:
                     self.out_buffer.write(bytes(packet))
                     
             except Exception as e:
-                print(f"Encoding error: {e}")
+                log.every("encode_error","Encoding error: %s",e,level=WARNING)
             
         
         self.audio_stream.stop_stream()
@@ -156,11 +158,11 @@ class AudioPlayer:
     async def __fps(self):
         try:
             while self.running:
-                print("audio decode fps:",self.fps)
+                log.debug("audio decode fps: %d",self.fps)
                 self.fps=0
                 await asyncio.sleep(1)
         except asyncio.CancelledError:
-            print("__fps task cancelled")
+            log.debug("__fps task cancelled")
             # 可以做一些清理工作
             return
     def close(self):
@@ -227,14 +229,14 @@ class AudioPlayer:
             # 等待有足够的数据来创建容器  
             self.container=av.open(self.stream,format=self.format,buffer_size=1024)
             stream=self.container.streams.audio[0]
-            print("stream ",stream.bit_rate,stream.sample_rate,stream.layout)
+            log.info("stream bit_rate: %s sample_rate: %s layout: %s",stream.bit_rate,stream.sample_rate,stream.layout)
 
             self.rate=self.container.streams.audio[0].rate
             self.channels=self.container.streams.audio[0].channels
-            print(f"Detected audio format: rate={self.rate}, channels={self.channels}")
+            log.info("Detected audio format: rate=%d, channels=%d",self.rate,self.channels)
             
             
-            print(f"start decode rate:{self.rate} layout:{self.container.streams.audio[0].layout}")
+            log.info("start decode rate: %d layout: %s",self.rate,self.container.streams.audio[0].layout)
             self.fps_task=self.loop.create_task(self.__fps())
             self.play_task=self.loop.create_task(self.__play())
             while self.running:
@@ -270,19 +272,19 @@ class AudioPlayer:
                                 pcm = pcm.T  # 转为interleaved
                             self.pcm_buffer.write(pcm.tobytes())
                         else:
-                            print(f"Unsupported audio format: {frame.format.name}")
+                            log.every("unsupported_format","Unsupported audio format: %s",frame.format.name,level=WARNING)
                 except asyncio.CancelledError:
-                    print("decode frames canceled")
+                    log.info("decode frames canceled")
                     return 
                 except av.error.EOFError:
-                    print("End of audio stream")
+                    log.info("End of audio stream")
                     break
                 except Exception as e:
-                    print(f"Decode frame error: {e}")
+                    log.every("decode_error","Decode frame error: %s",e,level=WARNING)
                     time.sleep(0.1)  # 短暂暂停避免忙等待
                     
         except Exception as e:
-            print(f"Decode initialization error: {e}")
+            log.exception("Decode initialization error: %s",e)
         finally:
             if hasattr(self, 'audio_stream'):
                 self.audio_stream.stop_stream()
@@ -314,9 +316,9 @@ def test_async_encoder_decoder():
         encoder=AsyncAudioEncoder(format="mp3")
         player=AsyncAudioPlayer(format="mp3")
         while True:
-            print("read data")
+            log.debug("read data")
             data=await encoder.read_frame()
-            print("write data",len(data))
+            log.debug("write data %d",len(data))
             await player.write(data)
             await asyncio.sleep(0.01)
     asyncio.run(test())
@@ -330,14 +332,14 @@ def test_encoder_decoder():
     # 给播放器一些时间来初始化
     time.sleep(1)
     
-    print("Starting encoder-decoder test...")
+    log.info("Starting encoder-decoder test...")
     
     try:
         frame_count = 0
         while True:
             data=encoder.read_frame()
             if len(data)==0:
-                print("No data available, waiting...")
+                log.every("no_data","No data available, waiting...")
                 time.sleep(0.05)  # 等待50ms让编码器产生数据
                 continue
                 
@@ -346,16 +348,18 @@ def test_encoder_decoder():
             player.write(data)
             
     except KeyboardInterrupt:
-        print("Test interrupted by user")
+        log.info("Test interrupted by user")
     except Exception as e:
-        print(f"Test error: {e}")
+        log.exception("Test error: %s",e)
     finally:
-        print("Closing encoder and player...")
+        log.info("Closing encoder and player...")
         encoder.close()
         player.close()
 
 
 if __name__=="__main__":
+    from pkg.log import configure
+    configure("debug")
     # test_encoder()
     # analyze_mp3_pcm_format()
     # test_decoder()
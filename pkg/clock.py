@@ -0,0 +1,221 @@
+import struct
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+# 带 FLAG_TIMESYNC 的控制帧: [类型, 发起方device_id, 目标device_id, t1, t2, t3]
+# 时间都是 time.time() 的微秒，t1 发起方发送时间，t2/t3 应答方收到和发出的时间
+TIMESYNC_FORMAT = struct.Struct("<BIIqqq")
+TIMESYNC_REQUEST = 1
+TIMESYNC_RESPONSE = 2
+# 开始时连续探测几次尽快得到估计，之后按 TIMESYNC_INTERVAL 持续探测
+TIMESYNC_BURST = 5
+TIMESYNC_BURST_INTERVAL = 0.2
+TIMESYNC_INTERVAL = 2.0
+# 连续这么多次探测没有应答(对端不支持或不在线)后间隔按指数增加，最长 TIMESYNC_MAX_INTERVAL 秒，
+# 收到应答后恢复正常间隔
+TIMESYNC_MAX_UNANSWERED = 5
+TIMESYNC_MAX_INTERVAL = 60.0
+# 保留的样本数，超出窗口的旧样本(和旧的最小RTT)被淘汰，路由变化后能重新收敛
+SAMPLE_WINDOW = 64
+# 样本跨度超过这个秒数才估计漂移
+DRIFT_MIN_SPAN = 10.0
+
+
+def now_us() -> int:
+    return int(time.time() * 1_000_000)
+
+
+def timesync_interval(sent: int, unanswered: int) -> float:
+    """已经发出 sent 次探测、其中最近连续 unanswered 次没有应答时，到下一次探测的秒数"""
+    if unanswered >= TIMESYNC_MAX_UNANSWERED:
+        # 先限制指数，长时间不应答时 2**n 不会溢出
+        exponent = min(unanswered - TIMESYNC_MAX_UNANSWERED + 1, 16)
+        return min(TIMESYNC_INTERVAL * 2 ** exponent, TIMESYNC_MAX_INTERVAL)
+    return TIMESYNC_BURST_INTERVAL if sent < TIMESYNC_BURST else TIMESYNC_INTERVAL
+
+
+class TimeSync(NamedTuple):
+    kind: int
+    source_id: int
+    target_id: int
+    t1: int
+    t2: int = 0
+    t3: int = 0
+
+
+def encode_timesync(message: TimeSync) -> bytes:
+    return TIMESYNC_FORMAT.pack(*message)
+
+
+def decode_timesync(data) -> Optional[TimeSync]:
+    if len(data) != TIMESYNC_FORMAT.size:
+        return None
+    message = TimeSync(*TIMESYNC_FORMAT.unpack(data))
+    if message.kind not in (TIMESYNC_REQUEST, TIMESYNC_RESPONSE):
+        return None
+    return message
+
+
+def timesync_request(source_id, target_id, now=None) -> TimeSync:
+    return TimeSync(TIMESYNC_REQUEST, source_id, target_id, now_us() if now is None else now)
+
+
+def timesync_response(request: TimeSync, received, now=None) -> TimeSync:
+    """received 是收到请求的时间，发出前再取一次时间作为t3"""
+    return TimeSync(TIMESYNC_RESPONSE, request.target_id, request.source_id, request.t1, received,
+                    now_us() if now is None else now)
+
+
+class ClockSample(NamedTuple):
+    local: float
+    offset: float
+    rtt: float
+
+
+class ClockEstimator:
+    """NTP式的时钟偏差估计，单位毫秒
+
+    每次请求-应答得到 offset=((t2-t1)+(t3-t4))/2 和 rtt=(t4-t1)-(t3-t2)，
+    排队造成的路径不对称会让偏差估计最多错 rtt/2，所以只使用窗口内RTT接近最小值的样本；
+    样本跨度足够时对这些样本的 offset 按本地时间做最小二乘，得到漂移(ppm)。
+    offset 是 对端时钟 - 本地时钟。
+    """
+
+    def __init__(self, window=SAMPLE_WINDOW, rtt_tolerance=1.0, drift_min_span=DRIFT_MIN_SPAN):
+        self.samples = deque(maxlen=window)
+        self.rtt_tolerance = rtt_tolerance
+        self.drift_min_span = drift_min_span
+        self.base_local = 0.0
+        self.base_offset = 0.0
+        self.drift = 0.0
+        self.min_rtt = None
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.samples)
+
+    def update(self, t1, t2, t3, t4) -> ClockSample:
+        """四个时间戳(微秒)，返回这一次的样本"""
+        rtt = ((t4 - t1) - (t3 - t2)) / 1000
+        offset = ((t2 - t1) + (t3 - t4)) / 2000
+        sample = ClockSample((t1 + t4) / 2000, offset, max(rtt, 0.0))
+        self.samples.append(sample)
+        self.__estimate()
+        return sample
+
+    def __estimate(self):
+        self.min_rtt = min(sample.rtt for sample in self.samples)
+        # RTT接近最小值的样本，允许 rtt_tolerance 毫秒或最小RTT的25%的抖动
+        limit = self.min_rtt + max(self.rtt_tolerance, self.min_rtt * 0.25)
+        best = [sample for sample in self.samples if sample.rtt <= limit]
+        span = best[-1].local - best[0].local
+        if len(best) >= 3 and span >= self.drift_min_span * 1000:
+            mean_local = sum(sample.local for sample in best) / len(best)
+            mean_offset = sum(sample.offset for sample in best) / len(best)
+            variance = sum((sample.local - mean_local) ** 2 for sample in best)
+            self.drift = sum((sample.local - mean_local) * (sample.offset - mean_offset) for sample in best) / variance
+            self.base_local = mean_local
+            self.base_offset = mean_offset
+        else:
+            # 跨度不够时只用RTT最小的一个样本
+            sample = min(best, key=lambda sample: sample.rtt)
+            self.drift = 0.0
+            self.base_local = sample.local
+            self.base_offset = sample.offset
+
+    def offset(self, local_ms=None) -> float:
+        """local_ms 时刻(本地 time.time() 毫秒)对端时钟比本地快多少毫秒，没有样本时为0"""
+        if not self.samples:
+            return 0.0
+        local_ms = time.time() * 1000 if local_ms is None else local_ms
+        return self.base_offset + self.drift * (local_ms - self.base_local)
+
+    def to_local(self, remote_ms, local_ms=None) -> float:
+        """对端时钟的时间戳(毫秒)换算成本地时钟"""
+        return remote_ms - self.offset(remote_ms if local_ms is None else local_ms)
+
+    def latency(self, remote_ms, local_ms=None) -> float:
+        """对端 remote_ms 发出、本地 local_ms 收到的单向延迟(毫秒)"""
+        local_ms = time.time() * 1000 if local_ms is None else local_ms
+        return local_ms - remote_ms + self.offset(local_ms)
+
+    def stats(self, local_ms=None) -> dict:
+        """local_ms 时刻的估计，默认是最后一个样本的时间"""
+        if local_ms is None and self.samples:
+            local_ms = self.samples[-1].local
+        return {
+            "offset_ms": round(self.offset(local_ms), 2),
+            "drift_ppm": round(self.drift * 1e6, 2),
+            "min_rtt_ms": round(self.min_rtt, 2) if self.min_rtt is not None else None,
+            "samples": len(self.samples),
+        }
+
+
+def test_clock_estimator(seconds=300, offset=1234.5, drift_ppm=80.0, seed=0):
+    """模拟一个有固定偏差和漂移的对端时钟，链路延迟带随机排队和不对称的突发，
+    检查估计出的偏差和漂移，以及修正后的单向延迟"""
+    import random
+
+    rnd = random.Random(seed)
+    start = 1_700_000_000_000.0
+
+    def remote_clock(true_ms):
+        return true_ms + offset + (true_ms - start) * drift_ppm / 1e6
+
+    def path_delay():
+        # 基础延迟20ms，经常有几毫秒排队，偶尔有上百毫秒的突发
+        delay = 20 + rnd.expovariate(1 / 3)
+        if rnd.random() < 0.1:
+            delay += rnd.uniform(50, 300)
+        return delay
+
+    estimator = ClockEstimator()
+    now = start
+    errors = []
+    while now < start + seconds * 1000:
+        t1 = now
+        arrive = t1 + path_delay()
+        t2 = remote_clock(arrive)
+        depart = arrive + rnd.uniform(0.05, 2)
+        t3 = remote_clock(depart)
+        t4 = depart + path_delay()
+        request = timesync_request(1, 2, int(t1 * 1000))
+        response = decode_timesync(encode_timesync(timesync_response(request, int(t2 * 1000), int(t3 * 1000))))
+        estimator.update(response.t1, response.t2, response.t3, int(t4 * 1000))
+        # 对端发出的视频帧，真实单向延迟是 30ms
+        send = t4 + 1
+        latency = estimator.latency(remote_clock(send), send + 30)
+        if now - start > 30_000:
+            errors.append(abs(latency - 30))
+        now += TIMESYNC_INTERVAL * 1000
+    stats = estimator.stats(now)
+    print(f"true offset {offset}ms drift {drift_ppm}ppm, estimated {stats}, "
+          f"latency error max {max(errors):.2f}ms avg {sum(errors) / len(errors):.2f}ms")
+    true_offset = offset + (now - start) * drift_ppm / 1e6
+    assert abs(estimator.offset(now) - true_offset) < 2, "offset not converged"
+    assert abs(estimator.drift * 1e6 - drift_ppm) < 20, "drift not estimated"
+    assert max(errors) < 3, "corrected latency off by more than 3ms"
+    assert abs(stats["offset_ms"] - true_offset) < 2
+
+
+def test_timesync_backoff(hours=1.0):
+    """对端从不应答时探测间隔退避，一小时内的探测数有上限；收到应答后恢复正常间隔"""
+    sent = unanswered = 0
+    elapsed = 0.0
+    while elapsed < hours * 3600:
+        sent += 1
+        unanswered += 1
+        elapsed += timesync_interval(sent, unanswered)
+    print(f"unanswered peer: {sent} probes in {hours}h, interval now {timesync_interval(sent, unanswered)}s")
+    assert sent <= TIMESYNC_MAX_UNANSWERED + 10 + hours * 3600 / TIMESYNC_MAX_INTERVAL
+    assert timesync_interval(sent, 0) == TIMESYNC_INTERVAL
+    assert timesync_interval(1, 1) == TIMESYNC_BURST_INTERVAL
+    # 几天不应答
+    for unanswered in (1030, 10 ** 6, 10 ** 9):
+        assert timesync_interval(unanswered, unanswered) == TIMESYNC_MAX_INTERVAL
+
+
+if __name__ == "__main__":
+    test_clock_estimator()
+    test_timesync_backoff()
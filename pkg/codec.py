@@ -7,11 +7,40 @@ import threading
 from collections import deque
 import time
 import io
-from queue import Queue
 from PyQt5.QtGui import QImage, QPixmap
 import asyncio
+from fractions import Fraction
 from concurrent.futures import ThreadPoolExecutor
+from av.codec.context import Flags
+from pkg.log import get_logger,WARNING
+from pkg.mailbox import LatestFrameMailbox
+from pkg.ratecontrol import EncoderReconfig,VideoTarget,KEEP,SET_BITRATE,REOPEN
+log=get_logger("codec")
 executor = ThreadPoolExecutor(max_workers=1)
+
+# setting.json 里 "decode_thread_type" 的取值
+# 帧级多线程每多一个线程输出就多延迟一帧，low_latency 只用slice线程并打开 LOW_DELAY
+DECODE_LOW_LATENCY="low_latency"
+DECODE_THREAD_TYPES={
+    DECODE_LOW_LATENCY:"SLICE",
+    "slice":"SLICE",
+    "frame":"FRAME",
+    "auto":"AUTO",
+    "none":"NONE",
+}
+
+def configure_decoder_threads(codec_context,thread_type=DECODE_LOW_LATENCY,threads=0):
+    """设置解码线程，必须在第一次decode(打开解码器)之前调用
+
+    threads=0 时由libavcodec按CPU核数决定；slice线程只对一帧有多个slice的码流有效。
+    """
+    if thread_type not in DECODE_THREAD_TYPES:
+        log.warning("unknown decode thread type %r, using %s",thread_type,DECODE_LOW_LATENCY)
+        thread_type=DECODE_LOW_LATENCY
+    codec_context.thread_type=DECODE_THREAD_TYPES[thread_type]
+    codec_context.thread_count=threads
+    if thread_type==DECODE_LOW_LATENCY:
+        codec_context.flags|=Flags.low_delay
 # TODO 实现一个异步的buffer 优化性能
 class AsyncRingBuffer:
     def __init__(self, maxSize=0, blocked=True, timeout=None):
@@ -64,7 +93,7 @@ class AsyncRingBuffer:
         with self.sync_lock:
             if self.buffer:
                 data = self.buffer.popleft()
-                print("sync read", n, "res:", len(data))
+                log.every("sync_read","sync read %d res: %d",n,len(data))
                 return data
         return b''
     
@@ -78,7 +107,7 @@ class AsyncRingBuffer:
         if not data:
             return
             
-        print("async write", len(data))
+        log.every("async_write","async write %d",len(data))
         self._ensure_async_primitives()
         
         # 同时更新同步和异步缓冲区
@@ -88,7 +117,7 @@ class AsyncRingBuffer:
             
             # 处理最大大小限制
             if self.maxSize > 0 and current_size > self.maxSize:
-                print("fifo full, dropping oldest data")
+                log.every("fifo_full","fifo full, dropping oldest data",level=WARNING)
                 self.buffer.popleft()
             else:
                 # 释放同步信号量
@@ -97,7 +126,7 @@ class AsyncRingBuffer:
                 if self._async_semaphore:
                     self._async_semaphore.release()
         
-        print("async write ok")
+        log.every("async_write_ok","async write ok")
                 
     async def read_single(self):
         """异步读取单个数据"""
@@ -108,13 +137,13 @@ class AsyncRingBuffer:
         if not data:
             return
             
-        print("sync write", len(data))
+        log.every("sync_write","sync write %d",len(data))
         with self.sync_lock:
             self.buffer.append(data)
             current_size = len(self.buffer)
             
             if self.maxSize > 0 and current_size > self.maxSize:
-                print("fifo full, dropping oldest data")
+                log.every("fifo_full","fifo full, dropping oldest data",level=WARNING)
                 self.buffer.popleft()
             else:
                 self.sync_semaphore.release()
@@ -139,6 +168,8 @@ class BufferStream:
         self.running = True
         self.lock = threading.Lock()  # Add a lock for buffer operations
         self.buffer_size=0
+        # read(n) 没读完的一块，只在读线程里使用
+        self.pending=None
 
 
     def size(self):
@@ -161,7 +192,7 @@ class BufferStream:
             self.buffer.append(data)
             self.buffer_size+=1
             if self.maxSize>0 and self.buffer_size>self.maxSize:
-                print("fifo full")
+                log.every("stream_full","fifo full, dropping oldest data",level=WARNING)
                 self.buffer.popleft()
                 self.buffer_size-=1
             else:
@@ -195,8 +226,15 @@ class BufferStream:
     #     return data[:n]
 
     def read(self, n):
-        
-        return self.__read()
+        # av.open 的读回调: 返回超过 n 字节会写出PyAV的缓冲区，多余的留到下一次
+        data = self.pending if self.pending is not None else self.__read()
+        self.pending = None
+        if len(data) > n:
+            data = memoryview(data)
+            self.pending = data[n:]
+            data = data[:n]
+        # av.open 只接受bytes，memoryview在解码线程里再拷贝
+        return data if isinstance(data, bytes) else bytes(data)
     
     def write(self, data):
         self.__write(data)
@@ -247,57 +285,121 @@ class HighBuffer:
             self.write_count+=1
             self.write_latency+=time.time()-start_time
 
+# setting.json 里 "decode_mode" 的取值
+# container: av.open 在 BufferStream 上探测格式后解复用；packet: Video.raw 直接交给解码器上下文解析和解码
+DECODE_CONTAINER="container"
+DECODE_PACKET="packet"
+
+class PacketDecoder:
+    """不经过容器和探测，直接用 CodecContext.parse()/decode() 解码收到的数据
+
+    解析器要看到下一个访问单元的起始码才输出当前的，已知数据是完整的访问单元时冲刷解析器，
+    解码器 LOW_DELAY，每个访问单元到达后立即输出这一帧。
+    """
+    def __init__(self,format='h264',threads=0,thread_type=DECODE_LOW_LATENCY):
+        self.codec=av.CodecContext.create(format,'r')
+        configure_decoder_threads(self.codec,thread_type,threads)
+        self.codec.flags|=Flags.low_delay
+
+    def decode(self,data,end_of_au=False)->list:
+        packets=self.codec.parse(data)
+        if end_of_au:
+            packets+=self.codec.parse(None)
+        return [frame for packet in packets for frame in self.codec.decode(packet)]
+
 class H264Decoder(QObject):
     frame_decoded = pyqtSignal()
-    def __init__(self,format='h264'):
+    def __init__(self,format='h264',threads=0,thread_type=DECODE_LOW_LATENCY,mode=DECODE_CONTAINER):
         super().__init__()
+        self.threads=threads
+        self.thread_type=thread_type
+        if mode not in (DECODE_CONTAINER,DECODE_PACKET):
+            log.warning("unknown decode mode %r, using %s",mode,DECODE_CONTAINER)
+            mode=DECODE_CONTAINER
+        self.mode=mode
         self.stream=BufferStream()
-        self.frames=Queue()
+        # 只保留最新解码的一帧，界面跟不上时旧帧直接被替换
+        self.frames=LatestFrameMailbox()
         self.lock=threading.Lock()
         self.format=format
-        self.decode_thread = threading.Thread(target=self.__decode_frames,daemon=True)
-        self.decode_thread.start()
         self.has_data = False
         self.running = True
+        target=self.__decode_packets if mode==DECODE_PACKET else self.__decode_frames
+        self.decode_thread = threading.Thread(target=target,daemon=True)
+        self.decode_thread.start()
 
     def close(self):
         self.running = False
         self.stream.close()
         self.decode_thread.join()
 
-    def write(self, data):
+    def write(self, data, end_of_au=False):
+        """end_of_au: data 以一个完整的访问单元结束(v2帧的 FLAG_END_OF_AU)，packet模式下立即解码"""
         if len(data)==0:
             return
-        self.stream.write(data)
+        if self.mode==DECODE_PACKET:
+            self.stream.write((data,end_of_au))
+        else:
+            self.stream.write(data)
 
     def get_frame(self):
-        return self.frames.get()
+        """界面线程调用，不阻塞，没有新帧时返回None"""
+        return self.frames.get_nowait()
+
+    def display_stats(self)->dict:
+        return self.frames.stats()
     
     def change_format(self,format):
         with self.lock:
             self.format=format
+            if self.mode==DECODE_PACKET:
+                self.decoder=PacketDecoder(self.format,self.threads,self.thread_type)
+                return
             self.container.close()
-            self.container = av.open(self.stream,format=self.format)
-            
-        
+            self.__open_container()
 
-    def __decode_frames(self):
+    def __open_container(self):
         self.container = av.open(self.stream,format=self.format)
-        print("start decode")
+        configure_decoder_threads(self.container.streams.video[0].codec_context,self.thread_type,self.threads)
+
+    def __show(self,frame):
+        image=frame.to_ndarray(format='rgb24')
+        height, width, _ = image.shape
+        bytes_per_line = 3 * width
+        q_img = QImage(image.data, width, height, bytes_per_line, QImage.Format_RGB888)
+        # Convert QImage to QPixmap
+        pixmap = QPixmap.fromImage(q_img)
+        # 邮箱原来为空时才通知界面，界面忙时信号不会在Qt事件队列里堆积
+        if self.frames.put(pixmap):
+            self.frame_decoded.emit()
+
+    def __decode_packets(self):
+        self.decoder=PacketDecoder(self.format,self.threads,self.thread_type)
+        log.info("start packet decode %s threads: %d type: %s",self.format,self.threads,self.thread_type)
+        while self.running:
+            item=self.stream.readSingle()
+            if not item:
+                continue
+            data,end_of_au=item
+            try:
+                with self.lock:
+                    for frame in self.decoder.decode(data,end_of_au):
+                        self.__show(frame)
+            except av.error.FFmpegError as e:
+                # 丢包或从非关键帧开始时解码出错，等下一个关键帧
+                log.every("packet_decode_error","packet decode error: %s",e,level=WARNING)
+        log.info("decode thread exit")
+
+    def __decode_frames(self):
+        self.__open_container()
+        log.info("start decode %s threads: %d type: %s",self.format,self.threads,self.thread_type)
         while self.running:
             try:
                 with self.lock:
                     for frame in self.container.decode(video=0):
-                        image=frame.to_ndarray(format='rgb24')
-                        height, width, _ = image.shape
-                        bytes_per_line = 3 * width
-                        q_img = QImage(image.data, width, height, bytes_per_line, QImage.Format_RGB888)
-                        # Convert QImage to QPixmap
-                        pixmap = QPixmap.fromImage(q_img)
-                        self.frames.put(pixmap)
-                        self.frame_decoded.emit()
+                        self.__show(frame)
                         if not self.running:
-                            print("decode thread exit")
+                            log.info("decode thread exit")
                             return
             except Exception as e:
                 pass
@@ -306,10 +408,14 @@ class H264Decoder(QObject):
         
 class H264Encoder(QObject):
     frame_encoded = pyqtSignal()
-    def __init__(self):
+    def __init__(self,bitrate=1_000_000):
         super().__init__()
         self.buffer=BufferStream()
         self.running = True
+        # 目标码率/分辨率缩放/帧率除数，由码率控制在其他线程修改，编码线程在下一帧应用
+        self.target_lock=threading.Lock()
+        # 决定目标码率是直接修改还是重新打开编码器，reconfig.target 是当前应用的目标
+        self.reconfig=EncoderReconfig(bitrate)
         
         self.encode_thread = threading.Thread(target=self.__encode_frames,daemon=True)
     def start(self):
@@ -321,48 +427,99 @@ class H264Encoder(QObject):
         if self.encode_thread.is_alive():
             self.encode_thread.join()
         
-    def write(self,data):
-        self.buffer.write(data)
+    def write(self,data,keyframe=False):
+        # 每次写入一个完整的访问单元
+        self.buffer.write((data,keyframe))
         self.frame_encoded.emit()
     
+    def set_target(self,bitrate,scale=1.0,fps_divisor=1):
+        """可在任意线程调用，码率在打开时的上限以内直接修改，分辨率/帧率变化才重新打开编码器(有最小间隔)，
+        返回目标是否有变化"""
+        with self.target_lock:
+            return self.reconfig.update(VideoTarget(int(bitrate),scale,max(1,int(fps_divisor))))!=KEEP
+
+    def reconfig_stats(self):
+        with self.target_lock:
+            return self.reconfig.stats()
+
+    def queue_size(self):
+        return self.buffer.size()
+
     def read_frame(self):
-        return self.buffer.readSingle()
+        """返回 (访问单元数据, 是否关键帧)"""
+        packet=self.buffer.readSingle()
+        if not packet:
+            return bytes(),False
+        return packet
     
     
+    @staticmethod
+    def __open_codec(width,height,fps,bitrate,ceiling,scale):
+        # 直接使用编码器上下文，每个packet就是一个完整的访问单元(Annex B)
+        codec = av.CodecContext.create('h264', 'w')
+        # yuv420p要求宽高为偶数
+        codec.width = int(width*scale)//2*2
+        codec.height = int(height*scale)//2*2
+        codec.pix_fmt = 'yuv420p'
+        codec.time_base = Fraction(1, fps)
+        codec.framerate = fps
+        codec.gop_size=30
+        # libx264 只有 bit_rate==maxrate 打开时才接受运行中修改码率，且不能超过打开时的 maxrate，
+        # 所以按上限打开，再把码率设为目标
+        codec.bit_rate=ceiling
+        # zerolatency 关闭lookahead和B帧；限制峰值码率和VBV缓冲，关键帧也不会一次把发送队列撑大
+        codec.options={"tune":"zerolatency","maxrate":str(ceiling),"bufsize":str(bitrate//2)}
+        codec.open()
+        codec.bit_rate=bitrate
+        return codec
+
     def __encode_frames(self):
         
         while self.running:
-            print("start encode")
+            log.info("start encode")
             cap = cv2.VideoCapture(0)
             if not cap.isOpened():
-                print("无法打开摄像头")
+                log.error("无法打开摄像头")
                 return
 
             # 获取视频属性
             width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps = int(cap.get(cv2.CAP_PROP_FPS))
-            print("width:",width,"height:",height,"fps:",fps)
-
-            # 创建输出容器
-            output_container = av.open(self, 'w',format='h264')
-            stream = output_container.add_stream('h264', rate=fps)
-            stream.width = width
-            stream.height = height
-            stream.pix_fmt = 'yuv420p'
-            stream.gop_size=30
+            fps = int(cap.get(cv2.CAP_PROP_FPS)) or 30
+            log.info("width: %d height: %d fps: %d",width,height,fps)
+
+            codec=None
+            frame_index=0
             # def read_frame():
             while self.running:
                 ret, frame = cap.read()
                 if not ret:
-                    print("无法读取视频帧")
+                    log.warning("无法读取视频帧")
                     break
+                frame_index+=1
+                with self.target_lock:
+                    # 降帧率时直接丢弃采集到的帧(pts仍按采集帧率计算)，待执行的动作留给下一个编码的帧
+                    action=self.reconfig.next_frame(frame_index,codec is not None)
+                    target,ceiling=self.reconfig.target,self.reconfig.ceiling
+                if action is None:
+                    continue
+                bitrate,scale,fps_divisor=target
+                if action==REOPEN:
+                    # 分辨率只能在打开编码器前设置，重建后从关键帧开始
+                    codec=self.__open_codec(width,height,fps,bitrate,ceiling,scale)
+                    log.info("encoder reopen bitrate: %d ceiling: %d size: %dx%d fps: %g",bitrate,ceiling,codec.width,codec.height,fps/fps_divisor)
+                elif action==SET_BITRATE:
+                    # 下一帧生效，不产生关键帧
+                    codec.bit_rate=bitrate
+                    log.debug("encoder target bitrate: %d",bitrate)
+                if scale!=1.0:
+                    frame=cv2.resize(frame,(codec.width,codec.height),interpolation=cv2.INTER_AREA)
                 # 创建 PyAV 视频帧
                 video_frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
-                video_frame.pts = int((1 / fps) * av.time_base)
-                # 编码并写入输出文件
-                for packet in stream.encode(video_frame):
-                    output_container.mux(packet)
+                video_frame.pts = frame_index
+                for packet in codec.encode(video_frame):
+                    self.write(bytes(packet),packet.is_keyframe)
+            cap.release()
 
 
 
@@ -371,7 +528,7 @@ def main():
     # 初始化摄像头
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
-        print("无法打开摄像头")
+        log.error("无法打开摄像头")
         return
 
     # 获取视频属性
@@ -386,11 +543,11 @@ def main():
     stream.height = height
     stream.pix_fmt = 'yuv420p'
 
-    print("开始采集并编码视频...")
+    log.info("开始采集并编码视频...")
     while True:
         ret, frame = cap.read()
         if not ret:
-            print("无法读取视频帧")
+            log.warning("无法读取视频帧")
             break
 
         # 将 OpenCV 的 BGR 格式转换为 RGB
@@ -417,7 +574,7 @@ def main():
     # 释放资源
     cap.release()
     cv2.destroyAllWindows()
-    print("视频采集和编码完成，保存为 output.h264")
+    log.info("视频采集和编码完成，保存为 output.h264")
 
 
 def test_encode_decode():
@@ -425,7 +582,7 @@ def test_encode_decode():
     # 初始化摄像头
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
-        print("无法打开摄像头")
+        log.error("无法打开摄像头")
         return
 
     # 获取视频属性
@@ -441,11 +598,11 @@ def test_encode_decode():
     stream.pix_fmt = 'yuv420p'
 
     def read_frame():
-        print("开始采集并编码视频...")
+        log.info("开始采集并编码视频...")
         while True:
             ret, frame = cap.read()
             if not ret:
-                print("无法读取视频帧")
+                log.warning("无法读取视频帧")
                 break
 
             # 将 OpenCV 的 BGR 格式转换为 RGB
@@ -472,7 +629,7 @@ def test_encode_decode():
                     img = frame.to_ndarray(format='bgr24')
                     cv2.imshow('Frame', img)
                     if cv2.waitKey(1) & 0xFF == ord('q'):
-                        print("decode exit")
+                        log.info("decode exit")
                         return
 
     decode_h264_stream(buffer)
@@ -504,26 +661,151 @@ def buffer_benchmark():
     
     total_mb = iterations * (len(test_data) / (1024 * 1024))
     
-    print(f"写入 {total_mb:.2f}MB 数据:")
-    print(f"总时间: {write_time:.4f}秒")
-    print(f"平均速度: {total_mb/write_time:.2f}MB/s")
-    print(f"每次写入平均延迟: {write_time/iterations*1000:.2f}ms")
+    log.info(f"写入 {total_mb:.2f}MB 数据:")
+    log.info(f"总时间: {write_time:.4f}秒")
+    log.info(f"平均速度: {total_mb/write_time:.2f}MB/s")
+    log.info(f"每次写入平均延迟: {write_time/iterations*1000:.2f}ms")
     
-    print(f"\n读取 {total_mb:.2f}MB 数据:")
-    print(f"总时间: {read_time:.4f}秒") 
-    print(f"平均速度: {total_mb/read_time:.2f}MB/s")
-    print(f"每次读取平均延迟: {read_time/iterations*1000:.2f}ms")
+    log.info(f"读取 {total_mb:.2f}MB 数据:")
+    log.info(f"总时间: {read_time:.4f}秒") 
+    log.info(f"平均速度: {total_mb/read_time:.2f}MB/s")
+    log.info(f"每次读取平均延迟: {read_time/iterations*1000:.2f}ms")
 
 def test_high_buffer():
     buffer=HighBuffer()
     buffer.write(b'1234567890')
     buffer.write(b'1234567890')
-    print(buffer.read(20))
-    print(buffer.read(5))
+    log.info("%r",buffer.read(20))
+    log.info("%r",buffer.read(5))
+
+# 基准测试用的编码器，tune=zerolatency 不产生B帧，解码延迟只来自解码线程
+BENCHMARK_ENCODERS={"h264":"libx264","hevc":"libx265"}
+
+def benchmark_clip(codec_name='h264',width=1920,height=1080,frames=120,fps=30,slices=8):
+    """编码一段运动的测试画面，返回每个访问单元的数据；每帧分成 slices 个slice，slice线程才有并行的余地"""
+    encoder=av.CodecContext.create(BENCHMARK_ENCODERS.get(codec_name,codec_name),'w')
+    encoder.width=width
+    encoder.height=height
+    encoder.pix_fmt='yuv420p'
+    encoder.time_base=Fraction(1,fps)
+    encoder.framerate=fps
+    encoder.gop_size=fps
+    encoder.bit_rate=8_000_000
+    if codec_name=='hevc':
+        encoder.options={"tune":"zerolatency","x265-params":f"slices={slices}:log-level=error"}
+    else:
+        encoder.options={"tune":"zerolatency","slices":str(slices)}
+    rnd=np.random.default_rng(0)
+    noise=rnd.integers(0,32,(height,width,3),dtype=np.uint8)
+    x=np.arange(width,dtype=np.uint16)
+    y=np.arange(height,dtype=np.uint16)[:,None]
+    packets=[]
+    for i in range(frames):
+        image=np.empty((height,width,3),dtype=np.uint8)
+        image[...,0]=(x+i*8)&0xff
+        image[...,1]=(y+i*4)&0xff
+        image[...,2]=(x//4+y//4+i)&0xff
+        image+=np.roll(noise,i*16,axis=1)
+        frame=av.VideoFrame.from_ndarray(image,format='rgb24')
+        frame.pts=i
+        packets+=[bytes(packet) for packet in encoder.encode(frame)]
+    packets+=[bytes(packet) for packet in encoder.encode(None)]
+    return packets
+
+def decode_clip(codec_name,packets,thread_type=DECODE_LOW_LATENCY,threads=0,fps=None):
+    """逐个访问单元解码，返回 (解码帧率, 每帧从送入到输出的延迟(秒), 最多积压的访问单元数)
+
+    fps 不为空时按实时帧率送入，延迟才是接收端实际增加的延迟；为空时尽快送入，测吞吐量。
+    """
+    decoder=av.CodecContext.create(codec_name,'r')
+    configure_decoder_threads(decoder,thread_type,threads)
+    sent=[]
+    latencies=[]
+    backlog=0
+    start=time.perf_counter()
+    for i,data in enumerate(packets):
+        if fps:
+            delay=start+i/fps-time.perf_counter()
+            if delay>0:
+                time.sleep(delay)
+        sent.append(time.perf_counter())
+        for _ in decoder.decode(av.Packet(data)):
+            latencies.append(time.perf_counter()-sent[len(latencies)])
+        backlog=max(backlog,len(sent)-len(latencies))
+    for _ in decoder.decode(None):
+        latencies.append(time.perf_counter()-sent[len(latencies)])
+    elapsed=time.perf_counter()-start
+    return len(latencies)/elapsed,latencies,backlog
+
+def decode_benchmark(codecs=('h264','hevc'),width=1920,height=1080,frames=120,fps=30,
+                     thread_types=(DECODE_LOW_LATENCY,'frame','auto'),thread_counts=(1,2,4,8)):
+    """每种线程设置的解码吞吐量(尽快送入)和按实时帧率送入时每帧增加的延迟
+
+    frame/auto 每多一个线程输出就多积压一帧，low_latency 的延迟应该随线程数下降。
+    """
+    for codec_name in codecs:
+        packets=benchmark_clip(codec_name,width,height,frames,fps,slices=max(thread_counts))
+        log.info("%s %dx%d %d frames %.1f Mbit/s",codec_name,width,height,len(packets),
+                 sum(len(data) for data in packets)*8*fps/len(packets)/1e6)
+        for thread_type in thread_types:
+            for threads in thread_counts:
+                throughput,_,_=decode_clip(codec_name,packets,thread_type,threads)
+                _,latencies,backlog=decode_clip(codec_name,packets,thread_type,threads,fps)
+                latencies.sort()
+                log.info("%s %-11s threads %d: %6.1f fps, latency p50 %.2fms p99 %.2fms, max backlog %d frames",
+                         codec_name,thread_type,threads,throughput,latencies[len(latencies)//2]*1000,
+                         latencies[int(len(latencies)*0.99)]*1000,backlog)
+
+def decode_mode_benchmark(codec_name='h264',width=1280,height=720,frames=150,fps=30,threads=0,thread_type=DECODE_LOW_LATENCY):
+    """container 和 packet 两种模式按实时帧率写入访问单元，和 H264Decoder 一样经过 BufferStream 在解码线程里解码，
+    对比第一帧延迟和每帧从写入到解码输出的延迟"""
+    packets=benchmark_clip(codec_name,width,height,frames,fps,slices=4)
+    for mode in (DECODE_CONTAINER,DECODE_PACKET):
+        stream=BufferStream()
+        written=[]
+        decoded=[]
+        def decode():
+            if mode==DECODE_PACKET:
+                decoder=PacketDecoder(codec_name,threads,thread_type)
+                while True:
+                    item=stream.readSingle()
+                    if not item:
+                        return
+                    for _ in decoder.decode(*item):
+                        decoded.append(time.perf_counter())
+            container=av.open(stream,format=codec_name)
+            configure_decoder_threads(container.streams.video[0].codec_context,thread_type,threads)
+            try:
+                for _ in container.decode(video=0):
+                    decoded.append(time.perf_counter())
+            except av.error.FFmpegError:
+                pass
+        thread=threading.Thread(target=decode,daemon=True)
+        thread.start()
+        start=time.perf_counter()
+        for i,data in enumerate(packets):
+            delay=start+i/fps-time.perf_counter()
+            if delay>0:
+                time.sleep(delay)
+            written.append(time.perf_counter())
+            stream.write((data,True) if mode==DECODE_PACKET else data)
+        # 解复用器要等到下一个访问单元或EOF才输出最后一帧，只统计关闭前输出的帧
+        deadline=time.perf_counter()+1
+        while len(decoded)<len(packets) and time.perf_counter()<deadline:
+            time.sleep(0.01)
+        closed=time.perf_counter()
+        stream.close()
+        thread.join(1)
+        latencies=sorted(output-written[i] for i,output in enumerate(decoded) if output<closed)
+        log.info("%-9s first frame %.1fms, per-frame p50 %.2fms p99 %.2fms max %.2fms, %d/%d frames before end of stream",
+                 mode,latencies and (decoded[0]-written[0])*1000,latencies[len(latencies)//2]*1000,
+                 latencies[int(len(latencies)*0.99)]*1000,latencies[-1]*1000,len(latencies),len(packets))
 
 if __name__ == "__main__":
     import time
     import threading
+    from pkg.log import configure
+    configure("debug")
     def test_decode():
         def decode_h264_stream(stream):
             # 创建一个解码器上下文
@@ -554,6 +836,8 @@ if __name__ == "__main__":
         decode_h264_stream(stream)
 
     # buffer_benchmark()
+    # decode_benchmark()
+    # decode_mode_benchmark()
     test_encode_decode()
     # test_high_buffer()
-    print("done")
\ No newline at end of file
+    log.info("done")
\ No newline at end of file
@@ -0,0 +1,278 @@
+import asyncio
+import random
+import ssl
+import struct
+from typing import Optional, Tuple
+
+from pkg.frame import encode_varint
+
+# 控制消息datagram: [类型, varint(device_id), seq(uint32 LE), Control protobuf]
+# 每个datagram自包含，丢失后不重传，接收端按序号丢弃过期的消息
+DATAGRAM_CONTROL = 0x01
+MAX_DATAGRAM_FRAME_SIZE = 65536
+SEQ_MASK = 0xffffffff
+# 乱序最多让序号后退这么多，后退更多说明发送端重启了(新连接的序号从随机值开始)
+SEQ_RESTART_GAP = 1024
+
+
+def encode_control_datagram(seq: int, device_id: int, payload: bytes) -> bytes:
+    return bytes([DATAGRAM_CONTROL]) + encode_varint(device_id) + struct.pack("<I", seq & SEQ_MASK) + payload
+
+
+def decode_control_datagram(data: bytes) -> Optional[Tuple[int, int, bytes]]:
+    """返回 (device_id, seq, payload)，格式不对返回None"""
+    if len(data) < 6 or data[0] != DATAGRAM_CONTROL:
+        return None
+    device_id = 0
+    shift = 0
+    i = 1
+    while True:
+        if i >= len(data) or shift > 63:
+            return None
+        b = data[i]
+        i += 1
+        device_id |= (b & 0x7f) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    if len(data) < i + 4:
+        return None
+    seq, = struct.unpack_from("<I", data, i)
+    return device_id, seq, data[i + 4:]
+
+
+def datagram_supported(protocol) -> bool:
+    """对端在传输参数里声明了max_datagram_frame_size才支持datagram"""
+    quic = getattr(protocol, "_quic", None)
+    return bool(getattr(quic, "_remote_max_datagram_frame_size", None))
+
+
+def datagram_fits(protocol, size: int) -> bool:
+    remote_max = getattr(protocol._quic, "_remote_max_datagram_frame_size", None) or 0
+    # 预留帧类型和长度字段
+    return size + 8 <= remote_max
+
+
+def initial_seq() -> int:
+    """每个连接的第一个序号，发送端重启后几乎不可能落在上一次序号后面的 SEQ_RESTART_GAP 以内"""
+    return random.getrandbits(32)
+
+
+class SequenceFilter:
+    """按32位序号丢弃过期消息，序号回绕时仍然有效
+
+    后退超过 restart_gap 当作发送端重启，从新序号重新开始。
+    """
+
+    def __init__(self, restart_gap=SEQ_RESTART_GAP):
+        self.restart_gap = restart_gap
+        self.last = None
+        self.accepted = 0
+        self.stale = 0
+        self.restarts = 0
+
+    def accept(self, seq: int) -> bool:
+        if self.last is not None:
+            diff = (seq - self.last) & SEQ_MASK
+            if diff == 0 or diff >= 0x80000000:
+                if (self.last - seq) & SEQ_MASK <= self.restart_gap:
+                    self.stale += 1
+                    return False
+                self.restarts += 1
+        self.last = seq
+        self.accepted += 1
+        return True
+
+
+class DeviceSequenceFilter:
+    """每个发送端(device_id)一个 SequenceFilter，多个控制端互不影响"""
+
+    def __init__(self, restart_gap=SEQ_RESTART_GAP):
+        self.restart_gap = restart_gap
+        self.filters = {}
+
+    def accept(self, device_id: int, seq: int) -> bool:
+        seq_filter = self.filters.get(device_id)
+        if seq_filter is None:
+            seq_filter = self.filters[device_id] = SequenceFilter(self.restart_gap)
+        return seq_filter.accept(seq)
+
+    def reset(self):
+        self.filters.clear()
+
+    @property
+    def stale(self) -> int:
+        return sum(seq_filter.stale for seq_filter in self.filters.values())
+
+    @property
+    def restarts(self) -> int:
+        return sum(seq_filter.restarts for seq_filter in self.filters.values())
+
+
+def test_control_datagram_loss(count=2000, loss=0.2, reorder=0.1, port=30543):
+    """本地aioquic服务端 + 模拟丢包/乱序，验证接收端只接受更新的控制消息"""
+    from aioquic.asyncio import QuicConnectionProtocol, serve
+    from aioquic.asyncio.client import connect
+    from aioquic.quic.configuration import QuicConfiguration
+    from aioquic.quic.events import DatagramFrameReceived
+
+    received = []
+    seq_filter = SequenceFilter()
+
+    class ServerProtocol(QuicConnectionProtocol):
+        def quic_event_received(self, event):
+            if isinstance(event, DatagramFrameReceived):
+                decoded = decode_control_datagram(event.data)
+                if decoded and seq_filter.accept(decoded[1]):
+                    received.append(decoded[1])
+
+    async def run(server_datagram):
+        server_configuration = QuicConfiguration(alpn_protocols=["HLD"], is_client=False)
+        if server_datagram:
+            server_configuration.max_datagram_frame_size = MAX_DATAGRAM_FRAME_SIZE
+        server_configuration.load_cert_chain("assets/tls/cert.pem", "assets/tls/key.pem")
+        server = await serve("127.0.0.1", port, configuration=server_configuration, create_protocol=ServerProtocol)
+
+        configuration = QuicConfiguration(alpn_protocols=["HLD"], is_client=True,
+                                          max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE)
+        configuration.verify_mode = ssl.CERT_NONE
+        loop = asyncio.get_running_loop()
+        try:
+            async with connect("127.0.0.1", port, configuration=configuration) as client:
+                supported = datagram_supported(client)
+                if not supported:
+                    return False
+                # 在UDP发送处模拟丢包和乱序
+                transport = client._transport
+                sendto = transport.sendto
+                rnd = random.Random(0)
+                def lossy_sendto(data, addr=None):
+                    r = rnd.random()
+                    if r < loss:
+                        return
+                    if r < loss + reorder:
+                        loop.call_later(0.005, sendto, data, addr)
+                        return
+                    sendto(data, addr)
+                transport.sendto = lossy_sendto
+                for seq in range(count):
+                    client._quic.send_datagram_frame(encode_control_datagram(seq, 1, b"\x08\x32"))
+                    client.transmit()
+                    await asyncio.sleep(0.001)
+                await asyncio.sleep(0.1)
+                return True
+        finally:
+            server.close()
+
+    supported = asyncio.run(run(server_datagram=True))
+    assert supported
+    assert received == sorted(received), "receiver accepted a stale control"
+    assert len(set(received)) == len(received)
+    print(f"sent {count} accepted {seq_filter.accepted} stale dropped {seq_filter.stale} "
+          f"lost {count - seq_filter.accepted - seq_filter.stale}")
+
+    # 对端不支持datagram时应回退到流
+    assert not asyncio.run(run(server_datagram=False))
+    print("fallback ok")
+
+    # 控制端重启: 新连接的序号从随机值(或旧版本的0)重新开始，新消息不能被当作过期丢弃
+    filters = DeviceSequenceFilter()
+    # 每次都比上一次的序号小: 旧版本从0开始，新版本从随机值开始
+    for start in (received[-1], 0, 0xf0000000, 0xc0000000, initial_seq()):
+        for seq in range(start, start + 50):
+            assert filters.accept(1, seq & SEQ_MASK), f"control {seq} after restart dropped"
+        # 重启后乱序到达的旧消息仍然丢弃
+        assert not filters.accept(1, (start + 10) & SEQ_MASK)
+    assert filters.restarts >= 3
+    # 两个控制端的序号互不影响
+    assert filters.accept(2, 5) and filters.accept(1, (start + 50) & SEQ_MASK) and filters.accept(2, 6)
+    print(f"restart ok, restarts detected {filters.restarts}")
+    filters.reset()
+    assert filters.accept(1, 0)
+
+
+def test_control_datagram_relay(count=100, port=30548):
+    """经过 HighwayRelay 端到端: 一个订阅者协商了datagram，收到原样转发的datagram；
+    另一个没有协商，中继改写到它的控制流，两者都按序收到全部控制消息"""
+    from aioquic.asyncio import QuicConnectionProtocol
+    from aioquic.asyncio.client import connect
+    from aioquic.quic.configuration import QuicConfiguration
+    from aioquic.quic.events import DatagramFrameReceived
+
+    from pkg.frame import ALPN_V2, FrameReader, FrameWriter, frame_version
+    from pkg.relay import relay_configuration, start_relay
+    from protocol.highway_pb2 import Control, Device, Register
+
+    control = Device(id=1, message_type=Device.MessageType.CONTROL)
+    received = {"datagram": [], "stream": []}
+
+    class DatagramProtocol(QuicConnectionProtocol):
+        def quic_event_received(self, event):
+            if isinstance(event, DatagramFrameReceived):
+                decoded = decode_control_datagram(event.data)
+                if decoded:
+                    received["datagram"].append(list(Control.FromString(decoded[2]).channels))
+            super().quic_event_received(event)
+
+    def client_configuration(datagram):
+        configuration = QuicConfiguration(alpn_protocols=[ALPN_V2], is_client=True,
+                                          max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE if datagram else None)
+        configuration.verify_mode = ssl.CERT_NONE
+        return configuration
+
+    async def register(client, device_id):
+        reader, writer = await client.create_stream()
+        frame_writer = FrameWriter(writer, delay=0, version=2)
+        frame_writer.write(Register(device=Device(id=device_id, message_type=Device.MessageType.CONTROL),
+                                    subscribe_device=control).SerializeToString())
+        await frame_writer.flush()
+        # writer被回收时会关闭流，中继会移除这个订阅者
+        return reader, writer
+
+    async def read_stream(reader, version):
+        frame_reader = FrameReader(reader, version=version)
+        while len(received["stream"]) < count:
+            frame = await frame_reader.read_frame()
+            received["stream"].append(list(Control.FromString(frame.payload).channels))
+
+    async def run():
+        server, relay = await start_relay("127.0.0.1", port, relay_configuration())
+        try:
+            async with connect("127.0.0.1", port, configuration=client_configuration(True),
+                               create_protocol=DatagramProtocol) as with_datagram, \
+                    connect("127.0.0.1", port, configuration=client_configuration(False)) as without_datagram, \
+                    connect("127.0.0.1", port, configuration=client_configuration(True)) as publisher:
+                streams = [await register(with_datagram, 100), await register(without_datagram, 101)]
+                reader = streams[1][0]
+                # 等两个订阅者在中继上注册完成
+                channel = relay.channels.get((control.id, control.message_type))
+                while channel is None or len(channel.subscribers) < 2:
+                    await asyncio.sleep(0.01)
+                    channel = relay.channels.get((control.id, control.message_type))
+                # 中继一侧看到的是订阅者声明的传输参数
+                assert sorted(datagram_supported(subscriber.protocol) for subscriber in channel.subscribers) == [False, True]
+                stream_task = asyncio.ensure_future(read_stream(reader, frame_version(without_datagram._quic.tls.alpn_negotiated)))
+                for seq in range(count):
+                    publisher._quic.send_datagram_frame(
+                        encode_control_datagram(seq, control.id, Control(channels=[seq, 1500]).SerializeToString()))
+                    publisher.transmit()
+                    await asyncio.sleep(0.001)
+                await asyncio.wait_for(stream_task, 5)
+                await asyncio.sleep(0.1)
+                return len(channel.subscribers)
+        finally:
+            server.close()
+
+    subscribers = asyncio.run(run())
+    expected = [[seq, 1500] for seq in range(count)]
+    assert subscribers == 2, "subscriber removed by a failed forward"
+    assert received["stream"] == expected, "stream fallback lost or reordered controls"
+    # 本地回环不丢包，datagram也应全部到达
+    assert received["datagram"] == expected, "datagram subscriber missed controls"
+    print(f"relay forwarded {count} controls: {len(received['datagram'])} as datagrams, "
+          f"{len(received['stream'])} on the fallback stream")
+
+
+if __name__ == "__main__":
+    test_control_datagram_loss()
+    test_control_datagram_relay()
@@ -0,0 +1,692 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import NamedTuple
+
+
+def generate_crc8_table():
+    crc8_table = [0] * 256
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) & 0xFF) ^ 0x07
+            else:
+                crc = (crc << 1) & 0xFF
+        crc8_table[i] = crc
+    return crc8_table
+
+def calculate_crc_fast(data: int) -> int:
+    crc = 0
+    # 获取低字节和高字节
+    low_byte = data & 0xFF
+    high_byte = (data >> 8) & 0xFF
+
+    # 使用查表法计算CRC8
+    crc = CRC8_TABLE[crc ^ low_byte]
+    crc = CRC8_TABLE[crc ^ high_byte]
+
+    return crc
+
+
+# 生成全局查找表
+CRC8_TABLE = generate_crc8_table()
+
+SYNC_BYTE = 0xff
+HEADER_SIZE = 4
+READ_CHUNK_SIZE = 65536
+# 合并写入的默认参数: 最多等待5ms 或 累计64KB 就写出
+FLUSH_DELAY = 0.005
+FLUSH_BYTES = 65536
+
+# v2 header: [0xfe, flags, varint(length)..., crc8(前面所有header字节)]
+# 带 FLAG_OOB 时: [0xfe, flags, varint(meta长度), varint(payload长度), crc8]，
+# 消息体是 protobuf头(不含payload字段) + 原始payload，payload不经过protobuf序列化
+# 通过ALPN协商，对端只支持"HLD"时仍使用v1的4字节header，"HLD3"表示支持 FLAG_OOB 的v2
+ALPN_V1 = "HLD"
+ALPN_V2 = "HLD2"
+ALPN_V3 = "HLD3"
+SYNC_BYTE_V2 = 0xfe
+V1_MAX_PAYLOAD = 0xFFFF
+# 最大的合法消息是文件块(pkg.upload.BLOCK_SIZE, 1MiB)和高码率下的关键帧，
+# 解析时长度超过这个值当作CRC误匹配重新同步，不会为一个假header等待大量数据
+V2_MAX_PAYLOAD = 4 * 1024 * 1024
+# 每个长度varint最多4字节(28位)
+V2_MAX_VARINT_SIZE = 4
+FLAG_KEYFRAME = 0x01
+FLAG_END_OF_AU = 0x02
+FLAG_OOB = 0x04
+# 控制流上的时钟同步消息(pkg.clock)，不是Control
+FLAG_TIMESYNC = 0x08
+
+
+class Frame(NamedTuple):
+    payload: bytes
+    flags: int = 0
+    # FLAG_OOB 帧 payload 开头的protobuf头长度
+    meta_size: int = 0
+
+
+def crc8(data) -> int:
+    crc = 0
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def build_header(length: int) -> bytes:
+    """构建4字节header [0xff, crc8(length), length低字节, length高字节]"""
+    if length > V1_MAX_PAYLOAD:
+        raise ValueError(f"payload too large for v1 framing: {length}")
+    crc = calculate_crc_fast(length)
+    return bytes([
+        SYNC_BYTE,
+        crc,
+        length & 0xFF,
+        (length >> 8) & 0xFF
+    ])
+
+
+def build_header_v2(length: int, flags: int = 0, meta_size: int = 0) -> bytes:
+    """length 是整个消息体的长度，FLAG_OOB 时其中前 meta_size 字节是protobuf头"""
+    if length > V2_MAX_PAYLOAD:
+        raise ValueError(f"payload too large for v2 framing: {length}")
+    header = bytearray((SYNC_BYTE_V2, flags))
+    if flags & FLAG_OOB:
+        header += encode_varint(meta_size)
+        header += encode_varint(length - meta_size)
+    else:
+        header += encode_varint(length)
+    header.append(crc8(header))
+    return bytes(header)
+
+
+def frame_version(alpn_protocol) -> int:
+    return {ALPN_V3: 3, ALPN_V2: 2}.get(alpn_protocol, 1)
+
+
+def alpn_protocols(version: int) -> list:
+    """最高支持到 version 时提供的ALPN列表，优先使用高版本"""
+    return [ALPN_V3, ALPN_V2, ALPN_V1][3 - min(max(version, 1), 3):]
+
+
+class FrameDecoder:
+    """增量帧解析器
+
+    数据按块喂进来(feed)，解析出的完整消息体放入队列。
+    CRC不匹配时直接在已缓冲的数据里向后查找下一个起始位重新同步，不再逐字节await。
+    """
+
+    def __init__(self, version=1):
+        self.version = version
+        self.sync_byte = SYNC_BYTE_V2 if version >= 2 else SYNC_BYTE
+        self.buffer = bytearray()
+        self.pos = 0
+        self.frames = deque()
+        self.resync_count = 0
+        self.crc_mismatch_count = 0
+
+    def feed(self, data) -> int:
+        """写入一块数据，返回新解析出的消息数量"""
+        if data:
+            self.buffer += data
+        return self.__parse()
+
+    def __parse(self) -> int:
+        buf = self.buffer
+        end = len(buf)
+        pos = self.pos
+        parse_header = self.__parse_header_v2 if self.version >= 2 else self.__parse_header_v1
+        # 从memoryview切片，每个消息体只拷贝一次；__compact 调整缓冲区大小前要先释放
+        view = memoryview(buf)
+        try:
+            count, pos = self.__parse_frames(buf, view, pos, end, parse_header)
+        finally:
+            view.release()
+        self.__compact(pos)
+        return count
+
+    def __parse_frames(self, buf, view, pos, end, parse_header):
+        count = 0
+        while True:
+            start = buf.find(self.sync_byte, pos)
+            if start < 0:
+                # 缓冲区里没有起始位，全部丢弃
+                if end > pos:
+                    self.resync_count += 1
+                pos = end
+                break
+            if start != pos:
+                self.resync_count += 1
+                pos = start
+            header = parse_header(buf, start, end)
+            if header is None:
+                break
+            if header[0] < 0:
+                # [ff,a,ff,b] 从下一个字节开始重新查找起始位
+                self.crc_mismatch_count += 1
+                pos = start + 1
+                continue
+            header_size, length, flags, meta_size = header
+            body = start + header_size
+            if end - body < length:
+                break
+            self.frames.append(Frame(bytes(view[body:body + length]), flags, meta_size))
+            pos = body + length
+            count += 1
+        return count, pos
+
+    @staticmethod
+    def __parse_header_v1(buf, start, end):
+        """返回 (header长度, 消息体长度, flags, meta长度)，数据不足返回None，校验失败header长度为-1"""
+        if end - start < HEADER_SIZE:
+            return None
+        if CRC8_TABLE[CRC8_TABLE[buf[start + 2]] ^ buf[start + 3]] != buf[start + 1]:
+            return (-1, 0, 0, 0)
+        return (HEADER_SIZE, buf[start + 2] | (buf[start + 3] << 8), 0, 0)
+
+    @staticmethod
+    def __parse_header_v2(buf, start, end):
+        if end - start < 2:
+            return None
+        flags = buf[start + 1]
+        i = start + 2
+        # FLAG_OOB 帧有 meta长度 和 payload长度 两个varint
+        lengths = []
+        for _ in range(2 if flags & FLAG_OOB else 1):
+            value = 0
+            shift = 0
+            varint_start = i
+            while True:
+                if i >= end:
+                    return None
+                b = buf[i]
+                i += 1
+                value |= (b & 0x7f) << shift
+                if not b & 0x80:
+                    break
+                shift += 7
+                if i - varint_start >= V2_MAX_VARINT_SIZE:
+                    return (-1, 0, 0, 0)
+            lengths.append(value)
+        if i >= end:
+            return None
+        length = sum(lengths)
+        if length > V2_MAX_PAYLOAD or crc8(buf[start:i]) != buf[i]:
+            return (-1, 0, 0, 0)
+        return (i + 1 - start, length, flags, lengths[0] if len(lengths) == 2 else 0)
+
+    def __compact(self, pos):
+        # 已消费的数据超过一半时再搬移，避免每条消息都memmove
+        if pos >= len(self.buffer):
+            self.buffer.clear()
+            self.pos = 0
+        elif pos > READ_CHUNK_SIZE and pos * 2 > len(self.buffer):
+            del self.buffer[:pos]
+            self.pos = 0
+        else:
+            self.pos = pos
+
+    def buffered(self) -> int:
+        return len(self.buffer) - self.pos
+
+    def has_frame(self) -> bool:
+        return len(self.frames) > 0
+
+    def pop(self) -> Frame:
+        return self.frames.popleft()
+
+    def __iter__(self):
+        while self.frames:
+            yield self.frames.popleft()
+
+
+class FrameReader:
+    """在asyncio.StreamReader上按块读取并解析消息"""
+
+    def __init__(self, reader: asyncio.StreamReader, chunk_size=READ_CHUNK_SIZE, version=1):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.decoder = FrameDecoder(version)
+        self.read_bytes = 0
+        self.message_count = 0
+        self.first_read_time = None
+        # trace(大小, flags, 从数据到达到被取走的秒数)，见 pkg.trace.MessageTrace
+        self.trace = None
+        self.arrivals = deque()
+
+    async def read_frame(self) -> Frame:
+        decoder = self.decoder
+        while not decoder.has_frame():
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(decoder.buffer[decoder.pos:]), None)
+            if self.first_read_time is None:
+                self.first_read_time = time.monotonic()
+            self.read_bytes += len(data)
+            count = decoder.feed(data)
+            if self.trace is not None and count:
+                self.arrivals.extend([time.monotonic()] * count)
+        self.message_count += 1
+        frame = decoder.pop()
+        if self.trace is not None and self.arrivals:
+            self.trace(len(frame.payload), frame.flags, time.monotonic() - self.arrivals.popleft())
+        return frame
+
+    async def read_message(self) -> bytes:
+        frame = await self.read_frame()
+        return frame.payload
+
+
+class FrameWriter:
+    """按流合并写入
+
+    header和payload以memoryview形式排队，不做拼接；
+    到达 delay 时间或累计 max_bytes 字节时一次writelines写出，每批只drain一次。
+    实时消息调用 flush() 可立即写出。
+    传入 scheduler 时，写出前需要等待 SendScheduler 按 message_type 的优先级放行。
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, delay=FLUSH_DELAY, max_bytes=FLUSH_BYTES, version=1,
+                 scheduler=None, message_type=None):
+        self.writer = writer
+        self.version = version
+        self.scheduler = scheduler
+        self.message_type = message_type
+        if scheduler is not None:
+            scheduler.register(self, message_type)
+        self.max_payload = V2_MAX_PAYLOAD if version >= 2 else V1_MAX_PAYLOAD
+        # v3 可以写 FLAG_OOB 帧
+        self.oob = version >= 3
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_count = 0
+        self.pending_since = 0.0
+        self.timer = None
+        self.drain_task = None
+        self.flush_task = None
+        self.error = None
+        self.write_bytes = 0
+        self.message_count = 0
+        self.batch_count = 0
+        self.drain_count = 0
+        # 累计等待drain的时间(秒)
+        self.drain_time = 0.0
+        self.drain_start = 0.0
+        # trace(大小, flags, 从排队到交给transport的秒数)，见 pkg.trace.MessageTrace
+        self.trace = None
+        self.pending_trace = []
+
+    def write(self, data, flags=0) -> int:
+        """排队一条消息，返回加上header后的字节数，v1不携带flags"""
+        return self.write_parts((data,), flags)
+
+    def write_oob(self, meta, payload, flags=0) -> int:
+        """排队一条 FLAG_OOB 消息: protobuf头 meta + 原始数据 payload，payload不拷贝"""
+        if not self.oob:
+            raise ValueError(f"out-of-band payload not supported by v{self.version} framing")
+        return self.write_parts((meta, payload), flags | FLAG_OOB, len(meta))
+
+    def write_parts(self, parts, flags=0, meta_size=0) -> int:
+        """排队由多段数据组成的一条消息，各段以memoryview排队，不拼接"""
+        if self.error:
+            raise self.error
+        length = sum(len(part) for part in parts)
+        header = build_header_v2(length, flags, meta_size) if self.version >= 2 else build_header(length)
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.append(header)
+        for part in parts:
+            self.pending.append(memoryview(part))
+        size = len(header) + length
+        if self.trace is not None:
+            self.pending_trace.append((size, flags, time.monotonic()))
+        self.pending_bytes += size
+        self.pending_count += 1
+        self.message_count += 1
+        if self.pending_bytes >= self.max_bytes:
+            self.__flush_soon()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.__flush_soon)
+        return size
+
+    async def flush(self):
+        """立即写出所有排队的数据并drain"""
+        if self.error:
+            raise self.error
+        if self.scheduler is not None:
+            await self.scheduler.wait_turn(self.message_type, self)
+        self.__write_pending()
+        self.drain_count += 1
+        start = time.monotonic()
+        try:
+            await self.writer.drain()
+        finally:
+            self.drain_time += time.monotonic() - start
+
+    def write_pending(self):
+        """不经过调度器和drain，立即把排队的数据交给transport"""
+        if self.error:
+            raise self.error
+        self.__write_pending()
+
+    def __write_pending(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        self.writer.writelines(self.pending)
+        if self.pending_trace:
+            now = time.monotonic()
+            for size, flags, queued in self.pending_trace:
+                self.trace(size, flags, now - queued)
+            self.pending_trace = []
+        self.write_bytes += self.pending_bytes
+        self.batch_count += 1
+        if self.scheduler is not None:
+            self.scheduler.on_sent(self.message_type, self.pending_bytes, self.pending_count,
+                                   time.monotonic() - self.pending_since)
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_count = 0
+
+    def __flush_soon(self):
+        if self.scheduler is not None and not self.scheduler.allowed(self.message_type, self):
+            # 优先级更高的流还有数据，等调度器放行后再写出
+            if self.flush_task is None or self.flush_task.done():
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                self.flush_task = asyncio.get_running_loop().create_task(self.__flush_when_allowed())
+            return
+        self.__write_pending()
+        self.__drain_soon()
+
+    async def __flush_when_allowed(self):
+        await self.scheduler.wait_turn(self.message_type, self)
+        self.__write_pending()
+        self.__drain_soon()
+
+    def __drain_soon(self):
+        # 上一批还在drain时不再重复创建任务
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_count += 1
+            self.drain_start = time.monotonic()
+            self.drain_task = asyncio.get_running_loop().create_task(self.writer.drain())
+            self.drain_task.add_done_callback(self.__drain_done)
+
+    def __drain_done(self, task: asyncio.Task):
+        self.drain_time += time.monotonic() - self.drain_start
+        if not task.cancelled() and task.exception():
+            self.error = task.exception()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for task in (self.drain_task, self.flush_task):
+            if task and not task.done():
+                task.cancel()
+        if self.scheduler is not None:
+            self.scheduler.unregister(self, self.message_type)
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_count = 0
+        self.pending_trace = []
+
+
+def generate_stream(count=10000, min_size=100, max_size=60000, corrupt_rate=0.0, seed=0, version=1) -> bytes:
+    """生成测试用的帧流，corrupt_rate>0 时随机插入垃圾字节和损坏的header"""
+    rnd = random.Random(seed)
+    sync_byte = SYNC_BYTE_V2 if version >= 2 else SYNC_BYTE
+    out = bytearray()
+    for i in range(count):
+        if corrupt_rate and rnd.random() < corrupt_rate:
+            # 插入带起始位的垃圾数据 / 长度被破坏的header
+            out += bytes([sync_byte, rnd.randrange(256), sync_byte]) + rnd.randbytes(rnd.randrange(1, 64))
+        payload = rnd.randbytes(rnd.randrange(min_size, max_size))
+        if version >= 3:
+            # v3 一半是 FLAG_OOB 帧
+            flags = i & 0x7
+            out += build_header_v2(len(payload), flags, min(len(payload), 16) if flags & FLAG_OOB else 0)
+        elif version == 2:
+            out += build_header_v2(len(payload), i & 0x3)
+        else:
+            out += build_header(len(payload))
+        out += payload
+    return bytes(out)
+
+
+async def _legacy_receive_message(reader: asyncio.StreamReader):
+    """旧版逐字节读取实现，仅用于benchmark对比"""
+    header = bytearray(4)
+    while True:
+        b = await reader.readexactly(1)
+        if b[0] == 0xff:
+            header[0] = b[0]
+            remain_size = 3
+            while True:
+                remaining = await reader.readexactly(remain_size)
+                header[4-remain_size:] = remaining
+                length = (header[2]&0xff | (header[3]&0xff)<<8)
+                if calculate_crc_fast(length) == header[1]:
+                    return await reader.readexactly(length)
+                has_ff = False
+                for i in range(1, 4):
+                    if header[i] == 0xff:
+                        has_ff = True
+                        for j in range(0, 4-i):
+                            header[j] = header[j+i]
+                        remain_size = i
+                        break
+                if not has_ff:
+                    break
+
+
+def test_oversize_header(count=100):
+    """CRC碰巧匹配但长度超过 V2_MAX_PAYLOAD 的header被丢弃，后面的帧正常解析，不会一直等待数据"""
+    rnd = random.Random(0)
+    payloads = [rnd.randbytes(rnd.randrange(20, 5000)) for _ in range(count)]
+    data = bytearray()
+    for i, payload in enumerate(payloads):
+        if i % 10 == 0:
+            for flags, lengths in ((0, (V2_MAX_PAYLOAD + 1,)), (FLAG_OOB, (16, V2_MAX_PAYLOAD))):
+                header = bytearray((SYNC_BYTE_V2, flags))
+                for length in lengths:
+                    header += encode_varint(length)
+                data += header + bytes([crc8(header)])
+        data += build_header_v2(len(payload)) + payload
+    decoder = FrameDecoder(version=3)
+    for i in range(0, len(data), 1350):
+        decoder.feed(data[i:i + 1350])
+    frames = list(decoder)
+    assert [frame.payload for frame in frames] == payloads, "frames lost after an oversize header"
+    assert decoder.crc_mismatch_count == count // 10 * 2
+    assert decoder.buffered() == 0
+    print(f"oversize headers skipped {decoder.crc_mismatch_count}, {len(frames)} frames decoded")
+
+
+def frame_decoder_benchmark(path=None, feed_size=1350, version=1):
+    """对比旧版逐字节解析和FrameReader
+
+    path 为录制的原始流文件(不传则生成带/不带损坏的测试流)，version 为其header版本，
+    数据按 feed_size (约一个QUIC包) 分块喂给StreamReader，模拟网络到达。
+    """
+    streams = []
+    if path:
+        with open(path, "rb") as f:
+            streams.append((path, f.read(), version))
+    else:
+        streams.append(("clean", generate_stream(count=20000, min_size=20, max_size=5000), 1))
+        streams.append(("corrupt 5%", generate_stream(count=20000, min_size=20, max_size=5000, corrupt_rate=0.05, seed=1), 1))
+        # v2: 整个访问单元一条消息
+        streams.append(("v2 clean", generate_stream(count=20000, min_size=20, max_size=5000, version=2), 2))
+        streams.append(("v2 corrupt 5%", generate_stream(count=20000, min_size=20, max_size=5000, corrupt_rate=0.05, seed=1, version=2), 2))
+        streams.append(("v2 large AU", generate_stream(count=300, min_size=60000, max_size=300000, version=2), 2))
+        streams.append(("v3 oob", generate_stream(count=20000, min_size=20, max_size=5000, corrupt_rate=0.05, seed=1, version=3), 3))
+
+    class CountingReader(asyncio.StreamReader):
+        # 统计对StreamReader的await次数
+        awaits = 0
+
+        async def read(self, n=-1):
+            self.awaits += 1
+            return await super().read(n)
+
+        async def readexactly(self, n):
+            self.awaits += 1
+            return await super().readexactly(n)
+
+    async def run(data, read_message):
+        reader = CountingReader(limit=2**30)
+        for i in range(0, len(data), feed_size):
+            reader.feed_data(data[i:i + feed_size])
+        reader.feed_eof()
+        count = 0
+        try:
+            while True:
+                await read_message(reader)
+                count += 1
+        except asyncio.IncompleteReadError:
+            pass
+        return count, reader.awaits
+
+    def legacy(reader):
+        return _legacy_receive_message(reader)
+
+    def chunked(version):
+        readers = {}
+        def read_message(reader):
+            if reader not in readers:
+                readers[reader] = FrameReader(reader, version=version)
+            return readers[reader].read_message()
+        return read_message
+
+    for name, data, version in streams:
+        mb = len(data) / (1024 * 1024)
+        impls = [("chunked", chunked(version))]
+        if version == 1:
+            # 旧版只支持v1
+            impls.insert(0, ("legacy", legacy))
+        for impl_name, read_message in impls:
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            count, awaits = asyncio.run(run(data, read_message))
+            cpu = time.process_time() - cpu_start
+            wall = time.perf_counter() - wall_start
+            print(f"[{name}] {impl_name:8s} {count} messages {mb:.2f}MB: "
+                  f"{count/wall:.0f} msg/s, cpu {cpu*1000/mb:.2f} ms/MB, {awaits} reader awaits")
+
+
+def frame_writer_benchmark(seconds=3, bitrate=4_000_000, fps=30):
+    """对比旧版send_message(拼接header+data，每条drain)和FrameWriter
+
+    模拟 bitrate 的视频(每帧按 <=60000 字节拆分) + 50pps音频 + 20Hz控制，
+    统计transport写次数、drain次数和写出前拷贝的字节数。
+    """
+    class FakeWriter:
+        def __init__(self):
+            self.writes = 0
+            self.drains = 0
+            self.bytes = 0
+            self.copied = 0
+
+        def write(self, data):
+            self.writes += 1
+            self.bytes += len(data)
+
+        def writelines(self, data):
+            # 与asyncio.WriteTransport.writelines一致: 拼接一次后写出
+            joined = b"".join(data)
+            self.copied += len(joined)
+            self.write(joined)
+
+        async def drain(self):
+            self.drains += 1
+            await asyncio.sleep(0)
+
+    async def legacy_send(writer, data, flush):
+        length = len(data)
+        crc = calculate_crc_fast(length)
+        header = bytes([0xff, crc, length & 0xFF, (length >> 8) & 0xFF])
+        writer.write(header + data)
+        if flush:
+            await writer.drain()
+        # header+data 拼接了两次
+        writer.copied += 2 * (HEADER_SIZE + length)
+        return len(header + data)
+
+    def make_sender(coalesce):
+        writers = {}
+        async def send(writer, data, flush):
+            if not coalesce:
+                return await legacy_send(writer, data, flush)
+            if writer not in writers:
+                writers[writer] = FrameWriter(writer)
+            size = writers[writer].write(data)
+            if flush:
+                await writers[writer].flush()
+            return size
+        return send
+
+    frame_size = bitrate // 8 // fps
+    video_frame = random.randbytes(frame_size)
+    audio_frame = random.randbytes(100)
+    control = random.randbytes(30)
+
+    async def run(send):
+        video, audio, ctrl = FakeWriter(), FakeWriter(), FakeWriter()
+
+        async def periodic(writer, data, rate, flush, split=None):
+            interval = 1 / rate
+            next_time = time.perf_counter()
+            end = next_time + seconds
+            while next_time < end:
+                if split:
+                    for i in range(0, len(data), split):
+                        await send(writer, data[i:i + split], flush)
+                else:
+                    await send(writer, data, flush)
+                next_time += interval
+                await asyncio.sleep(max(0, next_time - time.perf_counter()))
+
+        await asyncio.gather(
+            # 与现状一致: 视频默认flush，音频不flush，控制flush
+            periodic(video, video_frame, fps, not send.coalesce, split=1350),
+            periodic(audio, audio_frame, 50, False),
+            periodic(ctrl, control, 20, True),
+        )
+        await asyncio.sleep(FLUSH_DELAY * 2)
+        return video, audio, ctrl
+
+    for name, coalesce in (("legacy", False), ("coalesced", True)):
+        send = make_sender(coalesce)
+        send.coalesce = coalesce
+        cpu_start = time.process_time()
+        writers = asyncio.run(run(send))
+        cpu = time.process_time() - cpu_start
+        writes = sum(w.writes for w in writers)
+        drains = sum(w.drains for w in writers)
+        total = sum(w.bytes for w in writers)
+        copied = sum(w.copied for w in writers)
+        print(f"{name:10s} {total/1024/1024:.2f}MB transport writes {writes} drains {drains} "
+              f"copied {copied/1024/1024:.2f}MB cpu {cpu*1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    test_oversize_header()
+    frame_decoder_benchmark()
+    # frame_writer_benchmark()
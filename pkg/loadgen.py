@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import ssl
+import time
+from collections import defaultdict
+
+from aioquic.asyncio.client import connect
+from aioquic.quic.configuration import QuicConfiguration
+
+from pkg.frame import (FLAG_END_OF_AU, FLAG_KEYFRAME, V1_MAX_PAYLOAD, FrameReader, FrameWriter, alpn_protocols,
+                       frame_version)
+from pkg.loop import LOOP_ASYNCIO, LoopLagMonitor, loop_name, run
+from pkg.wire import decode_message, write_message
+from protocol.highway_pb2 import Audio, Control, Device, Register, Video
+
+logger = logging.getLogger("loadgen")
+
+PUBLISHER_ID_BASE = 1000
+SUBSCRIBER_ID_BASE = 100000
+# 合成的H264数据: 关键帧以IDR开头，其余为普通slice，中继可以按v1格式识别关键帧
+IDR_PREFIX = b"\x00\x00\x01\x65"
+SLICE_PREFIX = b"\x00\x00\x01\x41"
+
+MESSAGE_TYPES = {
+    "video": Device.MessageType.VIDEO,
+    "audio": Device.MessageType.AUDIO,
+    "control": Device.MessageType.CONTROL,
+}
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+class DeviceStats:
+    def __init__(self, device_id, role):
+        self.device_id = device_id
+        self.role = role
+        self.handshake_ms = None
+        self.setup_ms = None
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.messages = defaultdict(int)
+        self.latency = defaultdict(list)
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.error = None
+
+    def result(self, duration) -> dict:
+        return {
+            "device_id": self.device_id,
+            "role": self.role,
+            "handshake_ms": self.handshake_ms,
+            "setup_ms": self.setup_ms,
+            "send_rate": self.sent_bytes / duration,
+            "receive_rate": self.received_bytes / duration,
+            "messages": dict(self.messages),
+            "latency": {name: samples for name, samples in self.latency.items()},
+            "packets_sent": self.packets_sent,
+            "packets_received": self.packets_received,
+            "error": self.error,
+        }
+
+
+class VirtualDevice:
+    """一个模拟设备: 一条QUIC连接，视频/音频/控制各一个流
+
+    发布者按设定的速率发送合成数据，消息里带发送时的时间戳(毫秒)；
+    订阅者订阅对应发布者的三个频道，用时间戳计算端到端延迟。
+    Control没有时间戳字段，channels[0] 放发送时间戳的低31位。
+    """
+
+    def __init__(self, device_id, options, subscribe_id=None):
+        self.device_id = device_id
+        self.options = options
+        self.subscribe_id = subscribe_id
+        self.stats = DeviceStats(device_id, "subscriber" if subscribe_id is not None else "publisher")
+        self.version = 1
+
+    def configuration(self) -> QuicConfiguration:
+        configuration = QuicConfiguration(
+            alpn_protocols=alpn_protocols(self.options.framing),
+            is_client=True,
+        )
+        if self.options.insecure:
+            configuration.verify_mode = ssl.CERT_NONE
+        return configuration
+
+    async def run(self, deadline):
+        start = time.perf_counter()
+        try:
+            async with connect(self.options.host, self.options.port, configuration=self.configuration()) as client:
+                self.stats.handshake_ms = (time.perf_counter() - start) * 1000
+                # 统计收到的UDP包
+                datagram_received = client.datagram_received
+                def count_datagram(data, addr):
+                    self.stats.packets_received += 1
+                    datagram_received(data, addr)
+                client.datagram_received = count_datagram
+                self.version = frame_version(client._quic.tls.alpn_negotiated)
+                streams = {}
+                for name in self.options.types:
+                    reader, writer = await client.create_stream()
+                    frame_writer = FrameWriter(writer, delay=0, version=self.version)
+                    register = Register(device=Device(id=self.device_id, message_type=MESSAGE_TYPES[name]))
+                    if self.subscribe_id is not None:
+                        register.subscribe_device.CopyFrom(Device(id=self.subscribe_id, message_type=MESSAGE_TYPES[name]))
+                    frame_writer.write(register.SerializeToString())
+                    frame_writer.write_pending()
+                    streams[name] = (reader, frame_writer)
+                await writer.drain()
+                self.stats.setup_ms = (time.perf_counter() - start) * 1000
+                if self.subscribe_id is None:
+                    tasks = [self.__publish(name, frame_writer, deadline) for name, (_, frame_writer) in streams.items()]
+                else:
+                    tasks = [self.__subscribe(name, reader, deadline) for name, (reader, _) in streams.items()]
+                await asyncio.gather(*tasks)
+                self.stats.packets_sent = client._quic._packet_number
+        except Exception as e:
+            self.stats.error = repr(e)
+        return self.stats
+
+    async def __publish(self, name, frame_writer: FrameWriter, deadline):
+        options = self.options
+        rate = {"video": options.fps, "audio": options.audio_rate, "control": options.control_rate}[name]
+        if rate <= 0:
+            return
+        interval = 1 / rate
+        video_size = max(options.video_bitrate // 8 // options.fps, 16)
+        count = 0
+        next_time = time.monotonic()
+        while next_time < deadline:
+            if name == "video":
+                keyframe = count % options.fps == 0
+                raw = (IDR_PREFIX if keyframe else SLICE_PREFIX) + bytes(video_size)
+                if self.version >= 2:
+                    self.stats.sent_bytes += write_message(frame_writer, Video(timestamp=now_ms(), counter=count), raw,
+                                                           (FLAG_KEYFRAME if keyframe else 0) | FLAG_END_OF_AU)
+                else:
+                    chunk_size = V1_MAX_PAYLOAD - 64
+                    view = memoryview(raw)
+                    for i in range(0, len(raw), chunk_size):
+                        self.stats.sent_bytes += write_message(frame_writer, Video(timestamp=now_ms(), counter=count),
+                                                               view[i:i + chunk_size])
+            elif name == "audio":
+                self.stats.sent_bytes += write_message(frame_writer, Audio(timestamp=now_ms(), counter=count),
+                                                       bytes(options.audio_size))
+            else:
+                data = Control(channels=[now_ms() & 0x7fffffff] + [1500] * 9).SerializeToString()
+                frame_writer.write(data)
+                self.stats.sent_bytes += len(data)
+            await frame_writer.flush()
+            self.stats.messages[name] += 1
+            count += 1
+            next_time += interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def __subscribe(self, name, reader, deadline):
+        frame_reader = FrameReader(reader, version=self.version)
+        message_class = {"video": Video, "audio": Audio, "control": Control}[name]
+        latency = self.stats.latency[name]
+        try:
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                frame = await asyncio.wait_for(frame_reader.read_frame(), timeout)
+                self.stats.received_bytes += len(frame.payload)
+                self.stats.messages[name] += 1
+                message = decode_message(frame, message_class)
+                if name == "control":
+                    sent = message.channels[0] if message.channels else None
+                    received = now_ms() & 0x7fffffff
+                else:
+                    sent = message.timestamp
+                    received = now_ms()
+                if sent:
+                    latency.append(received - sent)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+
+
+async def run_devices(devices, options):
+    """按 connect_rate 错开建立连接，所有设备在同一时刻结束"""
+    deadline = time.monotonic() + options.duration
+    monitor = LoopLagMonitor()
+    monitor.start()
+    tasks = []
+    for device in devices:
+        tasks.append(asyncio.get_running_loop().create_task(device.run(deadline)))
+        if options.connect_rate > 0:
+            await asyncio.sleep(1 / options.connect_rate)
+    stats = await asyncio.gather(*tasks)
+    monitor.stop()
+    return stats, monitor.lateness, loop_name(asyncio.get_running_loop())
+
+
+def run_worker(args):
+    """进程池里的一个worker，运行分到的设备，返回可pickle的结果"""
+    options, publishers, subscribers = args
+    devices = [VirtualDevice(device_id, options) for device_id in publishers]
+    # 先连发布者，订阅者随后
+    devices += [VirtualDevice(device_id, options, subscribe_id) for device_id, subscribe_id in subscribers]
+    stats, lateness, name = run(run_devices(devices, options), options.loop)
+    duration = options.duration
+    return {"devices": [s.result(duration) for s in stats], "loop_lag": lateness, "loop": name}
+
+
+def plan(options):
+    """把设备平均分到各个进程"""
+    publishers = [PUBLISHER_ID_BASE + i for i in range(options.publishers)]
+    subscribers = [
+        (SUBSCRIBER_ID_BASE + i, publishers[i % len(publishers)] if publishers else options.source_device_id)
+        for i in range(options.subscribers)
+    ]
+    shards = []
+    for n in range(options.processes):
+        shards.append((options, publishers[n::options.processes], subscribers[n::options.processes]))
+    return shards
+
+
+def report(workers, options):
+    results = [r for worker in workers for r in worker["devices"]]
+    lag = [x for worker in workers for x in worker["loop_lag"]]
+    if lag:
+        print(f"event loop {workers[0]['loop']} lag ms p50 {percentile(lag, 0.5) * 1000:.2f} "
+              f"p99 {percentile(lag, 0.99) * 1000:.2f} max {max(lag) * 1000:.2f}")
+    packets = sum(r["packets_sent"] + r["packets_received"] for r in results)
+    print(f"packets {packets / options.duration:.0f}/s")
+    errors = [r for r in results if r["error"]]
+    ok = [r for r in results if not r["error"]]
+    print(f"devices {len(results)} ok {len(ok)} failed {len(errors)}")
+    for r in errors[:5]:
+        print(f"  device {r['device_id']} {r['role']}: {r['error']}")
+    for name, key in (("handshake", "handshake_ms"), ("setup", "setup_ms")):
+        samples = [r[key] for r in ok if r[key] is not None]
+        if samples:
+            print(f"{name:9s} ms p50 {percentile(samples, 0.5):.1f} p95 {percentile(samples, 0.95):.1f} "
+                  f"p99 {percentile(samples, 0.99):.1f} max {max(samples):.1f}")
+    for role, key in (("publisher", "send_rate"), ("subscriber", "receive_rate")):
+        rates = [r[key] for r in ok if r["role"] == role]
+        if rates:
+            print(f"{role:10s} throughput per device kB/s avg {sum(rates) / len(rates) / 1024:.1f} "
+                  f"min {min(rates) / 1024:.1f} max {max(rates) / 1024:.1f} total {sum(rates) * 8 / 1e6:.2f} Mbit/s")
+    for name in options.types:
+        samples = [x for r in ok for x in r["latency"].get(name, [])]
+        messages = sum(r["messages"].get(name, 0) for r in ok if r["role"] == "subscriber")
+        if samples:
+            print(f"{name:7s} latency ms p50 {percentile(samples, 0.5)} p95 {percentile(samples, 0.95)} "
+                  f"p99 {percentile(samples, 0.99)} max {max(samples)} ({messages} messages)")
+    if options.verbose:
+        for r in sorted(ok, key=lambda r: r["device_id"]):
+            print(f"  {r['role']:10s} {r['device_id']} setup {r['setup_ms']:.1f}ms "
+                  f"send {r['send_rate'] / 1024:.1f}kB/s receive {r['receive_rate'] / 1024:.1f}kB/s {r['messages']}")
+
+
+def main(options):
+    shards = plan(options)
+    start = time.perf_counter()
+    if options.processes > 1:
+        with multiprocessing.Pool(options.processes) as pool:
+            workers = pool.map(run_worker, shards)
+    else:
+        workers = [run_worker(shards[0])]
+    print(f"finished in {time.perf_counter() - start:.1f}s")
+    report(workers, options)
+    return workers
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Highway relay load generator")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=30042)
+    parser.add_argument("-p", "--publishers", type=int, default=10, help="number of publishing devices")
+    parser.add_argument("-s", "--subscribers", type=int, default=10,
+                        help="number of subscribing devices, assigned to publishers round-robin")
+    parser.add_argument("--source-device-id", type=int, default=1,
+                        help="device to subscribe to when there are no simulated publishers")
+    parser.add_argument("-j", "--processes", type=int, default=1, help="number of worker processes")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--types", type=str, default="video,audio,control",
+                        help="comma separated message types (video,audio,control)")
+    parser.add_argument("--video-bitrate", type=int, default=1_000_000, help="bits per second per publisher")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--audio-rate", type=float, default=50, help="audio messages per second")
+    parser.add_argument("--audio-size", type=int, default=640, help="bytes per audio message")
+    parser.add_argument("--control-rate", type=float, default=20, help="control messages per second")
+    parser.add_argument("--connect-rate", type=float, default=50, help="new connections per second per process (0 = all at once)")
+    parser.add_argument("--framing", type=int, default=3, help="highest framing version to offer (1, 2 or 3)")
+    parser.add_argument("--loop", type=str, default=LOOP_ASYNCIO, help="event loop: asyncio, uvloop or auto")
+    parser.add_argument("--secure", dest="insecure", action="store_false", help="verify the server certificate")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print per-device results")
+    options = parser.parse_args(argv)
+    options.types = [t for t in options.types.split(",") if t]
+    options.processes = max(1, options.processes)
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+        level=logging.DEBUG if options.verbose else logging.WARNING,
+    )
+    main(options)
@@ -0,0 +1,192 @@
+import logging
+import time
+from collections import deque
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+# setting.json 里 "log_level"/"log_ring_level" 的取值
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# 内存里保留的最近事件数
+RING_SIZE = 4096
+# every() 同一位置默认每秒最多输出一次
+SITE_INTERVAL = 1.0
+
+_level = INFO
+_ring_level = INFO
+_ring = deque(maxlen=RING_SIZE)
+_loggers = {}
+
+
+def parse_level(level) -> int:
+    if isinstance(level, str):
+        return LEVELS[level.lower()]
+    return int(level)
+
+
+class SiteCounter:
+    __slots__ = ("count", "suppressed", "last")
+
+    def __init__(self):
+        self.count = 0
+        self.suppressed = 0
+        self.last = float("-inf")
+
+
+class HotLogger:
+    """热路径上的日志
+
+    级别低于 log_level 和 log_ring_level 时，调用只比较一次整数就返回，参数不格式化；
+    达到 log_ring_level 的事件以未格式化的 (时间, 级别, 名称, msg, args) 放进环形缓冲，dump() 时才格式化；
+    达到 log_level 的事件交给同名的 logging.Logger 输出。
+    每个包/每帧都会执行的位置用 every(site, ...)，按位置计数，每 interval 秒最多输出一次。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger(name)
+        self.sites = {}
+        self.update()
+
+    def update(self):
+        self.level = _level
+        self.ring_level = _ring_level
+        self.min_level = min(_level, _ring_level)
+        self.logger.setLevel(_level)
+
+    def enabled(self, level) -> bool:
+        return level >= self.min_level
+
+    def _emit(self, level, msg, args, exc_info=None):
+        if level >= self.ring_level:
+            _ring.append((time.time(), level, self.name, msg, args))
+        if level >= self.level:
+            self.logger.log(level, msg, *args, exc_info=exc_info)
+
+    def debug(self, msg, *args):
+        if DEBUG >= self.min_level:
+            self._emit(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        if INFO >= self.min_level:
+            self._emit(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        if WARNING >= self.min_level:
+            self._emit(WARNING, msg, args)
+
+    def error(self, msg, *args):
+        if ERROR >= self.min_level:
+            self._emit(ERROR, msg, args)
+
+    def exception(self, msg, *args):
+        """在 except 块里调用，附带异常堆栈"""
+        if ERROR >= self.min_level:
+            self._emit(ERROR, msg, args, exc_info=True)
+
+    def every(self, site, msg, *args, level=DEBUG, interval=SITE_INTERVAL):
+        """同一位置每 interval 秒最多输出一次，期间被跳过的次数附在下一条后面"""
+        if level < self.min_level:
+            return
+        counter = self.sites.get(site)
+        if counter is None:
+            counter = self.sites[site] = SiteCounter()
+        counter.count += 1
+        now = time.monotonic()
+        if now - counter.last < interval:
+            counter.suppressed += 1
+            return
+        counter.last = now
+        if counter.suppressed:
+            msg += " (%d suppressed)"
+            args += (counter.suppressed,)
+            counter.suppressed = 0
+        self._emit(level, msg, args)
+
+    def counters(self) -> dict:
+        return {site: counter.count for site, counter in self.sites.items()}
+
+
+def get_logger(name) -> HotLogger:
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = HotLogger(name)
+    return logger
+
+
+def configure(level=None, ring_level=None, ring_size=None):
+    """设置输出级别、环形缓冲级别和大小，已经创建的 HotLogger 立即生效
+
+    root logger 还没有handler时按 LOG_FORMAT 输出到stderr。
+    """
+    global _level, _ring_level, _ring
+    if level is not None:
+        _level = parse_level(level)
+    if ring_level is not None:
+        _ring_level = parse_level(ring_level)
+    if ring_size is not None and ring_size != _ring.maxlen:
+        _ring = deque(_ring, maxlen=ring_size)
+    logging.basicConfig(format=LOG_FORMAT)
+    for logger in _loggers.values():
+        logger.update()
+
+
+def format_event(event) -> str:
+    timestamp, level, name, msg, args = event
+    try:
+        message = msg % args if args else msg
+    except Exception:
+        message = f"{msg} {args!r}"
+    return (f"{time.strftime('%H:%M:%S', time.localtime(timestamp))}.{int(timestamp % 1 * 1000):03d} "
+            f"{logging.getLevelName(level)} {name}: {message}")
+
+
+def dump(path=None) -> str:
+    """格式化环形缓冲里的事件和每个位置的计数，path 不为空时写入文件"""
+    lines = [format_event(event) for event in list(_ring)]
+    for name, logger in sorted(_loggers.items()):
+        for site, count in sorted(logger.counters().items()):
+            lines.append(f"counter {name}.{site}: {count}")
+    text = "\n".join(lines) + "\n"
+    if path:
+        with open(path, "w") as fp:
+            fp.write(text)
+    return text
+
+
+def counters() -> dict:
+    return {f"{name}.{site}": count for name, logger in _loggers.items() for site, count in logger.counters().items()}
+
+
+def clear():
+    _ring.clear()
+    for logger in _loggers.values():
+        logger.sites.clear()
+
+
+def log_benchmark(count=1000000):
+    """关闭时每次调用的开销，以及打开环形缓冲后 debug/every 的开销"""
+    log = get_logger("benchmark")
+    level, ring_level = _level, _ring_level
+    try:
+        for name, output, ring in (("disabled", INFO, INFO), ("ring", INFO, DEBUG)):
+            configure(output, ring)
+            for method, call in (("debug", lambda i: log.debug("receive message %d", i)),
+                                 ("every", lambda i: log.every("receive", "receive message %d", i))):
+                start = time.perf_counter()
+                for i in range(count):
+                    call(i)
+                elapsed = time.perf_counter() - start
+                print(f"{name:8s} {method:5s} {elapsed / count * 1e9:.0f}ns per call")
+        assert log.counters()["receive"] == count
+        assert f"receive message {count - 1}" in dump(), "debug events not in the ring"
+    finally:
+        configure(level, ring_level)
+        clear()
+
+
+if __name__ == "__main__":
+    log_benchmark()
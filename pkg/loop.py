@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("loop")
+
+# setting.json 里 "event_loop" 的取值
+LOOP_ASYNCIO = "asyncio"
+LOOP_UVLOOP = "uvloop"
+LOOP_AUTO = "auto"
+
+
+def uvloop_available() -> bool:
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def new_event_loop(name=LOOP_ASYNCIO) -> asyncio.AbstractEventLoop:
+    """按名称创建事件循环，uvloop没有安装时回退到asyncio默认的事件循环
+
+    asyncio: 标准事件循环；uvloop: 使用uvloop；auto: 安装了uvloop就用。
+    """
+    if name in (LOOP_UVLOOP, LOOP_AUTO):
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            if name == LOOP_UVLOOP:
+                logger.warning("uvloop is not installed, using the asyncio event loop")
+    elif name != LOOP_ASYNCIO:
+        logger.warning(f"unknown event loop {name!r}, using the asyncio event loop")
+    return asyncio.new_event_loop()
+
+
+def loop_name(loop: asyncio.AbstractEventLoop) -> str:
+    return LOOP_UVLOOP if type(loop).__module__.startswith("uvloop") else LOOP_ASYNCIO
+
+
+def run(coroutine, name=LOOP_ASYNCIO):
+    """asyncio.run 的替代，使用 new_event_loop(name) 创建的事件循环"""
+    loop = new_event_loop(name)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coroutine)
+    finally:
+        try:
+            tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class LoopLagMonitor:
+    """定时sleep，统计实际唤醒时间比预期晚了多少"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lateness = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.__run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def __run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lateness.append(time.perf_counter() - start - self.interval)
+
+
+def loop_benchmark(seconds=10, publishers=4, subscribers=8, port=30547):
+    """本地中继(单独的进程)，loadgen在当前进程里用不同的事件循环跑完整的视频+音频+控制负载，
+    对比每秒处理的UDP包数和事件循环延迟"""
+    import multiprocessing
+
+    from pkg import loadgen
+    from pkg.relay import _benchmark_relay_process
+
+    loops = [LOOP_ASYNCIO]
+    if uvloop_available():
+        loops.append(LOOP_UVLOOP)
+    else:
+        print("uvloop is not installed, only the asyncio loop is measured")
+    for name in loops:
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_benchmark_relay_process, args=(port, ready, stop, results))
+        process.start()
+        ready.wait()
+        options = loadgen.parse_args([
+            "--port", str(port), "-p", str(publishers), "-s", str(subscribers),
+            "-d", str(seconds), "--video-bitrate", "2000000", "--loop", name,
+        ])
+        worker = loadgen.run_worker(loadgen.plan(options)[0])
+        stop.set()
+        results.get()
+        process.join()
+        devices = worker["devices"]
+        packets = sum(d["packets_sent"] + d["packets_received"] for d in devices)
+        lag = worker["loop_lag"]
+        received = sum(d["receive_rate"] for d in devices) * 8 / 1e6
+        print(f"{name:8s} {packets / seconds:.0f} packets/s, subscribers received {received:.1f} Mbit/s, "
+              f"loop lag p50 {loadgen.percentile(lag, 0.5) * 1000:.2f}ms p99 {loadgen.percentile(lag, 0.99) * 1000:.2f}ms "
+              f"max {max(lag) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    loop_benchmark()
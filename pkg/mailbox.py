@@ -0,0 +1,304 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import deque
+
+from pkg.log import get_logger
+
+log = get_logger("mailbox")
+
+
+class LatestMailbox:
+    """只保留最新值的邮箱
+
+    put 会覆盖还没被取走的旧值，get 总是拿到最新的一份。
+    只能在事件循环线程里调用。
+    """
+
+    def __init__(self):
+        self.value = None
+        self.has_value = False
+        self.event = asyncio.Event()
+        self.put_count = 0
+        self.get_count = 0
+        self.overwrite_count = 0
+
+    def put(self, value):
+        if self.has_value:
+            # 上一个值还没发出去就被新值替换
+            self.overwrite_count += 1
+        self.value = value
+        self.has_value = True
+        self.put_count += 1
+        self.event.set()
+
+    def get_nowait(self):
+        if not self.has_value:
+            return None
+        value = self.value
+        self.value = None
+        self.has_value = False
+        self.get_count += 1
+        return value
+
+    async def get(self):
+        while not self.has_value:
+            self.event.clear()
+            await self.event.wait()
+        return self.get_nowait()
+
+    def stats(self) -> dict:
+        return {
+            "put": self.put_count,
+            "sent": self.get_count,
+            "overwritten": self.overwrite_count,
+        }
+
+
+class LatestFrameMailbox:
+    """解码线程和界面线程之间只保留最新一帧
+
+    put 在解码线程调用，覆盖还没显示的旧帧并计数；get_nowait 在界面线程调用，不阻塞，没有新帧时返回None。
+    put 返回True表示邮箱原来是空的，调用方只在这时通知界面，界面忙或窗口最小化时通知和帧都不会堆积。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.has_frame = False
+        self.put_count = 0
+        self.get_count = 0
+        self.superseded_count = 0
+
+    def put(self, frame) -> bool:
+        with self.lock:
+            empty = not self.has_frame
+            if not empty:
+                # 上一帧还没显示就被新帧替换
+                self.superseded_count += 1
+            self.frame = frame
+            self.has_frame = True
+            self.put_count += 1
+        return empty
+
+    def get_nowait(self):
+        with self.lock:
+            if not self.has_frame:
+                return None
+            frame = self.frame
+            self.frame = None
+            self.has_frame = False
+            self.get_count += 1
+        return frame
+
+    def stats(self) -> dict:
+        return {
+            "decoded": self.put_count,
+            "displayed": self.get_count,
+            "superseded": self.superseded_count,
+        }
+
+
+class ThreadHandoff:
+    """从任意线程(例如Qt主线程)投递到事件循环线程，调用方不等待
+
+    put 只是append到deque，队列从空变为非空时才call_soon_threadsafe唤醒一次事件循环，
+    事件循环线程里批量调用 handler。handler 返回协程时作为任务运行。
+    callback 在事件循环线程里以 handler 的结果(出错时为异常对象)调用，没有 callback 时异常写入日志。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, handler):
+        self.loop = loop
+        self.handler = handler
+        self.items = deque()
+        self.scheduled = False
+        self.submit_count = 0
+        self.wakeup_count = 0
+
+    def put(self, item, callback=None):
+        self.items.append((item, callback))
+        self.submit_count += 1
+        if not self.scheduled:
+            self.scheduled = True
+            self.wakeup_count += 1
+            self.loop.call_soon_threadsafe(self.__drain)
+
+    def __drain(self):
+        # 先清标志再取数据，清标志之后投递的数据会触发新的唤醒
+        self.scheduled = False
+        while self.items:
+            item, callback = self.items.popleft()
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                if callback is None:
+                    log.exception("handoff %s failed", getattr(self.handler, "__name__", self.handler))
+                result = e
+            if asyncio.iscoroutine(result):
+                task = self.loop.create_task(result)
+                task.add_done_callback(functools.partial(self.__task_done, callback))
+            elif callback:
+                callback(result)
+
+    @staticmethod
+    def __task_done(callback, task: asyncio.Task):
+        if task.cancelled():
+            if callback:
+                callback(asyncio.CancelledError())
+            return
+        if callback:
+            callback(task.exception() or task.result())
+            return
+        try:
+            task.result()
+        except Exception:
+            log.exception("handoff task %s failed", task.get_coro().__qualname__)
+
+
+def test_latest_frame_mailbox(count=20000, display_interval=0.002):
+    """解码线程尽快put，界面线程只在收到通知时取帧且比解码慢，
+    检查邮箱里最多一帧、每一帧要么显示要么被替换，以及最后一帧一定会显示"""
+    mailbox = LatestFrameMailbox()
+    notify = threading.Semaphore(0)
+    displayed = []
+
+    def decode():
+        for i in range(count):
+            if mailbox.put(i):
+                notify.release()
+
+    def display():
+        while True:
+            notify.acquire()
+            frame = mailbox.get_nowait()
+            if frame is None:
+                continue
+            displayed.append(frame)
+            if frame == count - 1:
+                return
+            time.sleep(display_interval)
+
+    threads = [threading.Thread(target=decode), threading.Thread(target=display)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    stats = mailbox.stats()
+    assert displayed[-1] == count - 1, "newest frame not displayed"
+    assert displayed == sorted(displayed), "frames displayed out of order"
+    assert stats["displayed"] + stats["superseded"] == count, stats
+    assert mailbox.get_nowait() is None
+    print(f"latest frame mailbox: {stats}")
+
+
+def test_handoff_errors():
+    """handler 抛出异常或返回的协程失败时: 有 callback 交给 callback，没有 callback 时写入日志"""
+    from pkg.log import clear, dump
+
+    loop = asyncio.new_event_loop()
+    results = []
+
+    def handler(item):
+        if item == "raise":
+            raise ValueError("payload too large")
+        async def fail():
+            raise AttributeError("writer not set up")
+        return fail()
+
+    handoff = ThreadHandoff(loop, handler)
+    clear()
+    try:
+        for item in ("raise", "task"):
+            handoff.put(item)
+            handoff.put(item, results.append)
+        loop.run_until_complete(asyncio.sleep(0.05))
+    finally:
+        loop.close()
+    assert [type(result) for result in results] == [ValueError, AttributeError]
+    text = dump()
+    assert "handoff handler failed" in text and "<locals>.fail failed" in text, text
+    print("handoff errors ok")
+
+
+def ui_jitter_benchmark(seconds=5, busy_ms=1, drain_ms=3):
+    """测量Qt事件循环卡顿: run_coroutine_threadsafe().result() 对比 ThreadHandoff
+
+    asyncio线程模拟QUIC收包处理，每5ms占用 busy_ms 毫秒CPU，每次发送等待 drain_ms 毫秒；
+    Qt线程以30fps投递16KB视频数据、20Hz投递控制数据，
+    同时用5ms的QTimer统计实际间隔相对期望值的延迟。
+    """
+    from PyQt5.QtCore import QCoreApplication, QTimer
+
+    app = QCoreApplication.instance() or QCoreApplication([])
+    video = bytes(16 * 1024)
+    control = list(range(10))
+
+    def run(mode):
+        loop = asyncio.new_event_loop()
+        sent = []
+
+        async def send(item):
+            sent.append(item)
+            await asyncio.sleep(drain_ms / 1000)
+
+        async def busy():
+            while True:
+                end = time.perf_counter() + busy_ms / 1000
+                while time.perf_counter() < end:
+                    pass
+                await asyncio.sleep(0.005)
+
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        asyncio.run_coroutine_threadsafe(busy(), loop)
+        handoff = ThreadHandoff(loop, send)
+
+        def submit(item):
+            if mode == "blocking":
+                asyncio.run_coroutine_threadsafe(send(item), loop).result()
+            else:
+                handoff.put(item)
+
+        lateness = []
+        last = [time.perf_counter()]
+        def tick():
+            now = time.perf_counter()
+            lateness.append(max(0.0, now - last[0] - 0.005))
+            last[0] = now
+
+        timers = []
+        for interval, item in ((5, None), (33, video), (50, control)):
+            timer = QTimer()
+            timer.setInterval(interval)
+            timer.timeout.connect(tick if item is None else (lambda item=item: submit(item)))
+            timer.start()
+            timers.append(timer)
+        QTimer.singleShot(seconds * 1000, app.quit)
+        app.exec_()
+        for timer in timers:
+            timer.stop()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+        async def cancel_all():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        loop.run_until_complete(cancel_all())
+        loop.close()
+
+        lateness.sort()
+        p99 = lateness[int(len(lateness) * 0.99)] * 1000
+        print(f"{mode:8s} submitted {len(sent)} ui ticks {len(lateness)} "
+              f"stall p99 {p99:.2f}ms max {lateness[-1]*1000:.2f}ms total {sum(lateness)*1000:.0f}ms")
+
+    for mode in ("blocking", "handoff"):
+        run(mode)
+
+
+if __name__ == "__main__":
+    test_latest_frame_mailbox()
+    test_handoff_errors()
+    ui_jitter_benchmark()
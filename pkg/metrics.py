@@ -0,0 +1,253 @@
+import math
+import time
+
+from pkg.scheduler import stream_unsent_bytes
+
+
+class ConnectionTimeline:
+    """一次连接过程中各个阶段相对开始连接的耗时(毫秒)
+
+    每个阶段只记录第一次，重连时调用 start 重新开始。
+    """
+
+    def __init__(self):
+        self.start_time = None
+        self.events = {}
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.events = {}
+
+    def mark(self, name, at=None) -> bool:
+        if self.start_time is None or name in self.events:
+            return False
+        self.events[name] = round(((at or time.monotonic()) - self.start_time) * 1000, 1)
+        return True
+
+    def snapshot(self) -> dict:
+        return dict(self.events)
+
+
+# StreamMetrics.sample() 每个流返回的累计计数
+STREAM_COUNTERS = ("sent_bytes", "received_bytes", "sent_messages", "received_messages",
+                   "resyncs", "crc_mismatches", "drains", "drain_time")
+
+
+class StreamMetrics:
+    """按流名称(video/audio/control/file)登记 FrameReader/FrameWriter 的注册表
+
+    收发路径上只有读写对象自己已有的整数计数，不额外加锁或加字典查找；
+    sample() 被调用时才遍历汇总，并计算与上一次采样之间的速率。
+    关闭的读写对象调用 remove 后，计数并入所在的流，累计值不会回退。
+    """
+
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+        # 已移除的读写对象和 datagram 等不经过FrameWriter的计数
+        self.retired = {}
+        self.last = {}
+        self.last_time = None
+
+    def add_reader(self, name, frame_reader):
+        self.readers[frame_reader] = name
+
+    def add_writer(self, name, frame_writer):
+        self.writers[frame_writer] = name
+
+    def count(self, name, counter, value=1):
+        totals = self.retired.setdefault(name, dict.fromkeys(STREAM_COUNTERS, 0))
+        totals[counter] += value
+
+    def remove(self, obj):
+        """读写对象关闭时调用，保留它的累计计数"""
+        for registry, sample in ((self.readers, self.__reader_counters), (self.writers, self.__writer_counters)):
+            name = registry.pop(obj, None)
+            if name is not None:
+                for counter, value in sample(obj).items():
+                    self.count(name, counter, value)
+
+    def clear(self):
+        for obj in list(self.readers) + list(self.writers):
+            self.remove(obj)
+
+    @staticmethod
+    def __reader_counters(frame_reader) -> dict:
+        decoder = frame_reader.decoder
+        return {
+            "received_bytes": frame_reader.read_bytes,
+            "received_messages": frame_reader.message_count,
+            "resyncs": decoder.resync_count,
+            "crc_mismatches": decoder.crc_mismatch_count,
+        }
+
+    @staticmethod
+    def __writer_counters(frame_writer) -> dict:
+        return {
+            "sent_bytes": frame_writer.write_bytes,
+            "sent_messages": frame_writer.message_count - frame_writer.pending_count,
+            "drains": frame_writer.drain_count,
+            "drain_time": frame_writer.drain_time,
+        }
+
+    def sample(self, now=None) -> dict:
+        """返回 {流名称: 计数}，包括累计值、距上次采样的速率(字节/秒、条/秒)和当前写队列深度"""
+        now = time.monotonic() if now is None else now
+        streams = {name: dict(totals) for name, totals in self.retired.items()}
+        queues = {}
+        for registry, sample in ((self.readers, self.__reader_counters), (self.writers, self.__writer_counters)):
+            for obj, name in registry.items():
+                totals = streams.setdefault(name, dict.fromkeys(STREAM_COUNTERS, 0))
+                for counter, value in sample(obj).items():
+                    totals[counter] += value
+                if registry is self.writers:
+                    # FrameWriter里排队的 + 已交给aioquic还没发出的
+                    queues[name] = queues.get(name, 0) + obj.pending_bytes + stream_unsent_bytes(obj.writer)
+        elapsed = now - self.last_time if self.last_time is not None else 0
+        result = {}
+        for name, totals in streams.items():
+            last = self.last.get(name, {})
+            stats = dict(totals)
+            stats["drain_time_ms"] = round(stats.pop("drain_time") * 1000, 1)
+            stats["queue_bytes"] = queues.get(name, 0)
+            for counter, rate in (("sent_bytes", "send_rate"), ("received_bytes", "receive_rate"),
+                                  ("sent_messages", "send_message_rate"), ("received_messages", "receive_message_rate")):
+                stats[rate] = (totals[counter] - last.get(counter, 0)) / elapsed if elapsed > 0 else 0.0
+            drains = totals["drains"] - last.get("drains", 0)
+            # 这段时间里每次drain的平均等待(毫秒)，持续升高说明这个流在对端或拥塞控制上堵住了
+            stats["drain_ms"] = round((totals["drain_time"] - last.get("drain_time", 0)) * 1000 / drains, 2) if drains else 0.0
+            result[name] = stats
+        self.last = streams
+        self.last_time = now
+        return result
+
+
+class LatencyHistogram:
+    """固定内存的对数分桶延迟直方图(HDR风格)
+
+    [lowest, highest] 毫秒之间每翻一倍分 sub_buckets 个桶，相对误差不超过 2^(1/sub_buckets)-1，
+    低于 lowest 的值(包括时钟偏差造成的负值)进第一个桶，高于 highest 的进最后一个桶，max/min 精确记录。
+    """
+
+    def __init__(self, lowest=0.1, highest=60000.0, sub_buckets=8):
+        self.lowest = lowest
+        self.highest = highest
+        self.sub_buckets = sub_buckets
+        self.counts = [0] * (int(math.log2(highest / lowest) * sub_buckets) + 2)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.max = None
+        self.min = None
+
+    def index(self, value) -> int:
+        if value < self.lowest:
+            return 0
+        return min(int(math.log2(value / self.lowest) * self.sub_buckets) + 1, len(self.counts) - 1)
+
+    def value(self, index) -> float:
+        """桶的上边界"""
+        return self.lowest * 2 ** (index / self.sub_buckets)
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        if other.count:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+            self.min = other.min if self.min is None else min(self.min, other.min)
+
+    def percentile(self, q) -> float:
+        """q在0~1之间，返回所在桶的上边界，不超过实际的max"""
+        if not self.count:
+            return 0.0
+        target = max(math.ceil(self.count * q), 1)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.value(i), self.max) if i else min(self.lowest, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "p50": round(self.percentile(0.5), 1),
+            "p95": round(self.percentile(0.95), 1),
+            "p99": round(self.percentile(0.99), 1),
+            "max": round(self.max, 1) if self.count else 0.0,
+        }
+
+    def export(self) -> dict:
+        """可以JSON序列化，只保存非空的桶"""
+        return {
+            "lowest": self.lowest,
+            "highest": self.highest,
+            "sub_buckets": self.sub_buckets,
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "buckets": {round(self.value(i), 3): count for i, count in enumerate(self.counts) if count},
+        }
+
+
+class LatencyRecorder:
+    """按名称(video/audio/control)分别保存本周期和累计的延迟直方图"""
+
+    def __init__(self, names=("video", "audio", "control")):
+        self.interval = {name: LatencyHistogram() for name in names}
+        self.total = {name: LatencyHistogram() for name in names}
+
+    def record(self, name, value):
+        self.interval[name].record(value)
+
+    def sample(self) -> dict:
+        """返回各名称本周期和累计的 p50/p95/p99/max，并开始新的周期"""
+        result = {}
+        for name, histogram in self.interval.items():
+            self.total[name].merge(histogram)
+            result[name] = {"interval": histogram.summary(), "total": self.total[name].summary()}
+            histogram.reset()
+        return result
+
+    def export(self) -> dict:
+        return {name: histogram.export() for name, histogram in self.total.items()}
+
+
+def test_latency_histogram(count=100000, seed=0):
+    """对数正态分布的延迟，直方图的分位数和排序后精确计算的分位数相差不超过一个桶"""
+    import random
+
+    rnd = random.Random(seed)
+    values = [rnd.lognormvariate(3.5, 0.6) for _ in range(count)] + [rnd.uniform(500, 2000) for _ in range(count // 100)]
+    histogram = LatencyHistogram()
+    half = LatencyHistogram()
+    for i, value in enumerate(values):
+        (histogram if i % 2 else half).record(value)
+    histogram.merge(half)
+    values.sort()
+    error = 2 ** (1 / histogram.sub_buckets)
+    for q in (0.5, 0.95, 0.99, 0.999):
+        exact = values[math.ceil(len(values) * q) - 1]
+        estimate = histogram.percentile(q)
+        print(f"p{q * 100:g}: exact {exact:.1f}ms histogram {estimate:.1f}ms")
+        assert exact <= estimate * 1.0001 and estimate <= exact * error, (q, exact, estimate)
+    assert histogram.max == values[-1] and histogram.count == len(values)
+    histogram.record(-3.0)
+    assert histogram.percentile(0) <= histogram.lowest
+    print(f"{len(histogram.counts)} buckets, summary {histogram.summary()}")
+
+
+if __name__ == "__main__":
+    test_latency_histogram()
@@ -1,49 +1,35 @@
 import asyncio
-import logging
+import functools
 import ssl
 from typing import cast, List
-from pkg.codec import H264Encoder,H264Decoder
+from pkg.codec import H264Encoder,H264Decoder,DECODE_LOW_LATENCY,DECODE_CONTAINER
 from aioquic.asyncio.client import connect
 from aioquic.asyncio.protocol import QuicConnectionProtocol
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import QuicEvent,ConnectionTerminated
-from PyQt5.QtCore import QObject,pyqtSignal
+from aioquic.quic.events import QuicEvent,ConnectionTerminated,ProtocolNegotiated,DatagramFrameReceived,HandshakeCompleted
+from PyQt5.QtCore import QObject,pyqtSignal,Qt
 from google.protobuf.message import Message
 from protocol.highway_pb2 import Register,Device,Control,Video,File,Audio
 import time
 import threading
-from asyncio import Queue
+from pkg.mailbox import LatestMailbox,ThreadHandoff
 import os
 from pkg.audio import AudioEncoder,AudioPlayer
 import numpy as np
-def generate_crc8_table():
-    crc8_table = [0] * 256
-    for i in range(256):
-        crc = i
-        for j in range(8):
-            if crc & 0x80:
-                crc = ((crc << 1) & 0xFF) ^ 0x07
-            else:
-                crc = (crc << 1) & 0xFF
-        crc8_table[i] = crc
-    return crc8_table
-
-def calculate_crc_fast(data: int) -> int:
-    crc = 0
-    # 获取低字节和高字节
-    low_byte = data & 0xFF
-    high_byte = (data >> 8) & 0xFF
-    
-    # 使用查表法计算CRC8
-    crc = CRC8_TABLE[crc ^ low_byte]
-    crc = CRC8_TABLE[crc ^ high_byte]
-    
-    return crc
-
-
-logger = logging.getLogger("quic")
-# 生成全局查找表
-CRC8_TABLE = generate_crc8_table()
+from pkg.scheduler import SendScheduler,stream_unacked_bytes
+from pkg.metrics import ConnectionTimeline,StreamMetrics,LatencyRecorder
+from pkg.trace import BackgroundQlogLogger,MessageTrace,DIRECTION_SEND,DIRECTION_RECEIVE
+import json
+from pkg.wire import decode_message,write_message as write_payload_message
+from pkg.loop import new_event_loop,loop_name,LOOP_ASYNCIO
+from pkg.upload import BlockUploader,UploadState,UPLOAD_STATE_FILE,BLOCK_SIZE,WINDOW
+from pkg.ratecontrol import RateController,quic_congestion_state,CONTROL_INTERVAL,DEFAULT_BITRATE,MIN_BITRATE,MAX_BITRATE
+from pkg.session import SessionTicketCache,SESSION_TICKET_FILE,early_data_allowed
+from pkg.datagram import encode_control_datagram,decode_control_datagram,datagram_supported,datagram_fits,DeviceSequenceFilter,initial_seq,MAX_DATAGRAM_FRAME_SIZE
+from pkg.frame import FrameReader,FrameWriter,Frame,FLUSH_DELAY,FLUSH_BYTES,V1_MAX_PAYLOAD,FLAG_KEYFRAME,FLAG_END_OF_AU,FLAG_TIMESYNC,frame_version,alpn_protocols
+from pkg.log import get_logger,configure as configure_log,dump as dump_recent_log,RING_SIZE,INFO
+from pkg.clock import ClockEstimator,TIMESYNC_REQUEST,TIMESYNC_RESPONSE,TIMESYNC_MAX_UNANSWERED,timesync_interval,decode_timesync,encode_timesync,timesync_request,timesync_response,now_us
+log = get_logger("quic")
 
 
 class HighwayClientProtocol(QuicConnectionProtocol,QObject):
@@ -51,9 +37,26 @@ class HighwayClientProtocol(QuicConnectionProtocol,QObject):
     def __init__(self, *args, **kwargs) -> None:
         QuicConnectionProtocol.__init__(self, *args, **kwargs)
         QObject.__init__(self)
+        self.alpn_protocol=None
+        self.early_data_accepted=False
+        # datagram在事件循环线程里直接回调，不经过Qt信号
+        self.datagram_handler=None
+        # 每收到一个UDP包置位，确认(ACK)只会随收到的包到达
+        self.packet_received=asyncio.Event()
+
+    def datagram_received(self, data, addr) -> None:
+        super().datagram_received(data, addr)
+        self.packet_received.set()
 
     def quic_event_received(self, event: QuicEvent) -> None:
-        if isinstance(event, ConnectionTerminated):
+        if isinstance(event, DatagramFrameReceived):
+            if self.datagram_handler:
+                self.datagram_handler(event.data)
+        elif isinstance(event, ProtocolNegotiated):
+            self.alpn_protocol=event.alpn_protocol
+        elif isinstance(event, HandshakeCompleted):
+            self.early_data_accepted=event.early_data_accepted
+        elif isinstance(event, ConnectionTerminated):
             self.quic_connection_lost.emit()
         return super().quic_event_received(event)
 
@@ -66,121 +69,195 @@ class HighwayQuicClient(QObject):
     upload_speed = pyqtSignal(float)
     download_speed = pyqtSignal(float)
     latency = pyqtSignal(int)
+    latency_stats = pyqtSignal(dict)
+    scheduler_stats = pyqtSignal(dict)
+    stream_stats = pyqtSignal(dict)
+    control_stats = pyqtSignal(dict)
+    connection_timeline = pyqtSignal(dict)
     file_send_progress = pyqtSignal(str,int)
     
     video_stream_failed = pyqtSignal(str)
     control_stream_failed = pyqtSignal(str)
+    receive_control = pyqtSignal(list)
     input_wave_data = pyqtSignal(np.ndarray)
     
     
     def __init__(self, setting) -> None:
         super().__init__()
         self.setting=setting
+        # log_level 控制台输出级别，log_ring_level 以上的事件保留在内存里，dump_log 写出
+        # 每包/每帧的日志是debug级别，默认关闭
+        configure_log(
+            level=self.setting.get("log_level","info"),
+            ring_level=self.setting.get("log_ring_level","info"),
+            ring_size=self.setting.get("log_ring_size",RING_SIZE)
+        )
         self.client = None
         self.reader = None
         self.writer = None
         self.loop = None
         self.running = False
-        self.upload_bytes = 0
-        self.download_bytes = 0
-        self.decoder=H264Decoder()
+        # 按流(video/audio/control/file)统计字节、消息、重同步、写队列和drain耗时
+        self.stream_metrics=StreamMetrics()
+        # decode_threads=0 按CPU核数；decode_thread_type: low_latency(只用slice线程) / slice / frame / auto / none
+        # decode_mode: container(av.open探测+解复用) / packet(直接解析Video.raw，每个访问单元到达即解码)
+        self.decoder=H264Decoder(
+            threads=self.setting.get("decode_threads",0),
+            thread_type=self.setting.get("decode_thread_type",DECODE_LOW_LATENCY),
+            mode=self.setting.get("decode_mode",DECODE_CONTAINER)
+        )
         self.decoder.frame_decoded.connect(self.receive_video.emit)
+        self.decoder.frame_decoded.connect(self.frame_decoded,Qt.DirectConnection)
+        # 从开始连接到各个流注册、收到第一帧的时间线
+        self.timeline=ConnectionTimeline()
         
-        self.control_stream_queue=Queue()
-        self.latency_sum=0
-        self.latency_count=0
+        # 只保留最新的控制消息，发送慢于生产时旧值直接被覆盖
+        self.control_mailbox=LatestMailbox()
+        # 每个连接重新开始，见 pkg.datagram.initial_seq
+        self.control_seq=initial_seq()
+        self.control_seq_filter=DeviceSequenceFilter()
+        self.frame_readers={}
+        self.frame_writers={}
+        # 控制 > 音频 > 视频 > 文件，实时流有数据时暂停低优先级流
+        self.scheduler=SendScheduler(
+            mode=self.setting.get("send_scheduling","strict"),
+            priorities=self.setting.get("send_priorities"),
+            weights=self.setting.get("send_weights")
+        )
+        # 视频/音频: 发送端时间戳到收到的延迟；控制: 输入到交给传输层的延迟
+        self.latencies=LatencyRecorder(("video","audio","control"))
+        # 对端(source_device_id)时钟相对本地的偏差，用于修正基于时间戳的延迟
+        self.clock=ClockEstimator()
+        # 连续没有应答的时钟同步探测数
+        self.timesync_unanswered=0
         # QUIC configuration
-        self.configuration = QuicConfiguration(alpn_protocols=["HLD"], is_client=True)
+        # 优先协商v3(v2帧格式+带外payload)，对端不支持时依次回退到v2、v1
+        self.configuration = QuicConfiguration(alpn_protocols=alpn_protocols(self.setting.get("framing_version",3)), is_client=True)
         if self.setting.get("insecure",True):
             self.configuration.verify_mode = ssl.CERT_NONE
+        # 保存session ticket，重连时用0-RTT直接发送register
+        self.session_tickets=SessionTicketCache(self.setting.get("session_ticket_file",SESSION_TICKET_FILE))
+        # 控制消息走不可靠datagram，避免丢包重传阻塞后续的摇杆数据
+        self.control_datagram=self.setting.get("control_datagram",False)
+        if self.control_datagram:
+            self.configuration.max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE
+        # 现场排查: qlog_dir 每个连接写一个qlog，trace_file 记录每条帧消息，都在后台线程写入
+        self.qlog_dir=self.setting.get("qlog_dir")
+        if self.qlog_dir:
+            os.makedirs(self.qlog_dir,exist_ok=True)
+            self.configuration.quic_logger=BackgroundQlogLogger(self.qlog_dir)
+        self.message_trace=None
         self.video_stream_failed.connect(self.reconnect_video_stream)
         self.control_stream_failed.connect(self.reconnect_control_stream)
         
-        self.video_encoder=H264Encoder()
+        self.video_encoder=H264Encoder(bitrate=self.setting.get("video_bitrate",DEFAULT_BITRATE))
         self.video_encoder.frame_encoded.connect(self.send_video_test_data)
+        # 根据拥塞状态和发送队列调整编码码率
+        self.rate_controller=None
+        if self.setting.get("adaptive_bitrate",True):
+            self.rate_controller=RateController(
+                bitrate=self.setting.get("video_bitrate",DEFAULT_BITRATE),
+                min_bitrate=self.setting.get("video_min_bitrate",MIN_BITRATE),
+                max_bitrate=self.setting.get("video_max_bitrate",MAX_BITRATE),
+            )
         
         self.audio_encoder=AudioEncoder(format="g726")
         self.audio_player=AudioPlayer(format="g726")
         
         self.tasks: List[asyncio.Task] = []
         
+        # 等待上传的文件，已确认的块记录在upload_state里
+        self.upload_state=UploadState(self.setting.get("upload_state_file",UPLOAD_STATE_FILE))
+        self.pending_uploads=[]
+        self.upload_task=None
+        
     
     def change_video_format(self,format):
         self.decoder.change_format(format)
 
     def reconnect_video_stream(self):
-        print("reconnect video stream")
+        log.info("reconnect video stream")
         if self.client:
             self.tasks.append(self.loop.create_task(self.establish_video_stream()))
 
     def reconnect_control_stream(self):
-        print("reconnect control stream")
+        log.info("reconnect control stream")
         if self.client:
             self.tasks.append(self.loop.create_task(self.establish_control_stream()))
 
-    async def send_message(self,writer:asyncio.StreamWriter,message:Message,flush=True):
-         # 序列化消息
+    @property
+    def frame_version(self)->int:
+        if self.client is None:
+            return 1
+        return frame_version(self.client.alpn_protocol)
+
+    def frame_writer(self,writer:asyncio.StreamWriter,message_type=None)->FrameWriter:
+        frame_writer=self.frame_writers.get(writer)
+        if frame_writer is None:
+            frame_writer=FrameWriter(
+                writer,
+                delay=self.setting.get("write_delay_ms",FLUSH_DELAY*1000)/1000,
+                max_bytes=self.setting.get("write_max_bytes",FLUSH_BYTES),
+                version=self.frame_version,
+                scheduler=self.scheduler if message_type is not None else None,
+                message_type=message_type
+            )
+            self.frame_writers[writer]=frame_writer
+            if message_type is not None:
+                self.stream_metrics.add_writer(Device.MessageType.Name(message_type).lower(),frame_writer)
+                if self.message_trace:
+                    frame_writer.trace=self.message_trace.recorder(message_type,writer.get_extra_info("stream_id") or 0,DIRECTION_SEND)
+        return frame_writer
+
+    def frame_reader(self,reader:asyncio.StreamReader,message_type=None,stream_id=0)->FrameReader:
+        # 每个reader对应一个按块读取的FrameReader，保留跨消息的缓冲数据
+        frame_reader=self.frame_readers.get(reader)
+        if frame_reader is None:
+            frame_reader=FrameReader(reader,version=self.frame_version)
+            self.frame_readers[reader]=frame_reader
+            if message_type is not None:
+                self.stream_metrics.add_reader(Device.MessageType.Name(message_type).lower(),frame_reader)
+                if self.message_trace:
+                    frame_reader.trace=self.message_trace.recorder(message_type,stream_id,DIRECTION_RECEIVE)
+        return frame_reader
+
+    def write_message(self,writer:asyncio.StreamWriter,message:Message,flags=0)->FrameWriter:
+        """序列化后排队合并写入，不等待"""
         data = message.SerializeToString()
-        
-        # 构建header
-        length = len(data)
-        crc = calculate_crc_fast(length)
-        header = bytes([
-            0xff,
-            crc,
-            length & 0xFF,
-            (length >> 8) & 0xFF
-        ])
-        
-        # 发送header和数据
-        writer.write(header + data)
+        frame_writer=self.frame_writer(writer)
+        frame_writer.write(data,flags)
+        return frame_writer
+
+    def write_payload(self,writer:asyncio.StreamWriter,message:Message,payload,flags=0)->FrameWriter:
+        """message不带payload字段，payload不经过protobuf序列化，对端支持时作为带外数据写入"""
+        frame_writer=self.frame_writer(writer)
+        write_payload_message(frame_writer,message,payload,flags)
+        return frame_writer
 
+    async def send_message(self,writer:asyncio.StreamWriter,message:Message,flush=True,flags=0):
+        # header和数据排队合并写入，flush=True时立即写出并drain
+        frame_writer=self.write_message(writer,message,flags)
         if flush:
-            await writer.drain()
-        self.upload_bytes+=len(header+data)
+            await frame_writer.flush()
         
-    async def receive_message(self,reader:asyncio.StreamReader):
-         # 创建4字节的header缓冲区
-        header = bytearray(4)
-        remain_size=3
-        # 读取直到找到0xff起始位
-        while True:
-            b = await reader.readexactly(1)
-            self.download_bytes+=1
-            if b[0] == 0xff:
-                header[0] = b[0]
-                # 读取剩余3个字节
-                remain_size=3
-                while True:
-                    remaining = await reader.readexactly(remain_size)
-                    header[4-remain_size:] = remaining
-                    self.download_bytes+=remain_size
+    def mark_timeline(self,name,at=None):
+        if self.timeline.mark(name,at):
+            log.info("connection timeline: %s",self.timeline.snapshot())
+            self.connection_timeline.emit(self.timeline.snapshot())
 
-                    
-                    # 获取长度并验证CRC
-                    length = (header[2]&0xff | (header[3]&0xff)<<8)
-                    check_crc = calculate_crc_fast(length)
-                    
-                    # CRC匹配则退出循环
-                    if check_crc == header[1]:
-                        print("crc match ",length)
-                        # 读取消息体
-                        data = await reader.readexactly(length)
-                        self.download_bytes+=length
-                        return data
-                    # [ff,a,ff,b]
-                    # [ff,b]   i=2  
-                    has_ff=False
-                    for i in range(1, 4):
-                        if header[i] == 0xff:
-                            has_ff=True
-                            # 移动数据
-                            for j in range(0, 4-i):
-                                header[j] = header[j+i]
-                            remain_size=i
-                            break
-                    if not has_ff:
-                        break
+    def frame_decoded(self):
+        # 在解码线程里直接调用，记录第一帧解码完成的时间
+        if "first_decoded_frame" not in self.timeline.events:
+            self.mark_timeline("first_decoded_frame")
+
+    async def receive_frame(self,reader:asyncio.StreamReader)->Frame:
+        frame=await self.frame_reader(reader).read_frame()
+        log.every("receive_frame","crc match %d",len(frame.payload))
+        return frame
+
+    async def receive_message(self,reader:asyncio.StreamReader):
+        frame=await self.receive_frame(reader)
+        return frame.payload
                         
     def start(self):
         """Start the client in a new thread"""
@@ -188,7 +265,16 @@ class HighwayQuicClient(QObject):
             return
             
         self.running = True
-        self.loop = asyncio.new_event_loop()
+        # setting.json 的 event_loop: asyncio / uvloop / auto，uvloop没安装时回退到asyncio
+        self.loop = new_event_loop(self.setting.get("event_loop",LOOP_ASYNCIO))
+        log.info("event loop: %s",loop_name(self.loop))
+        if self.setting.get("trace_file") and self.message_trace is None:
+            self.message_trace=MessageTrace(self.setting["trace_file"])
+        if self.setting.get("secrets_log_file") and self.configuration.secrets_log_file is None:
+            self.configuration.secrets_log_file=open(self.setting["secrets_log_file"],"a")
+        # Qt线程投递数据到事件循环，不阻塞界面
+        self.control_handoff=ThreadHandoff(self.loop,self.control_mailbox.put)
+        self.video_handoff=ThreadHandoff(self.loop,self.queue_video)
         
         # Start event loop in new thread
         self.run_thread= threading.Thread(
@@ -210,15 +296,15 @@ class HighwayQuicClient(QObject):
         if self.client:
             self.client.close()
             asyncio.run_coroutine_threadsafe(self.client.wait_closed(),self.loop).result()
-            print("client closed")
+            log.info("client closed")
         self.video_encoder.close()
-        print("video encoder closed")
+        log.info("video encoder closed")
         self.audio_encoder.close()
-        print("audio encoder closed")
+        log.info("audio encoder closed")
         self.decoder.close()
-        print("decoder closed")
+        log.info("decoder closed")
         self.audio_player.close()
-        print("audio player closed")
+        log.info("audio player closed")
         
         
         self.clear_tasks()
@@ -226,25 +312,55 @@ class HighwayQuicClient(QObject):
         if self.loop and self.loop.is_running():
             self.loop.call_soon_threadsafe(self.loop.stop)
         
-        print("loop stop")
+        log.info("loop stop")
         # Wait for the thread to finish
         if self.run_thread:
             self.run_thread.join()
-        print("thread quit")
+        log.info("thread quit")
         # Close the loop if it's not already closed
         if self.loop and not self.loop.is_closed():
             self.loop.close()
-            print("loop close")
+            log.info("loop close")
+        if self.message_trace:
+            self.message_trace.close()
+            self.message_trace=None
+        if self.configuration.quic_logger:
+            self.configuration.quic_logger.close()
+        if self.configuration.secrets_log_file:
+            self.configuration.secrets_log_file.close()
+            self.configuration.secrets_log_file=None
 
     async def __update_speed(self):
         while self.running:
-            print(f"Network stats - Upload: {self.upload_bytes} bytes, Download: {self.download_bytes} bytes")
-            self.upload_speed.emit(self.upload_bytes)
-            self.download_speed.emit(self.download_bytes)
-            self.upload_bytes = 0
-            self.download_bytes = 0
+            streams=self.stream_metrics.sample()
+            upload=sum(stats["send_rate"] for stats in streams.values())
+            download=sum(stats["receive_rate"] for stats in streams.values())
+            log.debug("Network stats - Upload: %.0f bytes/s, Download: %.0f bytes/s",upload,download)
+            control={**self.control_mailbox.stats(),"stale":self.control_seq_filter.stale,"restarts":self.control_seq_filter.restarts}
+            log.debug("Control stats - %s",control)
+            log.debug("Display stats - %s",self.decoder.display_stats())
+            self.upload_speed.emit(upload)
+            self.download_speed.emit(download)
+            self.stream_stats.emit(streams)
+            self.control_stats.emit(control)
+            self.scheduler_stats.emit(self.scheduler.stats())
             await asyncio.sleep(1)
     
+    async def __rate_control(self):
+        if self.rate_controller is None:
+            return
+        while self.running:
+            await asyncio.sleep(CONTROL_INTERVAL)
+            if not self.client:
+                continue
+            rtt,cwnd,bytes_in_flight=quic_congestion_state(self.client)
+            # 本地排队: 编码器输出队列 + FrameWriter和aioquic里还没发出的视频
+            frame_bytes=self.rate_controller.bitrate/8/30
+            queue_bytes=self.scheduler.backlog(Device.MessageType.VIDEO)+int(self.video_encoder.queue_size()*frame_bytes)
+            target=self.rate_controller.update(rtt,cwnd,bytes_in_flight,queue_bytes)
+            if self.video_encoder.set_target(*target):
+                log.every("rate_control","rate control: %s encoder: %s",self.rate_controller.stats(),self.video_encoder.reconfig_stats(),level=INFO)
+
     def _run_event_loop(self):
         """Run the event loop in a separate thread"""
         asyncio.set_event_loop(self.loop)
@@ -258,7 +374,7 @@ class HighwayQuicClient(QObject):
             self.loop.close()
 
     def connection_lost(self):
-        print("connection lost")
+        log.warning("connection lost")
         self.running=False
         self.client=None
         self.connection_error.emit("quic lost")
@@ -268,31 +384,66 @@ class HighwayQuicClient(QObject):
             if not task.done():
                 task.cancel()
         self.tasks=[]
+
+    def clear_streams(self):
+        for frame_writer in self.frame_writers.values():
+            frame_writer.close()
+        self.stream_metrics.clear()
+        self.frame_writers={}
+        self.frame_readers={}
     
     async def run(self):
         """Establish QUIC connection"""
        
         while self.running:
             try:
-                
-                print("connecting quic server, running",self.running)
+                host=self.setting.get("host","127.0.0.1")
+                port=self.setting.get("port",30042)
+                ticket,ticket_alpn=self.session_tickets.get(host,port)
+                early_data=early_data_allowed(ticket)
+                self.configuration.session_ticket=ticket
+                self.timeline.start()
+                log.info("connecting quic server %s:%d, 0-rtt %s",host,port,early_data)
                 async with connect(
-                    self.setting.get("host","127.0.0.1"),
-                    self.setting.get("port",30042),
+                    host,
+                    port,
                     configuration=self.configuration,
                     create_protocol=HighwayClientProtocol,
+                    session_ticket_handler=self.session_tickets.handler(host,port,lambda:self.client.alpn_protocol if self.client else None),
+                    wait_connected=not early_data,
                 ) as client:
-                    print("connected quic server")
                     self.client = cast(HighwayClientProtocol, client)
-                    
+                    if early_data:
+                        # 握手完成前沿用上次协商的帧格式，register作为0-RTT数据发送
+                        self.client.alpn_protocol=ticket_alpn
                     self.client.quic_connection_lost.connect(self.connection_lost)
-                    self.connected.emit()
+                    self.client.datagram_handler=self.datagram_received
+                    # 新连接: 序号重新开始，对端也可能已经重启
+                    self.control_seq=initial_seq()
+                    self.control_seq_filter.reset()
                     self.tasks.append(self.loop.create_task(self.__update_speed()))
                     self.tasks.append(self.loop.create_task(self.__metric_collect()))
-                    self.tasks.append(self.loop.create_task(self.establish_video_stream()))
-                    self.tasks.append(self.loop.create_task(self.establish_control_stream()))
-                    self.tasks.append(self.loop.create_task(self.establish_file_stream()))
-                    self.tasks.append(self.loop.create_task(self.establish_audio_stream()))
+                    self.tasks.append(self.loop.create_task(self.__rate_control()))
+                    if early_data:
+                        self.tasks.append(self.loop.create_task(self.establish_streams()))
+                        await asyncio.sleep(0)
+                        client.transmit()
+                        await client.wait_connected()
+                        self.mark_timeline("handshake_done")
+                        if not self.client.early_data_accepted and self.client.alpn_protocol!=ticket_alpn:
+                            # 0-RTT被拒绝且帧格式变了，按新格式重新建立所有流
+                            log.info("0-rtt rejected, re-establish streams")
+                            self.clear_tasks()
+                            self.clear_streams()
+                            self.tasks.append(self.loop.create_task(self.__update_speed()))
+                            self.tasks.append(self.loop.create_task(self.__metric_collect()))
+                            self.tasks.append(self.loop.create_task(self.__rate_control()))
+                            self.tasks.append(self.loop.create_task(self.establish_streams()))
+                    else:
+                        self.mark_timeline("handshake_done")
+                        self.tasks.append(self.loop.create_task(self.establish_streams()))
+                    log.info("connected quic server")
+                    self.connected.emit()
                     # Keep connection alive
                     while self.running:
                         # Check if client is still connected
@@ -301,15 +452,31 @@ class HighwayQuicClient(QObject):
                     
                         
             except Exception as e:
-                print("connect error:",e)
+                log.warning("connect error: %r",e)
                 self.client.close()
                 await self.client.wait_closed()
                 self.clear_tasks()
-                print("tasks cleared!")
+                self.clear_streams()
+                log.info("tasks cleared")
 
         
     
-    async def establish_file_stream(self):
+    async def establish_streams(self):
+        """同时建立所有流: 先排队全部register，一起写出后只drain一次"""
+        await asyncio.gather(
+            self.establish_video_stream(flush=False),
+            self.establish_control_stream(flush=False),
+            self.establish_file_stream(flush=False),
+            self.establish_audio_stream(flush=False),
+        )
+        for name,writer in (("video",self.video_writer),("control",self.control_writer),("file",self.file_writer),("audio",self.audio_writer)):
+            self.frame_writer(writer).write_pending()
+            self.mark_timeline(f"stream_registered_{name}")
+        await self.video_writer.drain()
+        # 继续断线前没有完成的上传
+        self.start_uploads()
+
+    async def establish_file_stream(self,flush=True):
         self.file_reader,self.file_writer=await self.client.create_stream(False)
         register_msg = Register(
             device=Device(
@@ -321,32 +488,85 @@ class HighwayQuicClient(QObject):
                 message_type=Device.MessageType.FILE
             )
         )
-        print("send file register message")
-        await self.send_message(writer=self.file_writer,message=register_msg)
+        log.info("send file register message")
+        self.frame_writer(self.file_writer,Device.MessageType.FILE)
+        self.frame_reader(self.file_reader,Device.MessageType.FILE,self.file_writer.get_extra_info("stream_id"))
+        await self.send_message(writer=self.file_writer,message=register_msg,flush=flush)
     
     def send_file(self,filePath):
-        if self.loop and self.running and self.file_writer:
-            self.loop.create_task(self.__send_file(filePath))
-
-    async def __send_file(self,filePath):
-        with open(filePath, "rb") as f:
-            fileName=os.path.basename(filePath)
-            fileSize=os.stat(filePath).st_size
-            await self.send_message(writer=self.file_writer,message=File(name=fileName,size=fileSize))
-            sendSize=0
-            while True:
-                data=f.read(1024)
-                if len(data)==0:
-                    break
-                self.file_writer.write(data)
-                await self.file_writer.drain()
-                sendSize+=len(data)
-                self.file_send_progress.emit(fileName,round(sendSize*100/fileSize))
-
-
-    async def establish_audio_stream(self):
+        """可在Qt线程调用，文件排队后按块上传，断线重连后从已确认的块继续"""
+        if self.loop and self.running:
+            self.loop.call_soon_threadsafe(self.__queue_upload,filePath)
+
+    def __queue_upload(self,filePath):
+        if filePath not in self.pending_uploads:
+            self.pending_uploads.append(filePath)
+        self.start_uploads()
+
+    def start_uploads(self):
+        if self.pending_uploads and self.client and (self.upload_task is None or self.upload_task.done()):
+            self.upload_task=self.loop.create_task(self.__upload_pending())
+            self.tasks.append(self.upload_task)
+
+    async def open_file_stream(self):
+        """额外的FILE流，和 establish_file_stream 使用同样的注册"""
+        reader,writer=await self.client.create_stream(False)
+        register_msg = Register(
+            device=Device(
+                id=self.setting.get("device_id",1),
+                message_type=Device.MessageType.FILE
+            ),
+            subscribe_device=Device(
+                id=self.setting.get("source_device_id",1),
+                message_type=Device.MessageType.FILE
+            )
+        )
+        self.frame_writer(writer,Device.MessageType.FILE)
+        self.frame_reader(reader,Device.MessageType.FILE,writer.get_extra_info("stream_id"))
+        await self.send_message(writer=writer,message=register_msg)
+        return reader,writer
+
+    async def __upload_pending(self):
+        # 同一时间只上传一个文件，确认消息从这些流上读取
+        while self.pending_uploads:
+            filePath=self.pending_uploads[0]
+            streams=[(self.file_reader,self.file_writer)]
+            try:
+                for _ in range(self.setting.get("upload_streams",4)-1):
+                    streams.append(await self.open_file_stream())
+                uploader=BlockUploader(
+                    filePath,
+                    [(functools.partial(self.receive_frame,reader),self.frame_writer(writer,Device.MessageType.FILE)) for reader,writer in streams],
+                    block_size=self.setting.get("upload_block_size",BLOCK_SIZE),
+                    window=self.setting.get("upload_window",WINDOW),
+                    state=self.upload_state,
+                    progress=self.file_send_progress.emit
+                )
+                await uploader.run()
+                log.info("upload finished %s %s",filePath,uploader.stats())
+                self.pending_uploads.pop(0)
+            except FileNotFoundError as e:
+                log.warning("upload file not found: %s",e)
+                self.pending_uploads.pop(0)
+            except Exception as e:
+                # 连接断开，保留在队列里等重连后续传
+                log.warning("upload interrupted %s: %r",filePath,e)
+                return
+            finally:
+                for reader,writer in streams[1:]:
+                    frame_writer=self.frame_writers.pop(writer,None)
+                    if frame_writer:
+                        frame_writer.close()
+                        self.stream_metrics.remove(frame_writer)
+                    frame_reader=self.frame_readers.pop(reader,None)
+                    if frame_reader:
+                        self.stream_metrics.remove(frame_reader)
+                    writer.close()
+
+
+    async def establish_audio_stream(self,flush=True):
         self.audio_reader, self.audio_writer = await self.client.create_stream(False)
-        print(f"Audio stream created - Reader: {id(self.audio_reader)}, Writer: {id(self.audio_writer)}")
+        log.info("Audio stream created - stream id: %s",self.audio_writer.get_extra_info("stream_id"))
         
         register_msg = Register(
             device=Device(
@@ -360,52 +580,55 @@ class HighwayQuicClient(QObject):
                 # device_type=Device.DeviceType.RECEIVER
             )
         )
-        await self.send_message(writer=self.audio_writer,message=register_msg)
-        print(f"Audio stream register sent successfully, writer state: {self.audio_writer.is_closing()}")
+        self.frame_writer(self.audio_writer,Device.MessageType.AUDIO)
+        self.frame_reader(self.audio_reader,Device.MessageType.AUDIO,self.audio_writer.get_extra_info("stream_id"))
+        await self.send_message(writer=self.audio_writer,message=register_msg,flush=flush)
+        log.info("Audio stream register sent, writer closing: %s",self.audio_writer.is_closing())
         
         self.tasks.append(self.loop.create_task(self.__read_audio_stream(reader=self.audio_reader)))
         self.tasks.append(self.loop.create_task(self.__send_audio_stream(writer=self.audio_writer)))
-        print(f"Audio stream tasks created, total tasks: {len(self.tasks)}")
+        log.debug("Audio stream tasks created, total tasks: %d",len(self.tasks))
         
     async def __read_audio_stream(self,reader:asyncio.StreamReader):
         try:
             while self.running:
-                message = await self.receive_message(reader)
-                audio=Audio.FromString(message)
-                print("receive audio frame",len(audio.raw))
+                frame = await self.receive_frame(reader)
+                audio=decode_message(frame,Audio)
+                log.every("receive_audio","receive audio frame %d",len(audio.raw))
                 self.input_wave_data.emit(np.frombuffer(audio.raw,dtype=np.int16))
+                if audio.timestamp:
+                    self.latencies.record("audio",self.clock.latency(audio.timestamp))
                 if audio.raw:
+                    if "first_audio_sample" not in self.timeline.events:
+                        self.mark_timeline("first_audio_sample")
                     self.audio_player.write(audio.raw)
         except asyncio.CancelledError:
-            print("__read_audio_stream canceled")
+            log.debug("__read_audio_stream canceled")
         except Exception as e:
-            print(f"__read_audio_stream error: {e}")
+            log.warning("__read_audio_stream error: %r",e)
         finally:
-            print("__read_audio_stream quit")
+            log.info("__read_audio_stream quit")
 
     async def __send_audio_stream(self,writer:asyncio.StreamWriter):
-        print("__send_audio_stream task started")
+        log.debug("__send_audio_stream task started")
         # 等待一下，确保establish函数完全完成
         await asyncio.sleep(0.1)
-        print("__send_audio_stream starting to send data")
+        log.debug("__send_audio_stream starting to send data")
         try:
             while self.running:
                 data=await self.audio_encoder.read_frame_async()
                 if len(data) == 0:
                     await asyncio.sleep(0.01)  # 短暂等待避免忙等待
                     continue
-                audio=Audio(raw=data)
-                await self.send_message(writer=writer,message=audio,flush=False)
+                self.write_payload(writer,Audio(timestamp=int(time.time()*1000)),data)
         except asyncio.CancelledError:
-            print("__send_audio_stream canceled")
+            log.debug("__send_audio_stream canceled")
         except Exception as e:
-            print(f"__send_audio_stream error: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("__send_audio_stream error: %r",e)
         finally:
-            print("__send_audio_stream task ended")
+            log.info("__send_audio_stream task ended")
     
-    async def establish_video_stream(self):
+    async def establish_video_stream(self,flush=True):
         """Establish video stream after connection"""
         self.video_reader, self.video_writer = await self.client.create_stream(False)
         
@@ -420,8 +643,10 @@ class HighwayQuicClient(QObject):
                 message_type=Device.MessageType.VIDEO
             )
         )
-        print("send video register message")
-        await self.send_message(writer=self.video_writer,message=register_msg)
+        log.info("send video register message")
+        self.frame_writer(self.video_writer,Device.MessageType.VIDEO)
+        self.frame_reader(self.video_reader,Device.MessageType.VIDEO,self.video_writer.get_extra_info("stream_id"))
+        await self.send_message(writer=self.video_writer,message=register_msg,flush=flush)
 
         # Start message reading task
         # self.video_encoder.start()
@@ -432,51 +657,172 @@ class HighwayQuicClient(QObject):
         self.video_encoder.start()
 
 
-    def send_control_message(self, values: list):
-        # TODO 发送速率小于生产速率会产生堆积 导致延迟
+    def send_control_message(self, values: list, callback=None):
+        """可在Qt线程调用，不等待事件循环；callback在事件循环线程里调用"""
         if self.loop and self.running and self.client:
-            print("send control message:",values)
-            future = asyncio.run_coroutine_threadsafe(
-                self.control_stream_queue.put(Control(channels=values)), 
-                self.loop
-            )
-            future.result()  # 等待操作完成
+            log.every("send_control","send control message: %s",values)
+            self.control_handoff.put((Control(channels=values),time.monotonic()),callback)
     
     
     
-    async def establish_control_stream(self):
+    async def establish_control_stream(self,flush=True):
         self.control_reader,self.control_writer=await self.client.create_stream(False)
         # Register control stream
+        # 订阅对端的控制流，接收对端的控制消息和时钟同步应答
         register_msg = Register(
             device=Device(
                 id=self.setting.get("device_id",1),
                 message_type=Device.MessageType.CONTROL
+            ),
+            subscribe_device=Device(
+                id=self.setting.get("source_device_id",1),
+                message_type=Device.MessageType.CONTROL
             )
         )
-        print("send control register message")
-        await self.send_message(writer=self.control_writer,message=register_msg)
-        print(f"Control stream register sent successfully, writer state: {self.control_writer.is_closing()}")
+        log.info("send control register message")
+        self.frame_writer(self.control_writer,Device.MessageType.CONTROL)
+        self.frame_reader(self.control_reader,Device.MessageType.CONTROL,self.control_writer.get_extra_info("stream_id"))
+        await self.send_message(writer=self.control_writer,message=register_msg,flush=flush)
+        log.info("Control stream register sent, writer closing: %s",self.control_writer.is_closing())
         self.tasks.append(self.loop.create_task(self.__send_control_message(writer=self.control_writer)))
+        self.tasks.append(self.loop.create_task(self.__read_control_stream(reader=self.control_reader)))
+        self.tasks.append(self.loop.create_task(self.__clock_sync(writer=self.control_writer)))
+    
+    async def __read_control_stream(self,reader:asyncio.StreamReader):
+        try:
+            while self.running:
+                frame=await self.receive_frame(reader)
+                if frame.flags&FLAG_TIMESYNC:
+                    self.timesync_received(frame.payload,now_us())
+                else:
+                    self.receive_control.emit(list(Control.FromString(frame.payload).channels))
+        except asyncio.CancelledError:
+            log.debug("__read_control_stream canceled")
+        except Exception as e:
+            log.warning("__read_control_stream error: %r",e)
+        finally:
+            log.info("__read_control_stream quit")
+    
+    def timesync_received(self,payload,received):
+        message=decode_timesync(payload)
+        if message is None:
+            return
+        device_id=self.setting.get("device_id",1)
+        if message.target_id!=device_id:
+            return
+        if message.kind==TIMESYNC_REQUEST:
+            # 对端向我们同步时钟
+            self.frame_writer(self.control_writer).write(encode_timesync(timesync_response(message,received)),FLAG_TIMESYNC)
+            self.frame_writer(self.control_writer).write_pending()
+        elif message.kind==TIMESYNC_RESPONSE and message.source_id==self.setting.get("source_device_id",1):
+            self.timesync_unanswered=0
+            self.clock.update(message.t1,message.t2,message.t3,received)
     
+    async def __clock_sync(self,writer:asyncio.StreamWriter):
+        """持续和对端交换时间戳，开始时连续探测几次，对端一直不应答时逐渐拉长间隔"""
+        if self.frame_version<2:
+            # v1没有flags，无法区分时钟同步消息
+            return
+        count=0
+        self.timesync_unanswered=0
+        while self.running:
+            try:
+                request=timesync_request(self.setting.get("device_id",1),self.setting.get("source_device_id",1))
+                frame_writer=self.frame_writer(writer)
+                frame_writer.write(encode_timesync(request),FLAG_TIMESYNC)
+                await frame_writer.flush()
+            except Exception:
+                # 一次探测失败不结束时钟同步，按退避间隔继续
+                log.exception("timesync probe failed")
+            count+=1
+            self.timesync_unanswered+=1
+            if self.timesync_unanswered==TIMESYNC_MAX_UNANSWERED:
+                log.info("no timesync response after %d probes, backing off",self.timesync_unanswered)
+            await asyncio.sleep(timesync_interval(count,self.timesync_unanswered))
+    
+    def send_control_datagram(self,message:Control)->bool:
+        """以datagram发送控制消息，对端不支持时返回False，由调用方回退到流"""
+        if not self.control_datagram or not datagram_supported(self.client):
+            return False
+        data=encode_control_datagram(self.control_seq,self.setting.get("device_id",1),message.SerializeToString())
+        if not datagram_fits(self.client,len(data)):
+            return False
+        self.control_seq+=1
+        self.client._quic.send_datagram_frame(data)
+        self.client.transmit()
+        self.stream_metrics.count("control","sent_bytes",len(data))
+        self.stream_metrics.count("control","sent_messages")
+        return True
+
+    async def wait_stream_acked(self,writer:asyncio.StreamWriter):
+        """等待流上已写入的数据全部被确认，最多等待两个RTT
+
+        每收到一个包检查一次，不轮询；读不到aioquic的确认状态时只等待一个RTT。
+        """
+        client=self.client
+        rtt,_,_=quic_congestion_state(client)
+        deadline=self.loop.time()+max(2*rtt,0.05)
+        while True:
+            unacked=stream_unacked_bytes(writer)
+            remaining=deadline-self.loop.time()
+            if unacked==0 or remaining<=0:
+                return
+            if unacked is None:
+                await asyncio.sleep(min(rtt,remaining))
+                return
+            client.packet_received.clear()
+            try:
+                await asyncio.wait_for(client.packet_received.wait(),remaining)
+            except asyncio.TimeoutError:
+                return
+
+    def datagram_received(self,data:bytes):
+        decoded=decode_control_datagram(data)
+        if decoded is None:
+            return
+        device_id,seq,payload=decoded
+        # 丢弃乱序到达的旧控制消息，每个控制端分别计算
+        if not self.control_seq_filter.accept(device_id,seq):
+            return
+        self.stream_metrics.count("control","received_bytes",len(data))
+        self.stream_metrics.count("control","received_messages")
+        self.receive_control.emit(list(Control.FromString(payload).channels))
+
     async def __send_control_message(self,writer:asyncio.StreamWriter):
         try:
             while self.running:
-                message=await self.control_stream_queue.get()
-                print("send control message channels:",message.channels )
+                message,input_time=await self.control_mailbox.get()
+                log.every("send_control_channels","send control message channels: %s",message.channels)
+                if self.send_control_datagram(message):
+                    self.latencies.record("control",(time.monotonic()-input_time)*1000)
+                    continue
                 await self.send_message(writer=writer,message=message)
+                self.latencies.record("control",(time.monotonic()-input_time)*1000)
+                # 上一条确认前新的值只会覆盖邮箱，输入到发出的延迟不超过一个RTT
+                await self.wait_stream_acked(writer)
         except Exception as e:
             self.control_stream_failed.emit(f"Send control message error: {str(e)}")
         finally:
-            print("__send_control_message quit")
+            log.info("__send_control_message quit")
     
-    def send_video_test_data(self):
-        data = self.video_encoder.read_frame()
-        if self.loop and self.running:
-            future = asyncio.run_coroutine_threadsafe(
-                self.send_message(writer=self.video_writer, message=Video(raw=data, timestamp=int(time.time()*1000))),
-                self.loop
-            )
-            future.result()  # Wait for completion
+    def send_video_test_data(self,callback=None):
+        data,keyframe = self.video_encoder.read_frame()
+        if self.loop and self.running and data:
+            self.video_handoff.put((data,keyframe,int(time.time()*1000)),callback)
+
+    def queue_video(self,item):
+        """在事件循环线程里排队一个视频访问单元"""
+        data,keyframe,timestamp=item
+        flags=FLAG_KEYFRAME if keyframe else 0
+        if self.frame_version>=2:
+            # v2 一个访问单元一条消息
+            self.write_payload(self.video_writer,Video(timestamp=timestamp),data,flags|FLAG_END_OF_AU)
+            return
+        # v1 长度只有16位，按块拆分
+        chunk_size=V1_MAX_PAYLOAD-64
+        view=memoryview(data)
+        for i in range(0,len(data),chunk_size):
+            self.write_payload(self.video_writer,Video(timestamp=timestamp),view[i:i+chunk_size])
    
     async def send_test(self,writer:asyncio.StreamWriter):
         with open(r"demo.h264","rb") as f:
@@ -490,29 +836,52 @@ class HighwayQuicClient(QObject):
     async def __metric_collect(self):
         while self.running:
             await asyncio.sleep(1)
-            if self.latency_count>0:
-                self.latency.emit(self.latency_sum//self.latency_count)
-                self.latency_sum=0
-                self.latency_count=0
+            latencies=self.latencies.sample()
+            video=latencies["video"]["interval"]
+            if video["count"]>0:
+                self.latency.emit(int(video["p50"]))
+            self.latency_stats.emit(latencies)
+            if self.clock.ready:
+                log.debug("clock: %s",self.clock.stats())
+            export_file=self.setting.get("latency_export_file")
+            if export_file:
+                self.export_latency(export_file,latencies)
+
+    def export_latency(self,path,latencies=None):
+        """写出最近一个周期的分位数和累计直方图(JSON)"""
+        try:
+            with open(path,"w") as fp:
+                json.dump({"time":time.time(),"latency":latencies,"histograms":self.latencies.export()},fp)
+        except OSError as e:
+            log.warning("export latency failed: %s",e)
             
+    def dump_log(self,path):
+        """写出内存里最近的日志事件和每个位置的计数"""
+        try:
+            dump_recent_log(path)
+        except OSError as e:
+            log.warning("dump log failed: %s",e)
+
     async def __read_video_stream(self,reader:asyncio.StreamReader):
         """Background task to read incoming messages"""
         try:
             while self.running:
-                message = await self.receive_message(reader)
-                video = Video.FromString(message)
-                print("receive message",len(message),"video count:",video.counter)
-                self.decoder.write(video.raw)
-                self.latency_sum+=int(time.time()*1000)-video.timestamp
-                self.latency_count+=1
+                frame = await self.receive_frame(reader)
+                if "first_video_byte" not in self.timeline.events:
+                    self.mark_timeline("first_video_byte",self.frame_readers[reader].first_read_time)
+                video = decode_message(frame,Video)
+                log.every("receive_video","receive message %d video count: %d",len(frame.payload),video.counter)
+                self.decoder.write(video.raw,bool(frame.flags&FLAG_END_OF_AU))
+                if video.timestamp:
+                    self.latencies.record("video",self.clock.latency(video.timestamp))
         except asyncio.CancelledError as e:
-            print("_read_video_stream ",e)
+            log.debug("_read_video_stream canceled %s",e)
         except Exception as e:
-            print("read video stream error",e)
+            log.warning("read video stream error: %r",e)
             self.video_stream_failed.emit(f"Read error: {str(e)}")
 
         finally:
-            print("_read_video_stream quit")
+            log.info("_read_video_stream quit")
 
 
 
@@ -0,0 +1,246 @@
+import time
+from typing import NamedTuple, Optional
+
+# 控制周期
+CONTROL_INTERVAL = 0.25
+DEFAULT_BITRATE = 1_000_000
+MIN_BITRATE = 150_000
+MAX_BITRATE = 4_000_000
+# 本地发送队列(编码器输出 + FrameWriter + aioquic未发出)能接受的排队时间
+TARGET_QUEUE_DELAY = 0.1
+# 码率变化小于这个比例时不修改编码器
+BITRATE_STEP = 0.1
+# 编码器按目标码率的这个倍数打开，上限以内的码率变化直接在打开的编码器上修改，
+# libx264 在下一帧重新配置码率控制，不产生IDR
+CEILING_RATIO = 2.0
+# 两次重新打开编码器(分辨率/帧率档位变化或码率超过上限)的最小间隔，每次重新打开都从IDR开始
+REOPEN_INTERVAL = 5.0
+# EncoderReconfig.update 的结果
+KEEP = 0
+SET_BITRATE = 1
+REOPEN = 2
+
+
+class VideoTarget(NamedTuple):
+    bitrate: int
+    scale: float = 1.0
+    fps_divisor: int = 1
+
+
+# (最低码率, 分辨率缩放, 帧率除数)，码率从高到低依次降级
+DEFAULT_LADDER = (
+    (700_000, 1.0, 1),
+    (400_000, 0.75, 1),
+    (250_000, 0.5, 1),
+    (0, 0.5, 2),
+)
+
+
+class RateController:
+    """根据拥塞窗口、RTT和本地发送队列调整视频码率
+
+    cwnd/RTT 估计当前可用带宽，码率不超过它的 headroom 倍；
+    本地队列排队时间超过 target_delay 时乘性降低，队列清空后缓慢增加。
+    码率低到一定程度时按 ladder 降低分辨率和帧率，回升时需要超过阈值 up_margin 倍才升级，避免来回切换。
+    """
+
+    def __init__(self, bitrate=DEFAULT_BITRATE, min_bitrate=MIN_BITRATE, max_bitrate=MAX_BITRATE,
+                 target_delay=TARGET_QUEUE_DELAY, ladder=DEFAULT_LADDER, headroom=0.85,
+                 decrease=0.8, increase=0.05, up_margin=1.3):
+        self.bitrate = bitrate
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.target_delay = target_delay
+        self.ladder = ladder
+        self.headroom = headroom
+        self.decrease = decrease
+        self.increase = increase
+        self.up_margin = up_margin
+        self.step = self.__step_for(bitrate, len(ladder) - 1)
+        self.available = 0.0
+        self.queue_delay = 0.0
+        self.last_update = None
+
+    def __step_for(self, bitrate, current):
+        for i, (threshold, _, _) in enumerate(self.ladder):
+            # 升级到更高一档需要额外的余量
+            if i < current and bitrate < threshold * self.up_margin:
+                continue
+            if bitrate >= threshold:
+                return i
+        return len(self.ladder) - 1
+
+    def update(self, rtt: float, cwnd: int, bytes_in_flight: int, queue_bytes: int, now=None) -> VideoTarget:
+        """rtt秒，cwnd/bytes_in_flight/queue_bytes字节"""
+        now = time.monotonic() if now is None else now
+        elapsed = CONTROL_INTERVAL if self.last_update is None else max(now - self.last_update, 1e-3)
+        self.last_update = now
+        self.available = cwnd * 8 / rtt if rtt > 0 and cwnd else 0.0
+        self.queue_delay = queue_bytes * 8 / max(self.bitrate, 1)
+        bitrate = self.bitrate
+        if self.queue_delay > self.target_delay:
+            # 队列在增长，按超出的比例降低，最多降到 decrease 倍
+            bitrate *= max(self.decrease, self.target_delay / self.queue_delay)
+        elif self.queue_delay < self.target_delay / 2 and bytes_in_flight < cwnd:
+            # 没有被拥塞窗口限制时才增加，每秒增加 increase*4
+            bitrate *= 1 + self.increase * elapsed / CONTROL_INTERVAL
+        if self.available:
+            bitrate = min(bitrate, self.available * self.headroom)
+        self.bitrate = int(min(max(bitrate, self.min_bitrate), self.max_bitrate))
+        self.step = self.__step_for(self.bitrate, self.step)
+        _, scale, fps_divisor = self.ladder[self.step]
+        return VideoTarget(self.bitrate, scale, fps_divisor)
+
+    def stats(self) -> dict:
+        return {
+            "bitrate": self.bitrate,
+            "available": int(self.available),
+            "queue_delay_ms": round(self.queue_delay * 1000, 1),
+            "step": self.step,
+        }
+
+
+class EncoderReconfig:
+    """决定码率控制的目标怎样应用到编码器
+
+    码率不超过打开时的上限 ceiling 时直接修改(SET_BITRATE)，变化小于 bitrate_step 时忽略；
+    档位(分辨率/帧率)变化或码率超过上限时重新打开(REOPEN)，距上次重新打开不到 reopen_interval 秒时推迟，
+    推迟期间档位不变、码率限制在上限以内，拥塞时码率仍然立即下降。
+    target 是当前应用到编码器的目标；pending 是还没应用到编码器的动作，由编码线程用 next_frame() 取走。
+    """
+
+    def __init__(self, bitrate=DEFAULT_BITRATE, max_bitrate=MAX_BITRATE, ceiling_ratio=CEILING_RATIO,
+                 reopen_interval=REOPEN_INTERVAL, bitrate_step=BITRATE_STEP):
+        self.max_bitrate = max_bitrate
+        self.ceiling_ratio = ceiling_ratio
+        self.reopen_interval = reopen_interval
+        self.bitrate_step = bitrate_step
+        self.target = VideoTarget(int(bitrate))
+        self.ceiling = self.__ceiling(bitrate)
+        self.last_reopen = None
+        self.reopens = 0
+        self.bitrate_changes = 0
+        self.pending = KEEP
+
+    def __ceiling(self, bitrate) -> int:
+        return int(max(bitrate, min(bitrate * self.ceiling_ratio, self.max_bitrate)))
+
+    def update(self, target: VideoTarget, now=None) -> int:
+        now = time.monotonic() if now is None else now
+        current = self.target
+        if (target.scale, target.fps_divisor) != (current.scale, current.fps_divisor) or target.bitrate > self.ceiling:
+            if self.last_reopen is None or now - self.last_reopen >= self.reopen_interval:
+                self.target = target
+                self.ceiling = self.__ceiling(target.bitrate)
+                self.last_reopen = now
+                self.reopens += 1
+                self.pending = REOPEN
+                return REOPEN
+        bitrate = min(target.bitrate, self.ceiling)
+        if abs(bitrate - current.bitrate) < current.bitrate * self.bitrate_step:
+            return KEEP
+        self.target = current._replace(bitrate=bitrate)
+        self.bitrate_changes += 1
+        self.pending = max(self.pending, SET_BITRATE)
+        return SET_BITRATE
+
+    def next_frame(self, frame_index: int, opened=True) -> Optional[int]:
+        """采集到第 frame_index 帧时调用，降帧率要丢弃的帧返回None且不取走 pending，
+        否则返回这一帧编码前要执行的动作(编码器还没打开时是REOPEN)"""
+        if frame_index % self.target.fps_divisor:
+            return None
+        action = self.pending if opened else REOPEN
+        self.pending = KEEP
+        return action
+
+    def stats(self) -> dict:
+        return {"ceiling": self.ceiling, "reopens": self.reopens, "bitrate_changes": self.bitrate_changes}
+
+
+def quic_congestion_state(protocol):
+    """从aioquic连接读取 (rtt秒, cwnd字节, bytes_in_flight字节)"""
+    loss = protocol._quic._loss
+    rtt = loss._rtt_smoothed or loss._rtt_initial
+    return rtt, loss.congestion_window, loss.bytes_in_flight
+
+
+def test_reconfig_dropped_frame(frames=300):
+    """按编码线程的方式逐帧调用 next_frame，降帧率时在奇数帧切换档位/码率，
+    动作不会因为这一帧被丢弃而丢失，编码器最后总是和 target 一致"""
+    reconfig = EncoderReconfig(1_000_000, reopen_interval=0)
+    # 编码器当前的 (bitrate, scale, fps_divisor)，None 表示还没打开
+    encoder = None
+    changes = {1: VideoTarget(1_000_000, 1.0, 2), 7: VideoTarget(600_000, 0.75, 2),
+               31: VideoTarget(400_000, 0.75, 2), 55: VideoTarget(300_000, 0.5, 3), 121: VideoTarget(1_000_000)}
+    encoded = 0
+    for frame_index in range(1, frames + 1):
+        if frame_index in changes:
+            assert reconfig.update(changes[frame_index], now=frame_index) != KEEP
+        action = reconfig.next_frame(frame_index, encoder is not None)
+        if action is None:
+            assert frame_index % reconfig.target.fps_divisor
+            continue
+        if action == REOPEN:
+            encoder = tuple(reconfig.target)
+        elif action == SET_BITRATE:
+            encoder = (reconfig.target.bitrate,) + encoder[1:]
+        assert encoder == tuple(reconfig.target), f"frame {frame_index}: encoder {encoder} target {reconfig.target}"
+        encoded += 1
+    print(f"dropped-frame reconfig ok, {encoded}/{frames} frames encoded, {reconfig.stats()}")
+
+
+def test_rate_control(seconds=60, fps=30, gop=30):
+    """模拟一条带宽变化的瓶颈链路，编码器按 EncoderReconfig 应用目标，
+    检查本地队列延迟保持有界，以及重新打开编码器(每次一个额外的IDR)的次数和间隔"""
+    controller = RateController()
+    reconfig = EncoderReconfig(controller.bitrate)
+    # (开始时间, 链路带宽bit/s)
+    schedule = ((0, 2_000_000), (15, 500_000), (30, 200_000), (45, 3_000_000))
+    base_rtt = 0.04
+    queue = 0.0
+    target = VideoTarget(controller.bitrate)
+    delays = []
+    reopen_times = []
+    # 旧的做法: 码率变化超过 BITRATE_STEP 或档位变化都重新打开编码器
+    naive_reopens = 0
+    naive = VideoTarget(controller.bitrate)
+    now = 0.0
+    step = 1 / fps
+    next_control = 0.0
+    while now < seconds:
+        link = [rate for start, rate in schedule if start <= now][-1]
+        queue += target.bitrate / 8 / fps
+        queue = max(0.0, queue - link / 8 * step)
+        delays.append((now, queue * 8 / link))
+        if now >= next_control:
+            # 拥塞窗口大约是BDP的两倍，链路上排队的数据也计入RTT
+            rtt = base_rtt + min(queue, link / 8 * base_rtt) * 8 / link
+            cwnd = int(link / 8 * base_rtt * 2)
+            wanted = controller.update(rtt, cwnd, min(int(queue), cwnd), int(queue), now)
+            if reconfig.update(wanted, now) == REOPEN:
+                reopen_times.append(now)
+            # 编码器实际输出的是应用后的码率
+            target = reconfig.target
+            if (wanted.scale, wanted.fps_divisor) != (naive.scale, naive.fps_divisor) or \
+                    abs(wanted.bitrate - naive.bitrate) >= naive.bitrate * BITRATE_STEP:
+                naive_reopens += 1
+                naive = wanted
+            next_control += CONTROL_INTERVAL
+        now += step
+    for start, rate in schedule:
+        window = [d for t, d in delays if start + 3 <= t < start + 15]
+        print(f"link {rate / 1e6:.1f}Mbit/s queue delay max {max(window) * 1000:.0f}ms "
+              f"avg {sum(window) / len(window) * 1000:.0f}ms")
+        assert max(window) < 0.5, "queue delay not bounded"
+    gop_idrs = int(seconds * fps / gop)
+    print(f"encoder reopens {reconfig.reopens} (extra IDRs), in-place bitrate changes {reconfig.bitrate_changes}, "
+          f"GOP IDRs {gop_idrs}; reopening on every change would have been {naive_reopens}")
+    assert all(b - a >= REOPEN_INTERVAL for a, b in zip(reopen_times, reopen_times[1:])), "encoder reopened too often"
+    assert reconfig.reopens <= seconds / REOPEN_INTERVAL + 1
+    assert reconfig.reopens < naive_reopens / 3, "bitrate changes still reopen the encoder"
+    print("final", controller.stats(), reconfig.stats())
+
+
+if __name__ == "__main__":
+    test_reconfig_dropped_frame()
+    test_rate_control()
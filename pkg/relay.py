@@ -0,0 +1,539 @@
+import argparse
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aioquic.asyncio import QuicConnectionProtocol, serve
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import ConnectionTerminated, DatagramFrameReceived, ProtocolNegotiated, QuicEvent
+from aioquic.quic.logger import QuicFileLogger
+from aioquic.tls import SessionTicket
+
+from pkg.datagram import MAX_DATAGRAM_FRAME_SIZE, datagram_fits, datagram_supported, decode_control_datagram
+from pkg.frame import (ALPN_V2, FLAG_KEYFRAME, FLAG_OOB, FLAG_TIMESYNC, V1_MAX_PAYLOAD, Frame, FrameReader,
+                       FrameWriter, alpn_protocols, frame_version)
+from pkg.scheduler import stream_unsent_bytes
+from pkg.upload import BLOCK_OVERHEAD
+from pkg.wire import legacy_frame
+from protocol.highway_pb2 import Audio, Device, File, Register, Video
+
+logger = logging.getLogger("relay")
+
+# 每个视频频道缓存最近一个GOP的上限，超过后等下一个关键帧重新开始缓存
+GOP_CACHE_BYTES = 8 * 1024 * 1024
+# 订阅者积压超过这个字节数时丢弃视频直到下一个关键帧
+MAX_BACKLOG = 2 * 1024 * 1024
+STATS_INTERVAL = 10
+# 带payload的消息类型，FLAG_OOB 帧转发给不支持的订阅者时需要转换
+MESSAGE_CLASSES = {Device.MessageType.VIDEO: Video, Device.MessageType.AUDIO: Audio, Device.MessageType.FILE: File}
+
+
+def h264_is_keyframe(data) -> bool:
+    """在Annex B数据里找到第一个视频NAL，IDR返回True"""
+    pos = data.find(b"\x00\x00\x01")
+    while pos >= 0 and pos + 3 < len(data):
+        nal_type = data[pos + 3] & 0x1f
+        if nal_type == 5:
+            return True
+        if 1 <= nal_type <= 4:
+            return False
+        pos = data.find(b"\x00\x00\x01", pos + 3)
+    return False
+
+
+def split_v1(payload, message_type: int) -> List[bytes]:
+    """v2的大消息转发给v1订阅者时，按客户端的方式把raw拆成多条消息
+
+    File块不拆分: 接收端按 block_id(uint32) 去重和确认，拆开的块没法各自确认，返回空列表由调用方计数丢弃。
+    """
+    message_class = MESSAGE_CLASSES.get(message_type)
+    if message_class not in (Video, Audio):
+        return []
+    message = message_class.FromString(payload)
+    chunk_size = V1_MAX_PAYLOAD - 64
+    return [
+        message_class(raw=message.raw[i:i + chunk_size], timestamp=message.timestamp,
+                      counter=message.counter).SerializeToString()
+        for i in range(0, len(message.raw), chunk_size)
+    ]
+
+
+class SessionTicketStore:
+    def __init__(self) -> None:
+        self.tickets: Dict[bytes, SessionTicket] = {}
+
+    def add(self, ticket: SessionTicket) -> None:
+        self.tickets[ticket.ticket] = ticket
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        return self.tickets.pop(label, None)
+
+
+class Subscriber:
+    def __init__(self, protocol, frame_writer: FrameWriter):
+        self.protocol = protocol
+        self.frame_writer = frame_writer
+        # 新订阅或积压丢帧后，视频要从关键帧开始
+        self.waiting_keyframe = True
+        self.dropped = 0
+        # 超过v1帧长度又不能拆分的消息(File块)
+        self.oversize = 0
+
+
+class Channel:
+    """一个发布者设备的一种消息类型，例如 (1, VIDEO)"""
+
+    def __init__(self, key: Tuple[int, int]):
+        self.key = key
+        self.subscribers: List[Subscriber] = []
+        self.gop = []
+        self.gop_bytes = 0
+        self.messages = 0
+        self.bytes = 0
+        # 最近一次 FLAG_OOB 帧转换成的普通消息，多个旧订阅者共用
+        self.legacy_source = None
+        self.legacy = None
+
+    @property
+    def is_video(self) -> bool:
+        return self.key[1] == Device.MessageType.VIDEO
+
+    def cache(self, frame: Frame, keyframe):
+        if keyframe:
+            self.gop = [frame]
+            self.gop_bytes = len(frame.payload)
+        elif self.gop:
+            self.gop.append(frame)
+            self.gop_bytes += len(frame.payload)
+            if self.gop_bytes > GOP_CACHE_BYTES:
+                self.gop = []
+                self.gop_bytes = 0
+
+    def legacy_frame(self, frame: Frame) -> Frame:
+        if self.legacy_source is not frame:
+            self.legacy = legacy_frame(frame, MESSAGE_CLASSES[self.key[1]])
+            self.legacy_source = frame
+        return self.legacy
+
+
+class HighwayRelay:
+    """Highway协议中继
+
+    每个流的第一帧是Register: device 是这个流发布的频道，subscribe_device 是要订阅的频道。
+    之后收到的每一帧原样转发给频道的所有订阅者，payload不解析也不拷贝，
+    每个订阅者只按自己协商的帧格式重新生成header，不支持 FLAG_OOB 的订阅者收到转换后的普通消息。
+    """
+
+    def __init__(self, write_delay=0.0, gop_cache=True, max_backlog=MAX_BACKLOG):
+        self.write_delay = write_delay
+        self.gop_cache = gop_cache
+        self.max_backlog = max_backlog
+        self.channels: Dict[Tuple[int, int], Channel] = {}
+        self.stream_count = 0
+
+    def channel(self, device: Device) -> Channel:
+        key = (device.id, device.message_type)
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = Channel(key)
+        return channel
+
+    def stream_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        protocol = writer.transport.protocol
+        protocol.tasks.add(asyncio.get_running_loop().create_task(self.handle_stream(protocol, reader, writer)))
+
+    async def handle_stream(self, protocol, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        version = frame_version(protocol.alpn_protocol)
+        frame_reader = FrameReader(reader, version=version)
+        subscriber = None
+        channel = None
+        self.stream_count += 1
+        try:
+            register = Register.FromString(await frame_reader.read_message())
+            logger.info(f"register device {register.device.id} {Device.MessageType.Name(register.device.message_type)} "
+                        f"subscribe {register.subscribe_device.id if register.HasField('subscribe_device') else '-'} "
+                        f"framing v{version}")
+            if register.HasField("subscribe_device"):
+                subscriber = Subscriber(protocol, FrameWriter(writer, delay=self.write_delay, version=version))
+                channel = self.channel(register.subscribe_device)
+                self.subscribe(channel, subscriber)
+            publish = self.channel(register.device)
+            while True:
+                frame = await frame_reader.read_frame()
+                self.publish(publish, frame, version)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.warning(f"stream {writer.get_extra_info('stream_id')} error: {e}")
+        finally:
+            self.stream_count -= 1
+            if subscriber is not None:
+                if subscriber in channel.subscribers:
+                    channel.subscribers.remove(subscriber)
+                subscriber.frame_writer.close()
+
+    def subscribe(self, channel: Channel, subscriber: Subscriber):
+        channel.subscribers.append(subscriber)
+        if not channel.is_video:
+            subscriber.waiting_keyframe = False
+            return
+        # 先补发缓存的GOP，新订阅者不用等下一个关键帧
+        for frame in channel.gop:
+            self.forward(channel, subscriber, frame, frame.flags & FLAG_KEYFRAME)
+
+    def publish(self, channel: Channel, frame: Frame, version: int):
+        channel.messages += 1
+        channel.bytes += len(frame.payload)
+        keyframe = False
+        if channel.is_video:
+            if version >= 2:
+                keyframe = bool(frame.flags & FLAG_KEYFRAME)
+            else:
+                # v1没有flags，只在这里解析一次，转发给v2订阅者时补上关键帧标志
+                keyframe = h264_is_keyframe(Video.FromString(frame.payload).raw)
+                if keyframe:
+                    frame = frame._replace(flags=frame.flags | FLAG_KEYFRAME)
+            if self.gop_cache:
+                channel.cache(frame, keyframe)
+        # 转发失败的订阅者会在forward里被移除
+        for subscriber in tuple(channel.subscribers):
+            self.forward(channel, subscriber, frame, keyframe)
+
+    def forward(self, channel: Channel, subscriber: Subscriber, frame: Frame, keyframe):
+        frame_writer = subscriber.frame_writer
+        if channel.is_video:
+            if subscriber.waiting_keyframe:
+                if not keyframe:
+                    subscriber.dropped += 1
+                    return
+                subscriber.waiting_keyframe = False
+            elif stream_unsent_bytes(frame_writer.writer) > self.max_backlog:
+                subscriber.waiting_keyframe = True
+                subscriber.dropped += 1
+                return
+        if frame.flags & FLAG_TIMESYNC and frame_writer.version < 2:
+            # v1没有flags，订阅者会把时钟同步消息当成Control解析
+            return
+        try:
+            if frame.flags & FLAG_OOB and not frame_writer.oob:
+                frame = channel.legacy_frame(frame)
+            if len(frame.payload) > frame_writer.max_payload:
+                parts = split_v1(frame.payload, channel.key[1])
+                if not parts:
+                    subscriber.oversize += 1
+                    subscriber.dropped += 1
+                    if subscriber.oversize == 1:
+                        logger.warning(f"{len(frame.payload)} byte {Device.MessageType.Name(channel.key[1])} message "
+                                       f"too large for a v{frame_writer.version} subscriber, dropped; "
+                                       f"uploads to v1 receivers need upload_block_size <= {V1_MAX_PAYLOAD - BLOCK_OVERHEAD}")
+                for part in parts:
+                    frame_writer.write(part)
+            else:
+                frame_writer.write_parts((frame.payload,), frame.flags, frame.meta_size)
+        except Exception as e:
+            logger.warning(f"forward to subscriber failed: {e}")
+            channel.subscribers.remove(subscriber)
+
+    def datagram_received(self, data: bytes):
+        """控制datagram原样转发，订阅者不支持datagram时改为写入它的流"""
+        decoded = decode_control_datagram(data)
+        if decoded is None:
+            return
+        device_id, _, payload = decoded
+        channel = self.channels.get((device_id, Device.MessageType.CONTROL))
+        if channel is None:
+            return
+        channel.messages += 1
+        channel.bytes += len(payload)
+        for subscriber in tuple(channel.subscribers):
+            protocol = subscriber.protocol
+            if datagram_supported(protocol) and datagram_fits(protocol, len(data)):
+                protocol._quic.send_datagram_frame(data)
+                protocol.transmit()
+            else:
+                self.forward(channel, subscriber, Frame(payload, 0), False)
+
+    def stats(self) -> dict:
+        result = {}
+        for (device_id, message_type), channel in self.channels.items():
+            result[f"{device_id}/{Device.MessageType.Name(message_type)}"] = {
+                "messages": channel.messages,
+                "bytes": channel.bytes,
+                "subscribers": len(channel.subscribers),
+                "gop_frames": len(channel.gop),
+                "dropped": sum(subscriber.dropped for subscriber in channel.subscribers),
+                "oversize": sum(subscriber.oversize for subscriber in channel.subscribers),
+            }
+        return result
+
+    async def report_stats(self, interval=STATS_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"streams {self.stream_count} channels {self.stats()}")
+
+
+class RelayProtocol(QuicConnectionProtocol):
+    def __init__(self, *args, relay: HighwayRelay = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.relay = relay
+        self.alpn_protocol = None
+        self.tasks = set()
+
+    def quic_event_received(self, event: QuicEvent):
+        if isinstance(event, ProtocolNegotiated):
+            self.alpn_protocol = event.alpn_protocol
+        elif isinstance(event, DatagramFrameReceived):
+            self.relay.datagram_received(event.data)
+        elif isinstance(event, ConnectionTerminated):
+            # aioquic不会结束已打开的流，这里让所有流的读取结束
+            for reader in self._stream_readers.values():
+                reader.feed_eof()
+        super().quic_event_received(event)
+
+
+def relay_configuration(certificate="assets/tls/cert.pem", private_key="assets/tls/key.pem", quic_logger=None):
+    configuration = QuicConfiguration(
+        alpn_protocols=alpn_protocols(3),
+        is_client=False,
+        max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE,
+        quic_logger=quic_logger,
+    )
+    configuration.load_cert_chain(certificate, private_key)
+    return configuration
+
+
+async def start_relay(host, port, configuration: QuicConfiguration, relay: HighwayRelay = None, retry=False):
+    relay = relay or HighwayRelay()
+    store = SessionTicketStore()
+    server = await serve(
+        host,
+        port,
+        configuration=configuration,
+        create_protocol=lambda *args, **kwargs: RelayProtocol(*args, relay=relay, **kwargs),
+        session_ticket_fetcher=store.pop,
+        session_ticket_handler=store.add,
+        retry=retry,
+        stream_handler=relay.stream_handler,
+    )
+    return server, relay
+
+
+async def main(host, port, configuration, retry, gop_cache):
+    server, relay = await start_relay(host, port, configuration, HighwayRelay(gop_cache=gop_cache), retry)
+    logger.info(f"relay listening on {host}:{port}")
+    try:
+        await relay.report_stats()
+    finally:
+        server.close()
+
+
+def test_control_datagram_fallback():
+    """控制datagram转发给没有协商datagram的订阅者时改写到它的控制流，v1/v2订阅者都能按Control解析"""
+    from protocol.highway_pb2 import Control
+
+    from pkg.datagram import encode_control_datagram
+
+    class Writer:
+        def __init__(self):
+            self.data = bytearray()
+
+        def writelines(self, parts):
+            for part in parts:
+                self.data += part
+
+        async def drain(self):
+            pass
+
+    class Protocol:
+        # 没有 _quic，datagram_supported 返回False
+        pass
+
+    async def run():
+        relay = HighwayRelay()
+        channel = relay.channel(Device(id=1, message_type=Device.MessageType.CONTROL))
+        writers = {}
+        for version in (1, 2, 3):
+            writers[version] = Writer()
+            relay.subscribe(channel, Subscriber(Protocol(), FrameWriter(writers[version], delay=0, version=version)))
+        for seq in range(10):
+            relay.datagram_received(encode_control_datagram(seq, 1, Control(channels=[seq, 1500]).SerializeToString()))
+        for subscriber in channel.subscribers:
+            await subscriber.frame_writer.flush()
+        assert len(channel.subscribers) == 3, "subscriber removed by a failed forward"
+        for version, writer in writers.items():
+            reader = asyncio.StreamReader()
+            reader.feed_data(bytes(writer.data))
+            reader.feed_eof()
+            frame_reader = FrameReader(reader, version=version)
+            for seq in range(10):
+                frame = await frame_reader.read_frame()
+                assert list(Control.FromString(frame.payload).channels) == [seq, 1500]
+        return channel.messages
+
+    messages = asyncio.run(run())
+    print(f"control datagram fallback ok, {messages} datagrams forwarded to v1/v2/v3 streams")
+
+
+def test_oversize_v1():
+    """超过v1帧长度的消息: Video拆成多条转发，File块丢弃并计入 dropped/oversize"""
+    from pkg.upload import BLOCK_SIZE
+
+    class Writer:
+        def __init__(self):
+            self.data = bytearray()
+
+        def writelines(self, parts):
+            for part in parts:
+                self.data += part
+
+        async def drain(self):
+            pass
+
+    async def run():
+        relay = HighwayRelay()
+        writer = Writer()
+        subscriber = Subscriber(None, FrameWriter(writer, delay=0, version=1))
+        video = relay.channel(Device(id=1, message_type=Device.MessageType.VIDEO))
+        file = relay.channel(Device(id=1, message_type=Device.MessageType.FILE))
+        relay.subscribe(video, subscriber)
+        relay.subscribe(file, subscriber)
+        raw = b"\x00\x00\x01\x65" + bytes(200000)
+        relay.publish(video, Frame(Video(raw=raw, timestamp=1).SerializeToString(), FLAG_KEYFRAME), 2)
+        block = File(name="a.bin", offset=0, total_size=BLOCK_SIZE, data=bytes(BLOCK_SIZE), block_id=0)
+        for _ in range(3):
+            relay.publish(file, Frame(block.SerializeToString()), 2)
+        await subscriber.frame_writer.flush()
+        reader = asyncio.StreamReader()
+        reader.feed_data(bytes(writer.data))
+        reader.feed_eof()
+        frame_reader = FrameReader(reader, version=1)
+        received = b""
+        while len(received) < len(raw):
+            received += Video.FromString(await frame_reader.read_message()).raw
+        assert received == raw, "split video not reassembled"
+        assert frame_reader.decoder.buffered() == 0, "oversize File block forwarded"
+        return relay.stats()
+
+    stats = asyncio.run(run())
+    assert stats["1/FILE"]["oversize"] == stats["1/FILE"]["dropped"] == 3
+    print(f"oversize v1 ok, file channel {stats['1/FILE']}")
+
+
+def _benchmark_relay_process(port, ready, stop, results):
+    async def run():
+        server, relay = await start_relay("127.0.0.1", port, relay_configuration())
+        ready.set()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, stop.wait)
+        server.close()
+        return relay
+
+    start = time.process_time()
+    relay = asyncio.run(run())
+    results.put((time.process_time() - start, relay.stats()))
+
+
+def relay_benchmark(seconds=5, subscribers=(1, 4, 8), payload_size=20000, port=30545):
+    """中继单独运行在一个进程里，一个发布者尽量快地发送视频，统计订阅者收到的数据量和中继进程的CPU时间"""
+    import multiprocessing
+    import ssl
+
+    from aioquic.asyncio.client import connect
+
+    async def client(configuration, register, received=None, payload=None, deadline=0.0):
+        async with connect("127.0.0.1", port, configuration=configuration) as protocol:
+            reader, writer = await protocol.create_stream()
+            frame_writer = FrameWriter(writer, delay=0, version=2)
+            frame_writer.write(register.SerializeToString())
+            await frame_writer.flush()
+            if payload is None:
+                frame_reader = FrameReader(reader, version=2)
+                try:
+                    while True:
+                        frame = await asyncio.wait_for(frame_reader.read_frame(), deadline - time.monotonic())
+                        received[0] += 1
+                        received[1] += len(frame.payload)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    pass
+                return
+            # 等订阅者注册完成
+            await asyncio.sleep(0.2)
+            count = 0
+            while time.monotonic() < deadline:
+                # 发送缓冲积压时等待，避免无限堆积在aioquic里
+                if stream_unsent_bytes(writer) > 1024 * 1024:
+                    await asyncio.sleep(0.001)
+                    continue
+                frame_writer.write(payload, FLAG_KEYFRAME if count % 30 == 0 else 0)
+                await frame_writer.flush()
+                count += 1
+
+    async def run(count):
+        configuration = QuicConfiguration(alpn_protocols=[ALPN_V2], is_client=True)
+        configuration.verify_mode = ssl.CERT_NONE
+        deadline = time.monotonic() + seconds + 0.5
+        received = [0, 0]
+        payload = Video(raw=b"\x00\x00\x01\x65" + bytes(payload_size)).SerializeToString()
+        subscribe = Register(device=Device(id=100, message_type=Device.MessageType.VIDEO),
+                             subscribe_device=Device(id=1, message_type=Device.MessageType.VIDEO))
+        publish = Register(device=Device(id=1, message_type=Device.MessageType.VIDEO))
+        tasks = [client(configuration, subscribe, received=received, deadline=deadline) for _ in range(count)]
+        tasks.append(client(configuration, publish, payload=payload, deadline=deadline))
+        await asyncio.gather(*tasks)
+        return received
+
+    for count in subscribers:
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_benchmark_relay_process, args=(port, ready, stop, results))
+        process.start()
+        ready.wait()
+        messages, size = asyncio.run(run(count))
+        stop.set()
+        cpu, stats = results.get()
+        process.join()
+        published = stats.get("1/VIDEO", {})
+        print(f"subscribers {count:2d} published {published.get('messages', 0)} msgs "
+              f"delivered {messages} msgs {size / seconds / 1e6:.1f} MB/s, "
+              f"relay cpu {cpu:.2f}s -> {size / max(cpu, 1e-6) / 1e6:.1f} MB per cpu-second")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Highway relay server")
+    parser.add_argument("--host", type=str, default="::", help="listen on the specified address (defaults to ::)")
+    parser.add_argument("--port", type=int, default=30042, help="listen on the specified port (defaults to 30042)")
+    parser.add_argument("-k", "--private-key", type=str, default="assets/tls/key.pem",
+                        help="load the TLS private key from the specified file")
+    parser.add_argument("-c", "--certificate", type=str, default="assets/tls/cert.pem",
+                        help="load the TLS certificate from the specified file")
+    parser.add_argument("--retry", action="store_true", help="send a retry for new connections")
+    parser.add_argument("--no-gop-cache", action="store_true", help="do not cache the last GOP for new video subscribers")
+    parser.add_argument("-q", "--quic-log", type=str, help="log QUIC events to QLOG files in the specified directory")
+    parser.add_argument("--benchmark", action="store_true", help="run the local relay throughput benchmark")
+    parser.add_argument("--test", action="store_true", help="run the relay self-tests")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase logging verbosity")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
+
+    if args.test:
+        test_control_datagram_fallback()
+        test_oversize_v1()
+    elif args.benchmark:
+        relay_benchmark()
+    else:
+        configuration = relay_configuration(
+            args.certificate,
+            args.private_key,
+            QuicFileLogger(args.quic_log) if args.quic_log else None,
+        )
+        try:
+            asyncio.run(main(args.host, args.port, configuration, args.retry, not args.no_gop_cache))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Optional
+
+from protocol.highway_pb2 import Device
+
+# 数值越小优先级越高: 控制 > 音频 > 视频 > 文件
+DEFAULT_PRIORITIES = {
+    "CONTROL": 0,
+    "REPORT": 0,
+    "AUDIO": 1,
+    "VIDEO": 2,
+    "FILE": 3,
+}
+DEFAULT_WEIGHTS = {
+    "CONTROL": 8,
+    "REPORT": 8,
+    "AUDIO": 4,
+    "VIDEO": 2,
+    "FILE": 1,
+}
+# 低优先级流在aioquic发送缓冲里最多积压的字节数
+MAX_BACKLOG = 65536
+POLL_INTERVAL = 0.005
+
+
+def stream_unsent_bytes(writer: asyncio.StreamWriter) -> int:
+    """已经交给aioquic但还没发出去的字节数，非QUIC流返回0"""
+    transport = getattr(writer, "transport", None)
+    protocol = getattr(transport, "protocol", None)
+    quic = getattr(protocol, "_quic", None)
+    if quic is None:
+        return 0
+    stream = quic._streams.get(transport.stream_id)
+    if stream is None:
+        return 0
+    return sum(r.stop - r.start for r in stream.sender._pending)
+
+
+def stream_unacked_bytes(writer: asyncio.StreamWriter) -> Optional[int]:
+    """已经交给aioquic但还没被对端确认的字节数，非QUIC流或aioquic内部字段不可用时返回None"""
+    transport = getattr(writer, "transport", None)
+    quic = getattr(getattr(transport, "protocol", None), "_quic", None)
+    stream = getattr(quic, "_streams", {}).get(getattr(transport, "stream_id", None))
+    sender = getattr(stream, "sender", None)
+    try:
+        return sender._buffer_stop - sender._buffer_start
+    except AttributeError:
+        return None
+
+
+class SendScheduler:
+    """跨流的发送调度
+
+    每个FrameWriter按 Device.MessageType 对应一个优先级。
+    strict: 更高优先级的流还有排队数据(包括aioquic里未发出的)时，低优先级流暂停写出；
+    weighted: 同样的条件下，低优先级流按权重分到一部分带宽，不会被完全饿死。
+    低优先级流自身在aioquic里的积压超过 max_backlog 时也会暂停。
+    """
+
+    def __init__(self, mode="strict", priorities=None, weights=None, max_backlog=MAX_BACKLOG):
+        self.mode = mode
+        self.priorities = {Device.MessageType.Value(k): v for k, v in {**DEFAULT_PRIORITIES, **(priorities or {})}.items()}
+        self.weights = {Device.MessageType.Value(k): v for k, v in {**DEFAULT_WEIGHTS, **(weights or {})}.items()}
+        self.max_backlog = max_backlog
+        self.writers = defaultdict(list)
+        self.changed = asyncio.Event()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.sent_bytes = defaultdict(int)
+        self.sent_messages = defaultdict(int)
+        self.delay_sum = defaultdict(float)
+        self.delay_count = defaultdict(int)
+        self.delay_max = defaultdict(float)
+        self.stats_time = time.monotonic()
+
+    def priority(self, message_type: int) -> int:
+        return self.priorities.get(message_type, max(self.priorities.values()))
+
+    def register(self, frame_writer, message_type: int):
+        self.writers[message_type].append(frame_writer)
+
+    def unregister(self, frame_writer, message_type: int):
+        if frame_writer in self.writers[message_type]:
+            self.writers[message_type].remove(frame_writer)
+
+    def backlog(self, message_type: int) -> int:
+        """该类型还没发到网络上的字节数"""
+        total = 0
+        for frame_writer in self.writers[message_type]:
+            total += frame_writer.pending_bytes + stream_unsent_bytes(frame_writer.writer)
+        return total
+
+    def allowed(self, message_type: int, frame_writer) -> bool:
+        priority = self.priority(message_type)
+        higher = [t for t in self.writers if self.priority(t) < priority]
+        if not higher:
+            return True
+        if stream_unsent_bytes(frame_writer.writer) > self.max_backlog:
+            return False
+        busy = [t for t in higher if self.backlog(t) > 0]
+        if not busy:
+            return True
+        if self.mode != "weighted":
+            return False
+        # 按权重: 本类型在这段时间里发送的字节占比低于权重占比时放行
+        active = busy + [message_type]
+        total = sum(self.sent_bytes[t] for t in active)
+        share = self.weights.get(message_type, 1) / sum(self.weights.get(t, 1) for t in active)
+        return total == 0 or self.sent_bytes[message_type] / total < share
+
+    async def wait_turn(self, message_type: int, frame_writer):
+        while not self.allowed(message_type, frame_writer):
+            self.changed.clear()
+            try:
+                # aioquic发出数据没有事件通知，定时重新检查
+                await asyncio.wait_for(self.changed.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def on_sent(self, message_type: int, size: int, messages: int, delay: float):
+        self.sent_bytes[message_type] += size
+        self.sent_messages[message_type] += messages
+        self.delay_sum[message_type] += delay
+        self.delay_count[message_type] += 1
+        if delay > self.delay_max[message_type]:
+            self.delay_max[message_type] = delay
+        self.changed.set()
+
+    def stats(self) -> dict:
+        """返回各类型的吞吐(字节/秒)和排队延迟(毫秒)，并开始新的统计周期"""
+        elapsed = max(time.monotonic() - self.stats_time, 1e-6)
+        result = {}
+        for message_type in self.writers:
+            count = self.delay_count[message_type]
+            result[Device.MessageType.Name(message_type)] = {
+                "throughput": self.sent_bytes[message_type] / elapsed,
+                "messages": self.sent_messages[message_type],
+                "queue_delay_avg": self.delay_sum[message_type] * 1000 / count if count else 0.0,
+                "queue_delay_max": self.delay_max[message_type] * 1000,
+                "backlog": self.backlog(message_type),
+            }
+        self.reset_stats()
+        return result
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import pickle
+import ssl
+import time
+from typing import Dict, Optional, Tuple
+
+from aioquic.tls import SessionTicket
+
+logger = logging.getLogger("session")
+
+SESSION_TICKET_FILE = "session_tickets.pkl"
+
+
+class SessionTicketCache:
+    """按 host:port 持久化保存 session ticket 和当时协商的ALPN，用于0-RTT重连"""
+
+    def __init__(self, path=SESSION_TICKET_FILE):
+        self.path = path
+        self.tickets: Dict[str, Tuple[SessionTicket, Optional[str]]] = {}
+        self.load()
+
+    @staticmethod
+    def key(host, port) -> str:
+        return f"{host}:{port}"
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as fp:
+                self.tickets = pickle.load(fp)
+        except Exception as e:
+            logger.warning(f"Unable to read {self.path}: {e}")
+            self.tickets = {}
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "wb") as fp:
+                pickle.dump(self.tickets, fp)
+        except OSError as e:
+            logger.warning(f"Unable to write {self.path}: {e}")
+
+    def get(self, host, port) -> Tuple[Optional[SessionTicket], Optional[str]]:
+        """返回 (ticket, alpn)，没有或已过期时返回 (None, None)"""
+        entry = self.tickets.get(self.key(host, port))
+        if entry is None:
+            return None, None
+        ticket, alpn = entry
+        if not ticket.is_valid:
+            self.remove(host, port)
+            return None, None
+        return ticket, alpn
+
+    def add(self, host, port, ticket: SessionTicket, alpn=None):
+        self.tickets[self.key(host, port)] = (ticket, alpn)
+        self.save()
+
+    def remove(self, host, port):
+        if self.tickets.pop(self.key(host, port), None) is not None:
+            self.save()
+
+    def handler(self, host, port, alpn=None):
+        """返回给 connect(session_ticket_handler=...) 使用的回调，alpn 可以是返回当前ALPN的函数"""
+        def save_session_ticket(ticket: SessionTicket):
+            logger.info(f"New session ticket received for {self.key(host, port)}")
+            self.add(host, port, ticket, alpn() if callable(alpn) else alpn)
+        return save_session_ticket
+
+
+def early_data_allowed(ticket: Optional[SessionTicket]) -> bool:
+    return ticket is not None and ticket.max_early_data_size is not None
+
+
+def resumption_benchmark(rounds=5, one_way_delay=0.025, port=30544):
+    """本地aioquic服务端(模拟 one_way_delay 的单向延迟)，
+    对比完整握手和0-RTT恢复时 从开始连接到收到第一帧 的时间"""
+    from aioquic.asyncio import QuicConnectionProtocol, serve
+    from aioquic.asyncio.client import connect
+    from aioquic.quic.configuration import QuicConfiguration
+    from aioquic.quic.events import StreamDataReceived
+    from pkg.frame import build_header
+
+    class FirstFrameProtocol(QuicConnectionProtocol):
+        # 收到register后立刻回一帧，模拟中继转发的第一帧视频
+        def quic_event_received(self, event):
+            if isinstance(event, StreamDataReceived) and event.data:
+                self._quic.send_stream_data(event.stream_id, build_header(4) + b"\x00\x00\x00\x00")
+                self.transmit()
+
+    class DelayedClientProtocol(QuicConnectionProtocol):
+        # 在握手开始前包装发送，完整握手和0-RTT的第一个包同样延迟、同样计数
+        def connection_made(self, transport):
+            loop = asyncio.get_running_loop()
+            sendto = transport.sendto
+            self.sent_packets = 0
+
+            def delayed_sendto(data, addr=None):
+                self.sent_packets += 1
+                loop.call_later(one_way_delay, sendto, data, addr)
+            transport.sendto = delayed_sendto
+            super().connection_made(transport)
+
+    class TicketStore:
+        def __init__(self):
+            self.tickets = {}
+
+        def add(self, ticket):
+            self.tickets[ticket.ticket] = ticket
+
+        def pop(self, label):
+            return self.tickets.pop(label, None)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        store = TicketStore()
+        server_configuration = QuicConfiguration(alpn_protocols=["HLD"], is_client=False)
+        server_configuration.load_cert_chain("assets/tls/cert.pem", "assets/tls/key.pem")
+        server = await serve("127.0.0.1", port, configuration=server_configuration,
+                             create_protocol=FirstFrameProtocol,
+                             session_ticket_fetcher=store.pop, session_ticket_handler=store.add)
+        # 服务端发包延迟 one_way_delay，客户端发包延迟同样的时间，RTT=2*one_way_delay
+        server_sendto = server._transport.sendto
+        server._transport.sendto = lambda data, addr=None: loop.call_later(one_way_delay, server_sendto, data, addr)
+
+        cache = SessionTicketCache(path=None)
+        results = {"full": [], "0-rtt": []}
+        packets = {"full": [], "0-rtt": []}
+        try:
+            for i in range(rounds * 2):
+                configuration = QuicConfiguration(alpn_protocols=["HLD"], is_client=True)
+                configuration.verify_mode = ssl.CERT_NONE
+                ticket, _ = cache.get("127.0.0.1", port)
+                resume = i % 2 == 1 and early_data_allowed(ticket)
+                configuration.session_ticket = ticket if resume else None
+                start = time.perf_counter()
+                async with connect("127.0.0.1", port, configuration=configuration,
+                                   create_protocol=DelayedClientProtocol,
+                                   session_ticket_handler=cache.handler("127.0.0.1", port),
+                                   wait_connected=not resume) as client:
+                    reader, writer = await client.create_stream()
+                    writer.write(build_header(2) + b"\x08\x01")
+                    client.transmit()
+                    await reader.readexactly(8)
+                    results["0-rtt" if resume else "full"].append(time.perf_counter() - start)
+                    # 客户端到收到第一帧为止发出的包数
+                    packets["0-rtt" if resume else "full"].append(client.sent_packets)
+                    # 等待服务端下发新的ticket
+                    await asyncio.sleep(one_way_delay * 2)
+        finally:
+            server.close()
+        return results, packets
+
+    results, packets = asyncio.run(run())
+    for name, samples in results.items():
+        if samples:
+            print(f"{name:6s} time-to-first-frame avg {sum(samples)/len(samples)*1000:.1f}ms "
+                  f"min {min(samples)*1000:.1f}ms, client packets avg {sum(packets[name])/len(packets[name]):.1f} "
+                  f"({len(samples)} runs, rtt {one_way_delay*2000:.0f}ms)")
+
+
+if __name__ == "__main__":
+    resumption_benchmark()
@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Iterator, NamedTuple
+
+from aioquic.quic.logger import QLOG_VERSION, QuicLogger, QuicLoggerTrace
+
+logger = logging.getLogger("trace")
+
+# 后台线程里排队的记录超过这个数时直接丢弃，磁盘写不过来也不拖慢事件循环
+MAX_PENDING = 100000
+# 写线程每批最多取出的记录数
+WRITE_BATCH = 1024
+
+# 二进制消息跟踪: 文件头 + 定长记录
+# [time.time() 秒(double), stream_id, 消息类型, 方向, flags, 大小, 队列延迟毫秒(float)]
+TRACE_MAGIC = b"HLTR\x01"
+TRACE_RECORD = struct.Struct("<dIBBBIf")
+DIRECTION_SEND = 0
+DIRECTION_RECEIVE = 1
+
+# JSON-SEQ 格式的qlog，每条事件前加RS，可以边写边读，连接没有正常结束也不会丢失
+RECORD_SEPARATOR = "\x1e"
+
+
+class BackgroundWriter:
+    """后台线程写文件
+
+    write 只把记录放进队列，encode(记录列表)->bytes/str 和写磁盘都在后台线程里做。
+    """
+
+    def __init__(self, path, encode, header=None, binary=False, max_pending=MAX_PENDING):
+        self.path = path
+        self.encode = encode
+        self.max_pending = max_pending
+        self.queue = queue.SimpleQueue()
+        self.dropped = 0
+        self.written = 0
+        self.closed = False
+        self.fp = open(path, "wb" if binary else "w")
+        if header:
+            self.fp.write(header)
+        self.thread = threading.Thread(target=self.__run, name=f"trace-{os.path.basename(path)}", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        if self.closed:
+            return
+        if self.queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            return
+        self.queue.put(record)
+
+    def __run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < WRITE_BATCH:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = records[-1] is None
+            if stop:
+                records.pop()
+            if records:
+                try:
+                    self.fp.write(self.encode(records))
+                    self.written += len(records)
+                except Exception as e:
+                    logger.warning(f"write {self.path} failed: {e}")
+            if stop:
+                self.fp.close()
+                return
+            if self.queue.empty():
+                self.fp.flush()
+
+    def close(self, timeout=2.0):
+        """写完排队的记录后关闭文件，最多等待 timeout 秒"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.dropped:
+            logger.warning(f"{self.path}: {self.dropped} records dropped")
+
+
+def _encode_qlog_events(events) -> str:
+    return "".join(RECORD_SEPARATOR + json.dumps(event) + "\n" for event in events)
+
+
+class BackgroundQlogTrace(QuicLoggerTrace):
+    """事件不保存在内存里，交给后台线程按 JSON-SEQ 写入"""
+
+    def __init__(self, *, is_client: bool, odcid: bytes, path: str) -> None:
+        super().__init__(is_client=is_client, odcid=odcid)
+        header = {
+            "qlog_format": "JSON-SEQ",
+            "qlog_version": QLOG_VERSION,
+            "trace": {
+                "common_fields": {"ODCID": odcid.hex()},
+                "vantage_point": self._vantage_point,
+            },
+        }
+        self.writer = BackgroundWriter(
+            os.path.join(path, f"{int(time.time())}-{odcid.hex()}.sqlog"),
+            _encode_qlog_events,
+            header=RECORD_SEPARATOR + json.dumps(header) + "\n",
+        )
+
+    def log_event(self, *, category: str, event: str, data: dict) -> None:
+        self.writer.write({"data": data, "name": category + ":" + event, "time": self.encode_time(time.time())})
+
+
+class BackgroundQlogLogger(QuicLogger):
+    """QuicFileLogger 的替代: 每个连接一个 .sqlog 文件，边运行边在后台线程写入
+
+    QuicFileLogger 把整个连接的事件保存在内存里，连接结束时在事件循环线程里一次性写出。
+    """
+
+    def __init__(self, path: str) -> None:
+        if not os.path.isdir(path):
+            raise ValueError("QUIC log output directory '%s' does not exist" % path)
+        self.path = path
+        super().__init__()
+
+    def start_trace(self, is_client: bool, odcid: bytes) -> QuicLoggerTrace:
+        trace = BackgroundQlogTrace(is_client=is_client, odcid=odcid, path=self.path)
+        self._traces.append(trace)
+        return trace
+
+    def end_trace(self, trace: QuicLoggerTrace) -> None:
+        super().end_trace(trace)
+        trace.writer.close(timeout=0)
+        self._traces.remove(trace)
+
+    def close(self):
+        for trace in self._traces:
+            trace.writer.close()
+        self._traces = []
+
+
+class TraceRecord(NamedTuple):
+    time: float
+    stream_id: int
+    message_type: int
+    direction: int
+    flags: int
+    size: int
+    queue_delay: float
+
+
+def _encode_trace_records(records) -> bytes:
+    return b"".join(TRACE_RECORD.pack(*record) for record in records)
+
+
+class MessageTrace:
+    """每条帧消息一条定长二进制记录，用来和qlog里的传输层事件对齐
+
+    发送: 从 FrameWriter.write 排队到交给aioquic的时间；
+    接收: 从数据块到达 FrameReader 到被应用取走的时间。
+    """
+
+    def __init__(self, path):
+        self.writer = BackgroundWriter(path, _encode_trace_records, header=TRACE_MAGIC, binary=True)
+
+    def recorder(self, message_type: int, stream_id: int, direction: int):
+        """返回给 FrameWriter/FrameReader 的 trace 回调: (大小, flags, 队列延迟秒)"""
+        write = self.writer.write
+
+        def record(size, flags, delay):
+            write((time.time(), stream_id, message_type, direction, flags, size, delay * 1000))
+        return record
+
+    def close(self):
+        self.writer.close()
+
+
+def read_trace(path) -> Iterator[TraceRecord]:
+    with open(path, "rb") as fp:
+        if fp.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a message trace")
+        while True:
+            data = fp.read(TRACE_RECORD.size * WRITE_BATCH)
+            # 最后一条可能没写完整
+            for offset in range(0, len(data) - TRACE_RECORD.size + 1, TRACE_RECORD.size):
+                yield TraceRecord(*TRACE_RECORD.unpack_from(data, offset))
+            if len(data) < TRACE_RECORD.size * WRITE_BATCH:
+                return
+
+
+def summarize(path, stall_ms=100.0):
+    """按流和方向统计消息数、字节数、队列延迟，列出队列延迟超过 stall_ms 的消息"""
+    from protocol.highway_pb2 import Device
+
+    streams = {}
+    stalls = []
+    start = None
+    for record in read_trace(path):
+        start = record.time if start is None else start
+        key = (Device.MessageType.Name(record.message_type), record.stream_id,
+               "send" if record.direction == DIRECTION_SEND else "receive")
+        stats = streams.setdefault(key, {"messages": 0, "bytes": 0, "delay_sum": 0.0, "delay_max": 0.0})
+        stats["messages"] += 1
+        stats["bytes"] += record.size
+        stats["delay_sum"] += record.queue_delay
+        stats["delay_max"] = max(stats["delay_max"], record.queue_delay)
+        if record.queue_delay >= stall_ms:
+            stalls.append(record)
+    for (name, stream_id, direction), stats in sorted(streams.items()):
+        print(f"{name:8s} stream {stream_id:3d} {direction:7s} {stats['messages']:8d} msgs {stats['bytes'] / 1e6:9.2f}MB "
+              f"queue delay avg {stats['delay_sum'] / stats['messages']:.2f}ms max {stats['delay_max']:.2f}ms")
+    for record in stalls[:50]:
+        print(f"stall +{record.time - start:.3f}s {time.strftime('%H:%M:%S', time.localtime(record.time))}"
+              f".{int(record.time % 1 * 1000):03d} stream {record.stream_id} {'send' if record.direction == DIRECTION_SEND else 'receive'} "
+              f"{record.size} bytes queued {record.queue_delay:.1f}ms")
+
+
+def test_message_trace(count=200000):
+    """记录在事件循环线程里只是放进队列，检查写入的记录完整，以及每条记录的开销"""
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "trace.bin")
+    trace = MessageTrace(path)
+    record = trace.recorder(2, 4, DIRECTION_SEND)
+    start = time.perf_counter()
+    for i in range(count):
+        record(i, i & 0xff, i / 1e6)
+    elapsed = time.perf_counter() - start
+    trace.close()
+    records = list(read_trace(path))
+    assert len(records) + trace.writer.dropped == count
+    assert all(r.flags == r.size & 0xff for r in records)
+    assert records[-1].stream_id == 4 and records[-1].message_type == 2
+    print(f"{count} records, {elapsed / count * 1e6:.2f}us per record on the caller, "
+          f"{os.path.getsize(path) / count:.0f} bytes per record, dropped {trace.writer.dropped}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize a HighwayQuicClient message trace")
+    parser.add_argument("trace", nargs="?", help="message trace file (trace_file setting)")
+    parser.add_argument("--stall-ms", type=float, default=100.0, help="report messages queued longer than this")
+    args = parser.parse_args()
+    if args.trace:
+        summarize(args.trace, args.stall_ms)
+    else:
+        test_message_trace()
@@ -0,0 +1,489 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import time
+import zlib
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from pkg.frame import Frame, FrameWriter
+from pkg.wire import decode_message, write_message
+from protocol.highway_pb2 import File
+
+logger = logging.getLogger("upload")
+
+UPLOAD_STATE_FILE = "upload_state.json"
+BLOCK_SIZE = 1024 * 1024
+# File消息除data以外的字段预留
+BLOCK_OVERHEAD = 256
+# 每个流最多有多少个未确认的块
+WINDOW = 4
+ACK_TIMEOUT = 10.0
+SAVE_INTERVAL = 1.0
+# 每个流提前在线程池里计算checksum(同时把页读入内存)的块数
+READ_AHEAD = 2
+# 进度信号的最短间隔
+PROGRESS_INTERVAL = 0.2
+
+
+def file_key(path) -> str:
+    """文件名+大小+修改时间，文件变化后不会错误地续传"""
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class UploadState:
+    """按文件持久化保存已确认的块，重连或重启后从这里续传"""
+
+    def __init__(self, path=UPLOAD_STATE_FILE):
+        self.path = path
+        self.uploads = {}
+        self.last_save = 0.0
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as fp:
+                self.uploads = json.load(fp)
+        except Exception as e:
+            logger.warning(f"Unable to read {self.path}: {e}")
+            self.uploads = {}
+
+    def save(self, force=True):
+        now = time.monotonic()
+        if not self.path or (not force and now - self.last_save < SAVE_INTERVAL):
+            return
+        self.last_save = now
+        try:
+            with open(self.path, "w") as fp:
+                json.dump(self.uploads, fp)
+        except OSError as e:
+            logger.warning(f"Unable to write {self.path}: {e}")
+
+    def acked(self, key, block_size) -> set:
+        entry = self.uploads.get(key)
+        if entry is None or entry["block_size"] != block_size:
+            return set()
+        return set(entry["acked"])
+
+    def update(self, key, block_size, acked):
+        self.uploads[key] = {"block_size": block_size, "acked": sorted(acked)}
+        self.save(force=False)
+
+    def remove(self, key):
+        if self.uploads.pop(key, None) is not None:
+            self.save()
+
+
+class BlockUploader:
+    """把文件分块，通过多个FILE流并行上传
+
+    文件以mmap打开，块数据以memoryview切片直接交给FrameWriter，不读入也不拷贝到protobuf里；
+    checksum在线程池里计算，同时也完成了这部分文件的预读。
+    每个块是一条 File(name, offset, total_size, data, checksum=crc32, block_id, last_block) 消息，
+    接收端校验后回一条不带data的 File(name, block_id, checksum) 作为确认，checksum不一致表示需要重传。
+    streams 是 (receive, frame_writer) 列表，receive 是读取下一帧的协程函数。
+    """
+
+    def __init__(self, path, streams: List[Tuple[Callable[[], Awaitable[Frame]], FrameWriter]],
+                 block_size=BLOCK_SIZE, window=WINDOW, ack_timeout=ACK_TIMEOUT,
+                 state: Optional[UploadState] = None, progress=None, read_ahead=READ_AHEAD,
+                 progress_interval=PROGRESS_INTERVAL):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.total_size = os.stat(path).st_size
+        self.key = file_key(path)
+        self.streams = streams
+        # v1帧长度只有16位，块大小不能超过单帧能容纳的数据
+        max_block = min(frame_writer.max_payload for _, frame_writer in streams) - BLOCK_OVERHEAD
+        self.block_size = min(block_size, max_block)
+        self.block_count = max(1, -(-self.total_size // self.block_size))
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.state = state or UploadState(path=None)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.progress_time = 0.0
+        self.read_ahead = read_ahead
+        self.acked = self.state.acked(self.key, self.block_size)
+        self.pending = deque(i for i in range(self.block_count) if i not in self.acked)
+        self.inflight = {}
+        self.changed = asyncio.Event()
+        self.done = asyncio.Event()
+        self.file = None
+        self.view = None
+        self.checksums = {}
+        self.sent_blocks = 0
+        self.resent_blocks = 0
+        self.sent_bytes = 0
+
+    def __block(self, block_id) -> memoryview:
+        return self.view[block_id * self.block_size:(block_id + 1) * self.block_size]
+
+    def __checksum(self, block_id) -> asyncio.Future:
+        future = self.checksums.get(block_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.checksums[block_id] = loop.run_in_executor(None, zlib.crc32, self.__block(block_id))
+        return future
+
+    def __report_progress(self):
+        now = time.monotonic()
+        if self.progress and (now - self.progress_time >= self.progress_interval or len(self.acked) >= self.block_count):
+            self.progress_time = now
+            self.progress(self.name, round(len(self.acked) * 100 / self.block_count))
+
+    def __next_block(self, stream_index):
+        """返回下一个要发送的块，没有时返回None"""
+        if sum(1 for s, _, _ in self.inflight.values() if s == stream_index) >= self.window:
+            return None
+        if self.pending:
+            return self.pending.popleft()
+        now = time.monotonic()
+        for block_id, (_, sent_time, _) in self.inflight.items():
+            if now - sent_time > self.ack_timeout:
+                self.resent_blocks += 1
+                return block_id
+        return None
+
+    async def __send_blocks(self, stream_index, frame_writer: FrameWriter):
+        while not self.done.is_set():
+            block_id = self.__next_block(stream_index)
+            if block_id is None:
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.inflight[block_id] = (stream_index, time.monotonic(), None)
+            # 后面几个块的checksum先在线程池里算起来
+            for next_block in list(self.pending)[:self.read_ahead]:
+                self.__checksum(next_block)
+            checksum = await self.__checksum(block_id)
+            self.checksums.pop(block_id, None)
+            self.inflight[block_id] = (stream_index, time.monotonic(), checksum)
+            data = self.__block(block_id)
+            message = File(
+                name=self.name,
+                offset=block_id * self.block_size,
+                total_size=self.total_size,
+                checksum=checksum,
+                block_id=block_id,
+                last_block=block_id == self.block_count - 1,
+            )
+            # data是mmap上的memoryview，对端支持时作为 FLAG_OOB 帧的payload
+            write_message(frame_writer, message, data)
+            await frame_writer.flush()
+            self.sent_blocks += 1
+            self.sent_bytes += len(data)
+
+    async def __receive_acks(self, receive):
+        while not self.done.is_set():
+            frame = await receive()
+            ack = File.FromString(frame.payload)
+            if ack.name != self.name or ack.data:
+                continue
+            entry = self.inflight.get(ack.block_id)
+            if entry is None or entry[2] is None:
+                continue
+            del self.inflight[ack.block_id]
+            if ack.checksum != entry[2]:
+                logger.warning(f"{self.name} block {ack.block_id} checksum mismatch, resend")
+                self.pending.appendleft(ack.block_id)
+            else:
+                self.acked.add(ack.block_id)
+                self.state.update(self.key, self.block_size, self.acked)
+                self.__report_progress()
+                if len(self.acked) >= self.block_count:
+                    self.done.set()
+            self.changed.set()
+
+    async def run(self) -> bool:
+        """全部块确认后返回True，连接断开时抛出异常，已确认的块保存在state里"""
+        if len(self.acked) >= self.block_count:
+            self.state.remove(self.key)
+            return True
+        if self.acked:
+            logger.info(f"resume {self.name} from {len(self.acked)}/{self.block_count} blocks")
+        self.file = open(self.path, "rb")
+        # 空文件不能mmap
+        self.view = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.total_size else b"")
+        tasks = [asyncio.ensure_future(self.__receive_acks(receive)) for receive, _ in self.streams]
+        tasks += [asyncio.ensure_future(self.__send_blocks(i, frame_writer))
+                  for i, (_, frame_writer) in enumerate(self.streams)]
+        done_task = asyncio.ensure_future(self.done.wait())
+        try:
+            # 全部确认或任一流出错时结束
+            waiting = set(tasks) | {done_task}
+            while not self.done.is_set():
+                finished, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    if task is not done_task and task.exception():
+                        raise task.exception()
+            self.state.remove(self.key)
+            return True
+        finally:
+            for task in tasks + [done_task]:
+                task.cancel()
+            await asyncio.gather(*self.checksums.values(), return_exceptions=True)
+            self.checksums = {}
+            self.__close_view()
+            self.file.close()
+            self.state.save()
+
+    def __close_view(self):
+        mapped = self.view.obj
+        try:
+            self.view.release()
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        except BufferError:
+            # 还有切片在FrameWriter里排队，等它们被释放后由GC关闭
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "blocks": self.block_count,
+            "acked": len(self.acked),
+            "sent": self.sent_blocks,
+            "resent": self.resent_blocks,
+            "bytes": self.sent_bytes,
+        }
+
+
+class BlockReceiver:
+    """接收端: 校验并按offset写入文件，返回确认消息，所有数据收齐后去掉 .part 后缀"""
+
+    def __init__(self, directory="."):
+        self.directory = directory
+        self.files = {}
+
+    def handle(self, message: File) -> Optional[File]:
+        if not message.data and not message.last_block:
+            return None
+        checksum = zlib.crc32(message.data)
+        ack = File(name=message.name, block_id=message.block_id, offset=message.offset, checksum=checksum)
+        if checksum != message.checksum:
+            return ack
+        name = os.path.basename(message.name)
+        entry = self.files.get(name)
+        if entry is None:
+            path = os.path.join(self.directory, name + ".part")
+            fp = open(path, "r+b" if os.path.exists(path) else "w+b")
+            fp.truncate(message.total_size)
+            entry = self.files[name] = {"fp": fp, "blocks": {}, "path": path}
+        if message.block_id not in entry["blocks"]:
+            entry["fp"].seek(message.offset)
+            entry["fp"].write(message.data)
+            entry["blocks"][message.block_id] = len(message.data)
+        if sum(entry["blocks"].values()) >= message.total_size and entry["blocks"]:
+            entry["fp"].close()
+            os.replace(entry["path"], os.path.join(self.directory, name))
+            del self.files[name]
+        return ack
+
+
+def test_block_upload(size=24 * 1024 * 1024, streams=4, port=30546):
+    """本地中继 + 接收端，上传到一半时断开连接，重连后从已确认的块续传"""
+    import hashlib
+    import ssl
+    import tempfile
+
+    from aioquic.asyncio.client import connect
+    from aioquic.quic.configuration import QuicConfiguration
+
+    from pkg.frame import ALPN_V3, FrameReader
+    from pkg.relay import relay_configuration, start_relay
+    from protocol.highway_pb2 import Device, Register
+
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "firmware.bin")
+    with open(source, "wb") as fp:
+        fp.write(os.urandom(size))
+    output = os.path.join(directory, "received")
+    os.mkdir(output)
+    state = UploadState(os.path.join(directory, UPLOAD_STATE_FILE))
+
+    def configuration():
+        configuration = QuicConfiguration(alpn_protocols=[ALPN_V3], is_client=True)
+        configuration.verify_mode = ssl.CERT_NONE
+        return configuration
+
+    async def open_stream(client, device_id, subscribe_id):
+        reader, writer = await client.create_stream()
+        frame_writer = FrameWriter(writer, delay=0, version=3)
+        register = Register(device=Device(id=device_id, message_type=Device.MessageType.FILE),
+                            subscribe_device=Device(id=subscribe_id, message_type=Device.MessageType.FILE))
+        frame_writer.write(register.SerializeToString())
+        await frame_writer.flush()
+        return FrameReader(reader, version=3), frame_writer
+
+    async def receiver(ready):
+        receiver = BlockReceiver(output)
+        async with connect("127.0.0.1", port, configuration=configuration()) as client:
+            frame_reader, frame_writer = await open_stream(client, 2, 1)
+            ready.set()
+            while True:
+                frame = await frame_reader.read_frame()
+                ack = receiver.handle(decode_message(frame, File))
+                if ack is not None:
+                    frame_writer.write(ack.SerializeToString())
+
+    async def upload(stop_after=None):
+        async with connect("127.0.0.1", port, configuration=configuration()) as client:
+            pairs = [await open_stream(client, 1, 2) for _ in range(streams)]
+            uploader = BlockUploader(source, [(frame_reader.read_frame, frame_writer) for frame_reader, frame_writer in pairs],
+                                     state=state)
+            if stop_after is None:
+                start = time.perf_counter()
+                result = await uploader.run()
+                return result, uploader.stats(), time.perf_counter() - start
+            task = asyncio.ensure_future(uploader.run())
+            while len(uploader.acked) < uploader.block_count * stop_after:
+                await asyncio.sleep(0.01)
+            # 模拟断线: 直接关闭连接
+            client.close()
+            try:
+                await task
+            except (asyncio.CancelledError, ConnectionError, asyncio.IncompleteReadError):
+                pass
+            return False, uploader.stats(), 0
+
+    async def run():
+        server, _ = await start_relay("127.0.0.1", port, relay_configuration())
+        ready = asyncio.Event()
+        receive_task = asyncio.ensure_future(receiver(ready))
+        await ready.wait()
+        try:
+            _, first, _ = await upload(stop_after=0.4)
+            print("interrupted", first)
+            result, second, elapsed = await upload()
+            print("resumed", second, f"{second['bytes'] / elapsed / 1e6:.1f} MB/s")
+            assert result
+            assert second["sent"] <= first["blocks"] - first["acked"] + streams * WINDOW
+            for _ in range(100):
+                if os.path.exists(os.path.join(output, "firmware.bin")):
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            receive_task.cancel()
+            server.close()
+
+    asyncio.run(run())
+    with open(source, "rb") as a, open(os.path.join(output, "firmware.bin"), "rb") as b:
+        assert hashlib.sha256(a.read()).digest() == hashlib.sha256(b.read()).digest()
+    assert not state.uploads
+    print("upload resumed and verified")
+
+
+def upload_benchmark(size=256 * 1024 * 1024, streams=4):
+    """对比旧的逐KB读写(每KB一次write+drain和一次进度回调)和分块mmap上传的
+    每GB CPU时间和上传期间事件循环的延迟。写入端模拟aioquic，把数据拼接进发送缓冲后丢弃。"""
+    import tempfile
+
+    class Transport:
+        def __init__(self):
+            self.bytes = 0
+
+        def write(self, data):
+            self.bytes += len(bytes(data))
+
+        def writelines(self, data):
+            self.bytes += len(b"".join(data))
+
+    class Writer:
+        def __init__(self):
+            self.transport = Transport()
+            self.drained = asyncio.Event()
+
+        def write(self, data):
+            self.transport.write(data)
+
+        def writelines(self, data):
+            self.transport.writelines(data)
+
+        async def drain(self):
+            self.drained.set()
+            await asyncio.sleep(0)
+
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as fp:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(size // len(chunk)):
+            fp.write(chunk)
+
+    async def lag_monitor(lateness, interval=0.005):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lateness.append(time.perf_counter() - start - interval)
+
+    async def legacy(progress):
+        writer = Writer()
+        with open(path, "rb") as f:
+            file_size = os.stat(path).st_size
+            send_size = 0
+            while True:
+                data = f.read(1024)
+                if len(data) == 0:
+                    break
+                writer.write(data)
+                await writer.drain()
+                send_size += len(data)
+                progress(os.path.basename(path), round(send_size * 100 / file_size))
+
+    async def blocks(progress):
+        writers = [FrameWriter(Writer(), delay=0, version=2) for _ in range(streams)]
+        uploader = None
+
+        def make_receive(frame_writer):
+            async def receive():
+                # 写出一批后确认这个流上所有已发出的块
+                while True:
+                    writer = frame_writer.writer
+                    writer.drained.clear()
+                    await writer.drained.wait()
+                    stream_index = writers.index(frame_writer)
+                    for block_id, (index, _, checksum) in list(uploader.inflight.items()):
+                        if index == stream_index and checksum is not None:
+                            return Frame(File(name=uploader.name, block_id=block_id, checksum=checksum).SerializeToString(), 0)
+            return receive
+
+        uploader = BlockUploader(path, [(make_receive(w), w) for w in writers], progress=progress)
+        await uploader.run()
+
+    async def run(send):
+        lateness = []
+        progress_count = [0]
+
+        def progress(name, value):
+            progress_count[0] += 1
+
+        monitor = asyncio.ensure_future(lag_monitor(lateness))
+        start = time.process_time()
+        wall = time.perf_counter()
+        await send(progress)
+        cpu = time.process_time() - start
+        wall = time.perf_counter() - wall
+        monitor.cancel()
+        lateness.sort()
+        gb = size / 1024 ** 3
+        print(f"{send.__name__:7s} {size / 1024 ** 2:.0f}MB in {wall:.2f}s, cpu {cpu / gb:.2f}s/GB, "
+              f"progress events {progress_count[0]}, loop lag p99 {lateness[int(len(lateness) * 0.99)] * 1000:.2f}ms "
+              f"max {lateness[-1] * 1000:.2f}ms")
+
+    try:
+        for send in (legacy, blocks):
+            asyncio.run(run(send))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    test_block_upload()
+    # upload_benchmark()
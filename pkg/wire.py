@@ -0,0 +1,308 @@
+import time
+from typing import NamedTuple
+
+from google.protobuf.internal import api_implementation
+from google.protobuf.message import DecodeError
+
+from pkg.frame import FLAG_OOB, Frame, encode_varint
+
+# Video/Audio 的字段: raw=1 (bytes), timestamp=2 (int64), counter=3 (uint64)
+RAW_TAG = 1 << 3 | 2
+TIMESTAMP_TAG = 2 << 3 | 0
+COUNTER_TAG = 3 << 3 | 0
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH = 2
+WIRE_FIXED32 = 5
+
+# C实现(upb/cpp)的FromString拷贝raw也很快，小消息上比纯Python遍历wire格式更快，
+# 只有消息超过这个大小时才走 parse_media；纯Python实现的protobuf总是走 parse_media
+FAST_PATH_SIZE = 0 if api_implementation.Type() == "python" else 64 * 1024
+
+
+class MediaView(NamedTuple):
+    """Video/Audio消息的只读视图，raw是原消息上的memoryview切片"""
+    raw: memoryview
+    timestamp: int = 0
+    counter: int = 0
+
+
+def _varint(buf, pos, end):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= end:
+            raise DecodeError("Truncated varint")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise DecodeError("Too many bytes when decoding varint")
+
+
+def parse_media(data) -> MediaView:
+    """不经过protobuf反序列化，直接在wire格式上找出 Video/Audio 的字段
+
+    raw 不拷贝，只解码 timestamp 和 counter 两个小字段，其他未知字段跳过。
+    和 Video.FromString 一样，重复出现的字段以最后一个为准，数据损坏时抛出 DecodeError。
+    """
+    # 在bytes上按下标取字节比memoryview快，只有raw切片使用memoryview
+    view = memoryview(data)
+    buf = data if isinstance(data, bytes) else view
+    end = len(view)
+    pos = 0
+    raw_start = raw_end = 0
+    timestamp = 0
+    counter = 0
+    while pos < end:
+        tag = buf[pos]
+        if tag < 0x80:
+            pos += 1
+        else:
+            tag, pos = _varint(buf, pos, end)
+        if tag == RAW_TAG:
+            if pos >= end:
+                raise DecodeError("Truncated message")
+            length = buf[pos]
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = _varint(buf, pos, end)
+            if pos + length > end:
+                raise DecodeError("Truncated message")
+            raw_start, raw_end = pos, pos + length
+            pos += length
+        elif tag == TIMESTAMP_TAG:
+            timestamp, pos = _varint(buf, pos, end)
+            if timestamp >= 1 << 63:
+                timestamp -= 1 << 64
+        elif tag == COUNTER_TAG:
+            counter, pos = _varint(buf, pos, end)
+            counter &= (1 << 64) - 1
+        else:
+            wire_type = tag & 7
+            if tag >> 3 == 0:
+                raise DecodeError("Field number 0 is illegal")
+            if wire_type == WIRE_VARINT:
+                _, pos = _varint(buf, pos, end)
+            elif wire_type == WIRE_FIXED64:
+                pos += 8
+            elif wire_type == WIRE_LENGTH:
+                length, pos = _varint(buf, pos, end)
+                pos += length
+            elif wire_type == WIRE_FIXED32:
+                pos += 4
+            else:
+                raise DecodeError(f"Unsupported wire type {wire_type}")
+            if pos > end:
+                raise DecodeError("Truncated message")
+    return MediaView(view[raw_start:raw_end], timestamp, counter)
+
+
+def read_media(data, message_class):
+    """返回带 raw/timestamp/counter 的 Video/Audio，大消息的raw是不拷贝的memoryview"""
+    if len(data) >= FAST_PATH_SIZE:
+        return parse_media(data)
+    return message_class.FromString(data)
+
+
+# FLAG_OOB 帧里不经过protobuf的payload字段
+PAYLOAD_FIELDS = {"Video": "raw", "Audio": "raw", "File": "data"}
+
+
+def payload_field(message_class) -> str:
+    return PAYLOAD_FIELDS[message_class.DESCRIPTOR.name]
+
+
+def payload_parts(message, payload) -> tuple:
+    """不带payload字段的message按 (其他字段+payload的tag和长度, payload) 两段返回，
+    拼起来和带payload的 SerializeToString() 结果等价"""
+    field = message.DESCRIPTOR.fields_by_name[payload_field(type(message))]
+    return message.SerializeToString() + encode_varint(field.number << 3 | WIRE_LENGTH) + encode_varint(len(payload)), payload
+
+
+class OobMessage:
+    """FLAG_OOB 帧的适配器，和 Video/Audio/File 一样按属性读取
+
+    payload字段是帧数据上的memoryview，其他字段从protobuf头读取。
+    """
+    __slots__ = ("header", "field", "payload")
+
+    def __init__(self, header, field, payload):
+        self.header = header
+        self.field = field
+        self.payload = payload
+
+    def __getattr__(self, name):
+        if name == self.field:
+            return self.payload
+        return getattr(self.header, name)
+
+
+def write_message(frame_writer, message, payload, flags=0) -> int:
+    """写入 message(不带payload字段) + payload，payload不拷贝
+
+    对端支持时使用 FLAG_OOB 帧，否则写成普通的protobuf消息。
+    """
+    if frame_writer.oob:
+        return frame_writer.write_oob(message.SerializeToString(), payload, flags)
+    return frame_writer.write_parts(payload_parts(message, payload), flags)
+
+
+def decode_message(frame: Frame, message_class):
+    """按消息类型解析一帧，FLAG_OOB 帧返回 OobMessage，Video/Audio的大消息返回 MediaView"""
+    if frame.flags & FLAG_OOB:
+        payload = memoryview(frame.payload)
+        header = message_class.FromString(payload[:frame.meta_size])
+        return OobMessage(header, payload_field(message_class), payload[frame.meta_size:])
+    if message_class.DESCRIPTOR.name in ("Video", "Audio"):
+        return read_media(frame.payload, message_class)
+    return message_class.FromString(frame.payload)
+
+
+def legacy_frame(frame: Frame, message_class) -> Frame:
+    """FLAG_OOB 帧转换成普通的protobuf消息，转发给不支持的对端"""
+    if not frame.flags & FLAG_OOB:
+        return frame
+    payload = memoryview(frame.payload)
+    header = message_class.FromString(payload[:frame.meta_size])
+    return Frame(b"".join(payload_parts(header, payload[frame.meta_size:])), frame.flags & ~FLAG_OOB)
+
+
+def test_parse_media(count=2000, seed=0):
+    """随机生成 Video/Audio 消息(包括未知字段、重复字段和负的时间戳)，和 highway_pb2 的解析结果对比"""
+    import random
+
+    from protocol.highway_pb2 import Audio, Report, Video
+
+    rnd = random.Random(seed)
+    for i in range(count):
+        message_class = Video if i % 2 else Audio
+        message = message_class(
+            raw=rnd.randbytes(rnd.choice((0, 1, 127, 128, 5000, 60000))),
+            timestamp=rnd.choice((0, 1, -1, int(time.time() * 1000), -(1 << 63), (1 << 63) - 1)),
+            counter=rnd.choice((0, 1, 300, (1 << 64) - 1)),
+        )
+        data = message.SerializeToString()
+        if i % 5 == 0:
+            # 未知字段(其他消息的字段号) + 再出现一次的counter
+            data += Report(battery=rnd.random()).SerializeToString().replace(b"\x0d", b"\x2d", 1)
+            data += message_class(counter=rnd.randrange(1, 1000)).SerializeToString()
+        expected = message_class.FromString(data)
+        parsed = parse_media(data)
+        assert bytes(parsed.raw) == expected.raw
+        assert parsed.timestamp == expected.timestamp
+        assert parsed.counter == expected.counter, (parsed.counter, expected.counter)
+    for data in (b"\x0a\x05abc", b"\x10", b"\x0a"):
+        try:
+            parse_media(data)
+        except DecodeError:
+            continue
+        raise AssertionError(f"truncated message {data!r} not rejected")
+    print(f"parse_media matches highway_pb2 on {count} messages")
+
+
+def test_oob_framing(count=500, seed=0):
+    """Video/Audio/File 分别用v2和v3写出，经过FrameReader后和原消息一致"""
+    import asyncio
+    import random
+
+    from pkg.frame import FrameReader, FrameWriter
+    from protocol.highway_pb2 import Audio, File, Video
+
+    class Writer:
+        def __init__(self):
+            self.data = bytearray()
+
+        def writelines(self, parts):
+            for part in parts:
+                self.data += part
+
+        async def drain(self):
+            pass
+
+    rnd = random.Random(seed)
+    messages = []
+    for i in range(count):
+        payload = rnd.randbytes(rnd.choice((0, 1, 200, 5000, 70000)))
+        if i % 3 == 0:
+            messages.append((File, File(name="a.bin", offset=i * 4096, block_id=i), payload))
+        else:
+            message_class = Video if i % 3 == 1 else Audio
+            messages.append((message_class, message_class(timestamp=-i, counter=i), payload))
+
+    async def run(version):
+        writer = Writer()
+        frame_writer = FrameWriter(writer, delay=0, version=version)
+        for i, (_, message, payload) in enumerate(messages):
+            write_message(frame_writer, message, payload, i & 0x3)
+        await frame_writer.flush()
+        reader = asyncio.StreamReader()
+        reader.feed_data(bytes(writer.data))
+        reader.feed_eof()
+        frame_reader = FrameReader(reader, version=version)
+        frames = [await frame_reader.read_frame() for _ in messages]
+        return frames
+
+    for version in (2, 3):
+        frames = asyncio.run(run(version))
+        for i, ((message_class, message, payload), frame) in enumerate(zip(messages, frames)):
+            assert bool(frame.flags & FLAG_OOB) == (version == 3)
+            assert frame.flags & 0x3 == i & 0x3
+            field = payload_field(message_class)
+            decoded = decode_message(frame, message_class)
+            assert bytes(getattr(decoded, field)) == payload
+            for name in ("timestamp", "counter", "name", "offset", "block_id"):
+                if hasattr(message, name):
+                    assert getattr(decoded, name) == getattr(message, name), name
+            # 转换成普通消息后旧的接收端照常解析
+            legacy = message_class.FromString(legacy_frame(frame, message_class).payload)
+            expected = message_class()
+            expected.CopyFrom(message)
+            setattr(expected, field, payload)
+            assert legacy == expected
+    print(f"oob framing matches protobuf on {count} messages")
+
+
+def parse_benchmark(sizes=(5000, 20000, 60000, 200000), count=20000):
+    """5-60KB的视频消息和200KB的关键帧
+
+    接收: Video.FromString 对比 parse_media/read_media 和 FLAG_OOB 帧的 decode_message；
+    发送: Video(raw=...).SerializeToString() 对比 FLAG_OOB 只序列化protobuf头。
+    """
+    from protocol.highway_pb2 import Video
+
+    for size in sizes:
+        raw = bytes(size)
+        timestamp = int(time.time() * 1000)
+        data = Video(raw=raw, timestamp=timestamp, counter=123456).SerializeToString()
+        meta = Video(timestamp=timestamp, counter=123456).SerializeToString()
+        oob = Frame(meta + raw, FLAG_OOB, len(meta))
+        results = []
+        for name, parse, arg in (("FromString", Video.FromString, data), ("parse_media", parse_media, data),
+                                 ("read_media", lambda data: read_media(data, Video), data),
+                                 ("oob", lambda frame: decode_message(frame, Video), oob)):
+            start = time.perf_counter()
+            for _ in range(count):
+                message = parse(arg)
+                message.raw, message.timestamp
+            elapsed = time.perf_counter() - start
+            results.append(f"{name} {elapsed / count * 1e6:.2f}us")
+        for name, encode in (("serialize", lambda: Video(raw=raw, timestamp=timestamp, counter=123456).SerializeToString()),
+                             ("oob encode", lambda: Video(timestamp=timestamp, counter=123456).SerializeToString())):
+            start = time.perf_counter()
+            for _ in range(count):
+                encode()
+            elapsed = time.perf_counter() - start
+            results.append(f"{name} {elapsed / count * 1e6:.2f}us")
+        print(f"{size // 1000:3d}KB: " + ", ".join(results))
+
+
+if __name__ == "__main__":
+    test_parse_media()
+    test_oob_framing()
+    parse_benchmark()